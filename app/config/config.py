@@ -33,15 +33,23 @@ def load_config():
 
 
 def save_config():
+    global version, _saved_config
     with open(config_file, "w", encoding="utf-8") as f:
         _cfg["app"] = app
         _cfg["azure"] = azure
         _cfg["siliconflow"] = siliconflow
         _cfg["ui"] = ui
-        f.write(toml.dumps(_cfg))
+        content = toml.dumps(_cfg)
+        f.write(content)
+    if content != _saved_config:
+        _saved_config = content
+        version += 1
 
 
 _cfg = load_config()
+# 配置改变并保存后加一，缓存了配置的模块据此重新读取
+version = 0
+_saved_config = toml.dumps(_cfg)
 app = _cfg.get("app", {})
 whisper = _cfg.get("whisper", {})
 proxy = _cfg.get("proxy", {})
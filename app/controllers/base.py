@@ -3,6 +3,7 @@ from uuid import uuid4
 from fastapi import Request
 
 from app.config import config
+from app.models import const
 from app.models.exception import HttpException
 
 
@@ -13,6 +14,11 @@ def get_task_id(request: Request):
     return str(task_id)
 
 
+def get_tenant_id(request: Request):
+    # 同一优先级的排队任务按租户轮流出队
+    return request.headers.get("x-tenant-id") or const.TASK_TENANT_DEFAULT
+
+
 def get_api_key(request: Request):
     api_key = request.headers.get("x-api-key")
     return api_key
@@ -0,0 +1,173 @@
+import os
+import stat
+from email.utils import parsedate_to_datetime
+from secrets import token_hex
+from typing import List, Optional, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import (
+    FileResponse,
+    MalformedRangeHeader,
+    RangeNotSatisfiable,
+    Response,
+)
+from starlette.types import Receive, Scope, Send
+
+from app.utils import utils
+
+_ZERO_COPY_EXTENSION = "http.response.zerocopysend"
+
+# the private methods of FileResponse overridden below, starlette is pinned in requirements.txt
+_FILE_RESPONSE_INTERNALS = (
+    "_parse_range_header",
+    "_handle_simple",
+    "_handle_single_range",
+    "_handle_multiple_ranges",
+    "generate_multipart",
+)
+_missing = [name for name in _FILE_RESPONSE_INTERNALS if not hasattr(FileResponse, name)]
+if _missing:
+    raise ImportError(
+        f"TaskFileResponse does not support this starlette version, missing: {', '.join(_missing)}"
+    )
+
+
+class TaskFileResponse(FileResponse):
+    """
+    serves a file of a task: conditional requests (etag / last-modified), single and multi range requests
+    and if-range come with starlette's FileResponse, this adds the 304 and fixes its 416 and multipart headers.
+    with a server that offers the asgi zero-copy extension the body is sent with sendfile,
+    otherwise it is read in large chunks in the thread pool
+    """
+
+    # 按页对齐的大块读取，每 MB 只需一次线程切换
+    chunk_size = 1024 * 1024
+
+    def _not_modified(self, headers: Headers, stat_result: os.stat_result) -> bool:
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in etags or self.headers["etag"] in etags
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            if not stat.S_ISREG(self.stat_result.st_mode):
+                raise RuntimeError(f"File at path {self.path} is not a file.")
+            self.set_stat_headers(self.stat_result)
+
+        headers = Headers(scope=scope)
+        if scope["method"].upper() in ("GET", "HEAD") and self._not_modified(headers, self.stat_result):
+            response = Response(
+                status_code=304,
+                headers={
+                    key: self.headers[key]
+                    for key in ("etag", "last-modified", "accept-ranges")
+                    if key in self.headers
+                },
+            )
+            return await response(scope, receive, send)
+
+        http_range = headers.get("range")
+        if http_range is not None:
+            try:
+                self._parse_range_header(http_range, self.stat_result.st_size)
+            except RangeNotSatisfiable as e:
+                # starlette leaves out the unit of the content-range
+                response = Response(
+                    status_code=416,
+                    headers={"content-range": f"bytes */{e.max_size}", "accept-ranges": "bytes"},
+                )
+                return await response(scope, receive, send)
+            except MalformedRangeHeader:
+                # answered with a 400 by starlette
+                pass
+
+        self._zero_copy = _ZERO_COPY_EXTENSION in scope.get("extensions", {})
+        await super().__call__(scope, receive, send)
+
+    async def _send_file(self, send: Send, offset: int, count: int):
+        with open(self.path, "rb") as file:
+            await send(
+                {
+                    "type": _ZERO_COPY_EXTENSION,
+                    "file": file,
+                    "offset": offset,
+                    "count": count,
+                    "more_body": False,
+                }
+            )
+
+    async def _handle_simple(self, send: Send, send_header_only: bool) -> None:
+        if send_header_only or not self._zero_copy:
+            return await super()._handle_simple(send, send_header_only)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await self._send_file(send, 0, self.stat_result.st_size)
+
+    async def _handle_single_range(
+        self, send: Send, start: int, end: int, file_size: int, send_header_only: bool
+    ) -> None:
+        if send_header_only or not self._zero_copy:
+            return await super()._handle_single_range(send, start, end, file_size, send_header_only)
+        self.headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        self.headers["content-length"] = str(end - start)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        await self._send_file(send, start, end - start)
+
+    async def _handle_multiple_ranges(
+        self,
+        send: Send,
+        ranges: List[Tuple[int, int]],
+        file_size: int,
+        send_header_only: bool,
+    ) -> None:
+        boundary = token_hex(13)
+        content_length, header_generator = self.generate_multipart(
+            ranges, boundary, file_size, self.headers["content-type"]
+        )
+        # starlette sends the boundary in content-range instead of content-type
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(content_length)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        if send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            for start, end in ranges:
+                await send({"type": "http.response.body", "body": header_generator(start, end), "more_body": True})
+                await file.seek(start)
+                while start < end:
+                    chunk = await file.read(min(self.chunk_size, end - start))
+                    start += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b"\n", "more_body": True})
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": f"\n--{boundary}--\n".encode("latin-1"),
+                    "more_body": False,
+                }
+            )
+
+
+def get_task_file(file_path: str) -> Optional[str]:
+    """
+    resolve a path relative to the task directory, None if it is not a file inside it
+    """
+    tasks_dir = os.path.abspath(utils.task_dir())
+    # 任务目录中允许符号链接，只拒绝 .. 跳出目录
+    path = os.path.normpath(os.path.join(tasks_dir, file_path.lstrip("/\\")))
+    if os.path.commonpath([tasks_dir, path]) != tasks_dir or not os.path.isfile(path):
+        return None
+    return path
@@ -1,18 +1,36 @@
 import threading
 from typing import Any, Callable, Dict
 
+from app.models import const
+
 
 class TaskManager:
-    def __init__(self, max_concurrent_tasks: int):
+    def __init__(self, max_concurrent_tasks: int, worker_pool=None):
         self.max_concurrent_tasks = max_concurrent_tasks
         self.current_tasks = 0
         self.lock = threading.Lock()
         self.queue = self.create_queue()
+        # tasks run in threads of this process without a worker pool
+        self.worker_pool = worker_pool
 
     def create_queue(self):
         raise NotImplementedError()
 
-    def add_task(self, func: Callable, *args: Any, **kwargs: Any):
+    def add_task(
+        self,
+        func: Callable,
+        *args: Any,
+        priority: str = const.TASK_PRIORITY_NORMAL,
+        tenant: str = const.TASK_TENANT_DEFAULT,
+        **kwargs: Any,
+    ):
+        """
+        run the task now if there is a free slot, otherwise queue it with its priority and tenant
+        """
+        if priority not in const.TASK_PRIORITIES:
+            raise ValueError(
+                f"invalid priority: {priority}, must be one of {', '.join(const.TASK_PRIORITIES)}"
+            )
         with self.lock:
             if self.current_tasks < self.max_concurrent_tasks:
                 print(f"add task: {func.__name__}, current_tasks: {self.current_tasks}")
@@ -21,9 +39,26 @@ class TaskManager:
                 print(
                     f"enqueue task: {func.__name__}, current_tasks: {self.current_tasks}"
                 )
-                self.enqueue({"func": func, "args": args, "kwargs": kwargs})
+                self.enqueue(
+                    {
+                        "func": func,
+                        "args": args,
+                        "kwargs": kwargs,
+                        "priority": priority,
+                        "tenant": tenant,
+                    }
+                )
 
     def execute_task(self, func: Callable, *args: Any, **kwargs: Any):
+        if self.worker_pool:
+            # called with the lock held
+            self.current_tasks += 1
+            try:
+                self.worker_pool.submit(func, *args, on_done=self.task_done, **kwargs)
+            except Exception:
+                self.current_tasks -= 1
+                raise
+            return
         thread = threading.Thread(
             target=self.run_task, args=(func, *args), kwargs=kwargs
         )
@@ -44,6 +79,9 @@ class TaskManager:
                 and not self.is_queue_empty()
             ):
                 task_info = self.dequeue()
+                if not task_info:
+                    # taken by another node in the meantime
+                    return
                 func = task_info["func"]
                 args = task_info.get("args", ())
                 kwargs = task_info.get("kwargs", {})
@@ -62,3 +100,9 @@ class TaskManager:
 
     def is_queue_empty(self):
         raise NotImplementedError()
+
+    def get_queue_stats(self) -> Dict:
+        """
+        queue depth and wait time per priority
+        """
+        raise NotImplementedError()
@@ -0,0 +1,360 @@
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+from app.config import config
+from app.models import const
+
+
+def get_tenant_weight(tenant: str) -> int:
+    """
+    number of tasks a tenant takes in a row before the next tenant of the same priority gets its turn
+    """
+    weights = config.app.get("tenant_weights", {}) or {}
+    try:
+        return max(1, int(weights.get(tenant, 1)))
+    except (TypeError, ValueError):
+        return 1
+
+
+def stamp_task(task: Dict) -> Dict:
+    """
+    add the priority, tenant and enqueue time to a task that is about to be queued
+    """
+    priority = task.get("priority") or const.TASK_PRIORITY_NORMAL
+    if priority not in const.TASK_PRIORITIES:
+        raise ValueError(
+            f"invalid priority: {priority}, must be one of {', '.join(const.TASK_PRIORITIES)}"
+        )
+    task["priority"] = priority
+    task["tenant"] = task.get("tenant") or const.TASK_TENANT_DEFAULT
+    task["enqueued_at"] = time.time()
+    return task
+
+
+def _priority_stats(depth: int, tenants: int, oldest: float, dequeued: int, total_wait: float) -> Dict:
+    return {
+        "depth": depth,
+        "tenants": tenants,
+        # 队列中最早的任务已等待的时间
+        "oldest_wait": round(time.time() - oldest, 3) if oldest else 0,
+        "dequeued": dequeued,
+        "avg_wait": round(total_wait / dequeued, 3) if dequeued else 0,
+    }
+
+
+class FairQueue:
+    """
+    one queue per priority, a higher priority is always served first.
+    inside a priority every tenant has its own sub-queue and the tenants take turns (weighted round-robin),
+    so a bulk batch of one tenant does not hold back the tasks of the others
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # tenant -> tasks, the tenant at the head has the turn
+        self._tenants = {p: OrderedDict() for p in const.TASK_PRIORITIES}
+        # tasks the tenant at the head took in its current turn
+        self._turns = {p: {} for p in const.TASK_PRIORITIES}
+        self._stats = {p: {"dequeued": 0, "total_wait": 0.0} for p in const.TASK_PRIORITIES}
+
+    def put(self, task: Dict):
+        task = stamp_task(task)
+        with self._lock:
+            self._tenants[task["priority"]].setdefault(task["tenant"], deque()).append(task)
+
+    def get(self) -> Optional[Dict]:
+        with self._lock:
+            for priority in const.TASK_PRIORITIES:
+                tenants = self._tenants[priority]
+                if not tenants:
+                    continue
+                tenant, tasks = next(iter(tenants.items()))
+                task = tasks.popleft()
+                turns = self._turns[priority].pop(tenant, 0) + 1
+                if not tasks:
+                    del tenants[tenant]
+                elif turns >= get_tenant_weight(tenant):
+                    tenants.move_to_end(tenant)
+                else:
+                    self._turns[priority][tenant] = turns
+                stats = self._stats[priority]
+                stats["dequeued"] += 1
+                stats["total_wait"] += time.time() - task["enqueued_at"]
+                return task
+        return None
+
+    def empty(self) -> bool:
+        with self._lock:
+            return not any(self._tenants.values())
+
+    def stats(self) -> Dict:
+        with self._lock:
+            result = {}
+            for priority in const.TASK_PRIORITIES:
+                tenants = self._tenants[priority]
+                result[priority] = _priority_stats(
+                    depth=sum(len(tasks) for tasks in tenants.values()),
+                    tenants=len(tenants),
+                    oldest=min((tasks[0]["enqueued_at"] for tasks in tenants.values()), default=0),
+                    **self._stats[priority],
+                )
+            return result
+
+
+# redis 中的键 (q 为队列名，带有 hash tag，所有键在 Redis Cluster 的同一个槽中):
+#   {q}:{priority}:tenants         有排队任务的租户，头部的租户轮到出队
+#   {q}:{priority}:tenant:{tenant} 租户的任务
+#   {q}:{priority}:turns           头部租户本轮已出队的任务数
+#   {q}:weights                    租户的权重
+#   {q}:signal                     唤醒等待中的工作节点
+#   {q}:processing:{worker}        工作节点正在运行的任务
+# every key a script touches is passed in KEYS
+_PUSH = """
+local function push(tenant_queue, ring, item, tenant)
+    if redis.call('RPUSH', tenant_queue, item) == 1 then
+        redis.call('RPUSH', ring, tenant)
+    end
+end
+local function signal(key)
+    redis.call('LPUSH', key, 1)
+    redis.call('LTRIM', key, 0, 99)
+end
+"""
+
+# KEYS: tenant queue, tenants, weights, signal
+# ARGV: task, tenant, weight
+_ENQUEUE_SCRIPT = (
+    _PUSH
+    + """
+push(KEYS[1], KEYS[2], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[2], ARGV[3])
+signal(KEYS[4])
+"""
+)
+
+# KEYS: tenants, turns, weights, tenant queue of the tenant at the head, processing list
+# ARGV: tenant at the head, 1 to move the task to the processing list
+# returns false if the head changed in the meantime
+_DEQUEUE_SCRIPT = """
+local tenant = ARGV[1]
+if redis.call('LINDEX', KEYS[1], 0) ~= tenant then
+    return false
+end
+local item = redis.call('LPOP', KEYS[4])
+if item and redis.call('LLEN', KEYS[4]) > 0 then
+    local weight = tonumber(redis.call('HGET', KEYS[3], tenant)) or 1
+    if redis.call('HINCRBY', KEYS[2], tenant, 1) >= weight then
+        redis.call('RPUSH', KEYS[1], redis.call('LPOP', KEYS[1]))
+        redis.call('HDEL', KEYS[2], tenant)
+    end
+else
+    redis.call('LPOP', KEYS[1])
+    redis.call('HDEL', KEYS[2], tenant)
+end
+if item and ARGV[2] == '1' then
+    redis.call('LPUSH', KEYS[5], item)
+end
+return item
+"""
+
+# KEYS: processing list, signal, then for every task: tenant queue, tenants
+# ARGV: for every task: the task as it is in the processing list, the task to queue ('' to drop it), tenant
+# 只移动仍在处理列表中的任务，同时回收同一个节点的多个工作节点不会重复入队
+_REQUEUE_SCRIPT = (
+    _PUSH
+    + """
+local removed = {}
+local count = 0
+for i = 1, #ARGV / 3 do
+    local found = redis.call('LREM', KEYS[1], 1, ARGV[i * 3 - 2])
+    if found > 0 and ARGV[i * 3 - 1] ~= '' then
+        push(KEYS[i * 2 + 1], KEYS[i * 2 + 2], ARGV[i * 3 - 1], ARGV[i * 3])
+        count = count + 1
+    end
+    table.insert(removed, found)
+end
+if count > 0 then
+    signal(KEYS[2])
+end
+return removed
+"""
+)
+
+# 出队时租户可能被其他节点改变，重试的次数
+_DEQUEUE_RETRIES = 10
+
+
+class RedisFairQueue:
+    """
+    the FairQueue kept in redis and shared by all the nodes, every queue operation is a single lua script.
+    the tasks are json strings that went through stamp_task.
+    name should carry a hash tag ({...}) so all the keys of the queue are in one slot of a Redis Cluster
+    """
+
+    def __init__(self, redis_client: redis.Redis, name: str):
+        self.redis = redis_client
+        self.name = name
+        self._enqueue = redis_client.register_script(_ENQUEUE_SCRIPT)
+        self._dequeue = redis_client.register_script(_DEQUEUE_SCRIPT)
+        self._requeue = redis_client.register_script(_REQUEUE_SCRIPT)
+
+    def _tenants_key(self, priority: str) -> str:
+        return f"{self.name}:{priority}:tenants"
+
+    def _tenant_key(self, priority: str, tenant: str) -> str:
+        return f"{self.name}:{priority}:tenant:{tenant}"
+
+    def _turns_key(self, priority: str) -> str:
+        return f"{self.name}:{priority}:turns"
+
+    def _weights_key(self) -> str:
+        return f"{self.name}:weights"
+
+    def _signal_key(self) -> str:
+        return f"{self.name}:signal"
+
+    def _stats_key(self, priority: str) -> str:
+        return f"{self.name}:stats:{priority}"
+
+    def processing_key(self, worker_id: str) -> str:
+        return f"{self.name}:processing:{worker_id}"
+
+    def put(self, task_json: str, priority: str, tenant: str):
+        self._enqueue(
+            keys=[
+                self._tenant_key(priority, tenant),
+                self._tenants_key(priority),
+                self._weights_key(),
+                self._signal_key(),
+            ],
+            args=[task_json, tenant, get_tenant_weight(tenant)],
+        )
+
+    def _head(self) -> Optional[Tuple[str, str]]:
+        """
+        the priority and tenant whose turn it is
+        """
+        pipe = self.redis.pipeline()
+        for priority in const.TASK_PRIORITIES:
+            pipe.lindex(self._tenants_key(priority), 0)
+        for priority, tenant in zip(const.TASK_PRIORITIES, pipe.execute()):
+            if tenant:
+                return priority, tenant.decode("utf-8")
+        return None
+
+    def get(self, processing_key: str = "") -> Optional[bytes]:
+        """
+        take the next task, it is moved to processing_key (see processing_key()) in the same step when given
+        """
+        for _ in range(_DEQUEUE_RETRIES):
+            head = self._head()
+            if not head:
+                return None
+            priority, tenant = head
+            task_json = self._dequeue(
+                keys=[
+                    self._tenants_key(priority),
+                    self._turns_key(priority),
+                    self._weights_key(),
+                    self._tenant_key(priority, tenant),
+                    processing_key or self.processing_key(""),
+                ],
+                args=[tenant, 1 if processing_key else 0],
+            )
+            if task_json:
+                break
+        else:
+            return None
+        enqueued_at = json.loads(task_json).get("enqueued_at")
+        if enqueued_at:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self._stats_key(priority), "dequeued", 1)
+            pipe.hincrbyfloat(self._stats_key(priority), "total_wait", time.time() - enqueued_at)
+            pipe.execute()
+        return task_json
+
+    def requeue(self, processing_key: str, max_attempts: int = 0) -> Tuple[int, List[Dict]]:
+        """
+        put the tasks of a processing list back on their queues, every task counts its attempts.
+        a task that has had max_attempts attempts (0 for no limit) is dropped instead,
+        returns the number of tasks queued again and the dropped tasks
+        """
+        items = self.redis.lrange(processing_key, 0, -1)
+        if not items:
+            return 0, []
+        keys = [processing_key, self._signal_key()]
+        args = []
+        tasks = []
+        # 处理列表的头部是最新的任务，最早的任务先重新入队
+        for item in reversed(items):
+            task = json.loads(item)
+            task["attempts"] = task.get("attempts", 0) + 1
+            dropped = bool(max_attempts) and task["attempts"] >= max_attempts
+            priority = task.get("priority") or const.TASK_PRIORITY_NORMAL
+            tenant = task.get("tenant") or const.TASK_TENANT_DEFAULT
+            keys += [self._tenant_key(priority, tenant), self._tenants_key(priority)]
+            args += [item, "" if dropped else json.dumps(task), tenant]
+            tasks.append((task, dropped))
+
+        requeued, dropped_tasks = 0, []
+        # 已被其他工作节点移走的任务不计入
+        for (task, dropped), found in zip(tasks, self._requeue(keys=keys, args=args)):
+            if not found:
+                continue
+            if dropped:
+                dropped_tasks.append(task)
+            else:
+                requeued += 1
+        return requeued, dropped_tasks
+
+    def wait(self, timeout: int):
+        """
+        block until a task may have been queued or the timeout passed
+        """
+        self.redis.blpop(self._signal_key(), timeout=timeout)
+
+    def empty(self) -> bool:
+        pipe = self.redis.pipeline()
+        for priority in const.TASK_PRIORITIES:
+            pipe.llen(self._tenants_key(priority))
+        return not any(pipe.execute())
+
+    def stats(self) -> Dict:
+        pipe = self.redis.pipeline()
+        for priority in const.TASK_PRIORITIES:
+            pipe.lrange(self._tenants_key(priority), 0, -1)
+            pipe.hgetall(self._stats_key(priority))
+        results = pipe.execute()
+
+        tenants = {}
+        pipe = self.redis.pipeline()
+        for i, priority in enumerate(const.TASK_PRIORITIES):
+            tenants[priority] = [t.decode("utf-8") for t in results[i * 2]]
+            for tenant in tenants[priority]:
+                pipe.llen(self._tenant_key(priority, tenant))
+                pipe.lindex(self._tenant_key(priority, tenant), 0)
+        queues = iter(pipe.execute())
+
+        result = {}
+        for i, priority in enumerate(const.TASK_PRIORITIES):
+            depth, oldest = 0, 0
+            for _ in tenants[priority]:
+                depth += next(queues)
+                head = next(queues)
+                if head:
+                    enqueued_at = json.loads(head).get("enqueued_at", 0)
+                    oldest = min(oldest, enqueued_at) if oldest else enqueued_at
+            stats = results[i * 2 + 1]
+            result[priority] = _priority_stats(
+                depth=depth,
+                tenants=len(tenants[priority]),
+                oldest=oldest,
+                dequeued=int(stats.get(b"dequeued", 0)),
+                total_wait=float(stats.get(b"total_wait", 0)),
+            )
+        return result
@@ -1,12 +1,12 @@
-from queue import Queue
 from typing import Dict
 
 from app.controllers.manager.base_manager import TaskManager
+from app.controllers.manager.fair_queue import FairQueue
 
 
 class InMemoryTaskManager(TaskManager):
     def create_queue(self):
-        return Queue()
+        return FairQueue()
 
     def enqueue(self, task: Dict):
         self.queue.put(task)
@@ -16,3 +16,6 @@ class InMemoryTaskManager(TaskManager):
 
     def is_queue_empty(self):
         return self.queue.empty()
+
+    def get_queue_stats(self) -> Dict:
+        return self.queue.stats()
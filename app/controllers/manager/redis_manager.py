@@ -2,8 +2,11 @@ import json
 from typing import Dict
 
 import redis
+from loguru import logger
 
+from app.config import config
 from app.controllers.manager.base_manager import TaskManager
+from app.controllers.manager.fair_queue import RedisFairQueue, stamp_task
 from app.models.schema import VideoParams
 from app.services import task as tm
 
@@ -13,44 +16,85 @@ FUNC_MAP = {
 }
 
 
+def get_queue_name() -> str:
+    # hash tag，队列的所有键在 Redis Cluster 的同一个槽中
+    return f"{{{config.app.get('redis_key_prefix', 'mpt')}}}:task_queue"
+
+
+# 旧版本的任务队列，一个不分优先级的列表
+_LEGACY_QUEUE_NAME = "task_queue"
+
+
+def migrate_legacy_queue(redis_client: redis.Redis, queue: RedisFairQueue) -> int:
+    """
+    move the tasks left on the queue of an older version to queue, returns the number of tasks
+    """
+    migrated = 0
+    while task_json := redis_client.lpop(_LEGACY_QUEUE_NAME):
+        task = stamp_task(json.loads(task_json))
+        queue.put(json.dumps(task), task["priority"], task["tenant"])
+        migrated += 1
+    if migrated:
+        logger.info(f"moved {migrated} tasks from {_LEGACY_QUEUE_NAME} to {queue.name}")
+    return migrated
+
+
+def serialize_task(task: Dict) -> str:
+    task_with_serializable_params = task.copy()
+    task_with_serializable_params["kwargs"] = dict(task["kwargs"])
+
+    if "params" in task["kwargs"] and isinstance(
+        task["kwargs"]["params"], VideoParams
+    ):
+        task_with_serializable_params["kwargs"]["params"] = task["kwargs"][
+            "params"
+        ].model_dump(mode="json", warnings=False)
+
+    # 将函数对象转换为其名称
+    task_with_serializable_params["func"] = task["func"].__name__
+    return json.dumps(task_with_serializable_params)
+
+
+def deserialize_task(task_json) -> Dict:
+    task_info = json.loads(task_json)
+    # 将函数名称转换回函数对象
+    task_info["func"] = FUNC_MAP[task_info["func"]]
+
+    if "params" in task_info["kwargs"] and isinstance(
+        task_info["kwargs"]["params"], dict
+    ):
+        task_info["kwargs"]["params"] = VideoParams(**task_info["kwargs"]["params"])
+
+    return task_info
+
+
 class RedisTaskManager(TaskManager):
-    def __init__(self, max_concurrent_tasks: int, redis_url: str):
+    """
+    tasks are queued per priority and tenant (see RedisFairQueue) and taken by this process once a local task
+    finishes or by the worker daemons (python -m app.worker) on any machine
+    """
+
+    def __init__(self, max_concurrent_tasks: int, redis_url: str, worker_pool=None):
         self.redis_client = redis.Redis.from_url(redis_url)
-        super().__init__(max_concurrent_tasks)
+        super().__init__(max_concurrent_tasks, worker_pool=worker_pool)
 
     def create_queue(self):
-        return "task_queue"
+        queue = RedisFairQueue(self.redis_client, get_queue_name())
+        migrate_legacy_queue(self.redis_client, queue)
+        return queue
 
     def enqueue(self, task: Dict):
-        task_with_serializable_params = task.copy()
-
-        if "params" in task["kwargs"] and isinstance(
-            task["kwargs"]["params"], VideoParams
-        ):
-            task_with_serializable_params["kwargs"]["params"] = task["kwargs"][
-                "params"
-            ].dict()
-
-        # 将函数对象转换为其名称
-        task_with_serializable_params["func"] = task["func"].__name__
-        self.redis_client.rpush(self.queue, json.dumps(task_with_serializable_params))
+        task = stamp_task(task)
+        self.queue.put(serialize_task(task), task["priority"], task["tenant"])
 
     def dequeue(self):
-        task_json = self.redis_client.lpop(self.queue)
+        task_json = self.queue.get()
         if task_json:
-            task_info = json.loads(task_json)
-            # 将函数名称转换回函数对象
-            task_info["func"] = FUNC_MAP[task_info["func"]]
-
-            if "params" in task_info["kwargs"] and isinstance(
-                task_info["kwargs"]["params"], dict
-            ):
-                task_info["kwargs"]["params"] = VideoParams(
-                    **task_info["kwargs"]["params"]
-                )
-
-            return task_info
+            return deserialize_task(task_json)
         return None
 
     def is_queue_empty(self):
-        return self.redis_client.llen(self.queue) == 0
+        return self.queue.empty()
+
+    def get_queue_stats(self) -> Dict:
+        return self.queue.stats()
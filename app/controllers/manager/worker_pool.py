@@ -0,0 +1,192 @@
+import atexit
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from loguru import logger
+
+from app.models import const
+from app.services import state as sm
+
+
+def _init_worker(state_queue, memory_limit: int):
+    if memory_limit:
+        try:
+            import resource
+
+            limit = memory_limit * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            # not supported on windows
+            logger.warning(f"failed to limit the memory of the worker: {str(e)}")
+    if state_queue is not None:
+        sm.state = sm.ForwardingState(state_queue)
+
+
+def _worker_main(conn, state_queue, memory_limit: int):
+    """
+    run the tasks received on conn one at a time until None or the pool is gone
+    """
+    _init_worker(state_queue, memory_limit)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        func, args, kwargs = message
+        try:
+            func(*args, **kwargs)
+            conn.send(None)
+        except Exception as e:
+            # the exception itself may not be picklable
+            conn.send(f"{type(e).__name__}: {str(e)}")
+
+
+class WorkerDiedError(RuntimeError):
+    pass
+
+
+class WorkerPool:
+    """
+    runs tasks in worker processes, so rendering does not compete with the api for the GIL.
+    every worker has its own supervisor thread and pipe, a crashing render only fails its own task
+    and only its worker is replaced, the tasks running on the other workers are not affected.
+    a worker is replaced after max_tasks_per_child tasks, memory_limit (MB) caps its address space.
+    with the in-memory state the workers send their updates back to this process
+    """
+
+    def __init__(self, max_workers: int, max_tasks_per_child: int = 10, memory_limit: int = 0):
+        self.max_workers = max_workers
+        self.max_tasks_per_child = max_tasks_per_child or 0
+        self.memory_limit = memory_limit
+        self._context = multiprocessing.get_context("spawn")
+        self._tasks = queue.Queue()
+        self._shutdown = False
+        self._lock = threading.Lock()
+        self._state_queue = None
+        if isinstance(sm.state, sm.MemoryState):
+            self._state_queue = self._context.Queue()
+            threading.Thread(target=self._apply_state_updates, daemon=True).start()
+        self._supervisors = [
+            threading.Thread(target=self._supervise, daemon=True) for _ in range(max_workers)
+        ]
+        for supervisor in self._supervisors:
+            supervisor.start()
+        # 解释器退出时先让空闲的工作进程退出，否则 multiprocessing 会一直等待它们
+        atexit.register(self.shutdown, wait=False)
+
+    def _apply_state_updates(self):
+        while True:
+            task_id, state, progress, kwargs = self._state_queue.get()
+            try:
+                sm.state.update_task(task_id, state=state, progress=progress, **kwargs)
+            except Exception as e:
+                logger.error(f"failed to update the state of task {task_id}: {str(e)}")
+
+    def _start_worker(self):
+        conn, child_conn = self._context.Pipe()
+        # not a daemon, the tasks start process pools of their own
+        process = self._context.Process(
+            target=_worker_main, args=(child_conn, self._state_queue, self.memory_limit)
+        )
+        process.start()
+        # 子进程退出后 recv 才能收到 EOFError
+        child_conn.close()
+        return process, conn
+
+    @staticmethod
+    def _stop_worker(process, conn):
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        conn.close()
+        process.join()
+
+    def _supervise(self):
+        process, conn, tasks_run = None, None, 0
+        while True:
+            item = self._tasks.get()
+            if item is None:
+                break
+            func, args, kwargs, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if process is None:
+                process, conn = self._start_worker()
+            try:
+                conn.send((func, args, kwargs))
+                error = conn.recv()
+            except (EOFError, OSError):
+                process.join()
+                future.set_exception(
+                    WorkerDiedError(f"worker process died with exit code {process.exitcode}")
+                )
+                process, conn, tasks_run = None, None, 0
+                continue
+            except Exception as e:
+                # the task could not be sent to the worker
+                future.set_exception(e)
+                continue
+
+            if error:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(None)
+            tasks_run += 1
+            if self.max_tasks_per_child and tasks_run >= self.max_tasks_per_child:
+                # release leaked memory
+                self._stop_worker(process, conn)
+                process, conn, tasks_run = None, None, 0
+        if process is not None:
+            self._stop_worker(process, conn)
+
+    def submit(self, func: Callable, *args: Any, on_done: Callable[[], None] = None, **kwargs: Any) -> Future:
+        """
+        run func(*args, **kwargs) in a worker, on_done is called once it has finished or failed.
+        a task that failed or whose worker died is marked as failed
+        """
+        task_id = kwargs.get("task_id", "")
+
+        def _done(future: Future):
+            try:
+                future.result()
+            except WorkerDiedError as e:
+                logger.error(f"worker process of task {task_id} died: {str(e)}")
+                if task_id:
+                    sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+            except Exception as e:
+                logger.error(f"task {task_id} failed: {str(e)}")
+                if task_id:
+                    sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+            finally:
+                if on_done:
+                    on_done()
+
+        future = Future()
+        # 在入队前注册，否则任务很快结束时回调会在调用方线程中执行，
+        # 而调用方持有 TaskManager.lock，on_done 再取这把锁就会死锁
+        future.add_done_callback(_done)
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("the worker pool is shut down")
+            self._tasks.put((func, args, kwargs, future))
+        return future
+
+    def shutdown(self, wait: bool = True):
+        """
+        stop the workers once the queued tasks are done
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            for _ in self._supervisors:
+                self._tasks.put(None)
+        if wait:
+            for supervisor in self._supervisors:
+                supervisor.join()
@@ -20,11 +20,12 @@ router = new_router()
     response_model=VideoScriptResponse,
     summary="Create a script for the video",
 )
-def generate_video_script(request: Request, body: VideoScriptRequest):
-    video_script = llm.generate_script(
+async def generate_video_script(request: Request, body: VideoScriptRequest):
+    video_script = await llm.agenerate_script(
         video_subject=body.video_subject,
         language=body.video_language,
         paragraph_number=body.paragraph_number,
+        use_cache=body.use_llm_cache,
     )
     response = {"video_script": video_script}
     return utils.get_response(200, response)
@@ -35,11 +36,28 @@ def generate_video_script(request: Request, body: VideoScriptRequest):
     response_model=VideoTermsResponse,
     summary="Generate video terms based on the video script",
 )
-def generate_video_terms(request: Request, body: VideoTermsRequest):
-    video_terms = llm.generate_terms(
+async def generate_video_terms(request: Request, body: VideoTermsRequest):
+    video_terms = await llm.agenerate_terms(
         video_subject=body.video_subject,
         video_script=body.video_script,
         amount=body.amount,
+        use_cache=body.use_llm_cache,
     )
     response = {"video_terms": video_terms}
     return utils.get_response(200, response)
+
+
+@router.get(
+    "/llm_cache",
+    summary="Retrieve the hit rate of the llm response cache and the calls it saved",
+)
+def get_llm_cache_stats(request: Request):
+    return utils.get_response(200, llm.get_llm_cache_stats())
+
+
+@router.get(
+    "/llm_providers",
+    summary="Retrieve the latency and error rate of the llm providers requests are routed to",
+)
+def get_llm_provider_stats(request: Request):
+    return utils.get_response(200, llm.get_llm_provider_stats())
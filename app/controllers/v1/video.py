@@ -1,24 +1,40 @@
+import asyncio
 import glob
+import json
 import os
 import pathlib
 import shutil
+import threading
 from typing import Union
 
-from fastapi import BackgroundTasks, Depends, Path, Request, UploadFile
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    Path,
+    Request,
+    UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
 from fastapi.params import File
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import StreamingResponse
 from loguru import logger
 
 from app.config import config
 from app.controllers import base
+from app.controllers.file_response import TaskFileResponse, get_task_file
 from app.controllers.manager.memory_manager import InMemoryTaskManager
 from app.controllers.manager.redis_manager import RedisTaskManager
+from app.controllers.manager.worker_pool import WorkerPool
 from app.controllers.v1.base import new_router
+from app.models import const
 from app.models.exception import HttpException
 from app.models.schema import (
     AudioRequest,
     BgmRetrieveResponse,
     BgmUploadResponse,
+    MaterialUploadResponse,
     SubtitleRequest,
     TaskDeletionResponse,
     TaskQueryRequest,
@@ -28,6 +44,7 @@ from app.models.schema import (
 )
 from app.services import state as sm
 from app.services import task as tm
+from app.services import upload, video
 from app.utils import utils
 
 # 认证依赖项
@@ -40,15 +57,33 @@ _redis_port = config.app.get("redis_port", 6379)
 _redis_db = config.app.get("redis_db", 0)
 _redis_password = config.app.get("redis_password", None)
 _max_concurrent_tasks = config.app.get("max_concurrent_tasks", 5)
+_task_executor = config.app.get("task_executor", "thread")
+_resume_lock = threading.Lock()
+
+# 任务在独立的工作进程中运行，与 api 进程隔离
+worker_pool = None
+if _task_executor == "process":
+    worker_pool = WorkerPool(
+        max_workers=_max_concurrent_tasks,
+        max_tasks_per_child=config.app.get("task_worker_max_tasks", 10),
+        memory_limit=config.app.get("task_worker_memory_limit", 0),
+    )
 
 redis_url = f"redis://:{_redis_password}@{_redis_host}:{_redis_port}/{_redis_db}"
 # 根据配置选择合适的任务管理器
 if _enable_redis:
     task_manager = RedisTaskManager(
-        max_concurrent_tasks=_max_concurrent_tasks, redis_url=redis_url
+        # 任务全部交给工作节点 (python -m app.worker) 运行，api 只负责入队
+        max_concurrent_tasks=0 if _task_executor == "worker" else _max_concurrent_tasks,
+        redis_url=redis_url,
+        worker_pool=worker_pool,
     )
 else:
-    task_manager = InMemoryTaskManager(max_concurrent_tasks=_max_concurrent_tasks)
+    if _task_executor == "worker":
+        logger.warning("task_executor = worker needs redis, running the tasks in this process")
+    task_manager = InMemoryTaskManager(
+        max_concurrent_tasks=_max_concurrent_tasks, worker_pool=worker_pool
+    )
 
 
 @router.post("/videos", response_model=TaskResponse, summary="Generate a short video")
@@ -86,7 +121,14 @@ def create_task(
             "params": body.model_dump(),
         }
         sm.state.update_task(task_id)
-        task_manager.add_task(tm.start, task_id=task_id, params=body, stop_at=stop_at)
+        task_manager.add_task(
+            tm.start,
+            task_id=task_id,
+            params=body,
+            stop_at=stop_at,
+            priority=getattr(body, "priority", const.TASK_PRIORITY_NORMAL),
+            tenant=base.get_tenant_id(request),
+        )
         logger.success(f"Task created: {utils.to_json(task)}")
         return utils.get_response(200, task)
     except ValueError as e:
@@ -94,6 +136,51 @@ def create_task(
             task_id=task_id, status_code=400, message=f"{request_id}: {str(e)}"
         )
 
+
+@router.post(
+    "/tasks/{task_id}/resume",
+    response_model=TaskResponse,
+    summary="Run a task again, reusing the outputs of the stages whose inputs are unchanged",
+)
+def resume_task(request: Request, task_id: str = Path(..., description="Task ID")):
+    request_id = base.get_task_id(request)
+    params, stop_at, priority = tm.load_task_params(task_id)
+    if not params:
+        raise HttpException(
+            task_id=task_id,
+            status_code=404,
+            message=f"{request_id}: task manifest not found",
+        )
+
+    task = {
+        "task_id": task_id,
+        "request_id": request_id,
+        "params": params.model_dump(),
+    }
+    # 检查和标记在同一个锁中，同时到达的两个请求不会把任务运行两次
+    with _resume_lock:
+        current = sm.state.get_task(task_id)
+        if current and current.get("state") not in (
+            const.TASK_STATE_COMPLETE,
+            const.TASK_STATE_FAILED,
+        ):
+            raise HttpException(
+                task_id=task_id,
+                status_code=409,
+                message=f"{request_id}: task is still queued or running",
+            )
+        sm.state.update_task(task_id)
+    task_manager.add_task(
+        tm.start,
+        task_id=task_id,
+        params=params,
+        stop_at=stop_at,
+        priority=priority,
+        tenant=base.get_tenant_id(request),
+    )
+    logger.success(f"Task resumed: {utils.to_json(task)}")
+    return utils.get_response(200, task)
+
 from fastapi import Query
 
 @router.get("/tasks", response_model=TaskQueryResponse, summary="Get all tasks")
@@ -111,6 +198,34 @@ def get_all_tasks(request: Request, page: int = Query(1, ge=1), page_size: int =
 
 
 
+def _get_endpoint(request: Union[Request, WebSocket]) -> str:
+    endpoint = config.app.get("endpoint", "")
+    if not endpoint:
+        base_url = request.base_url
+        if base_url.scheme in ("ws", "wss"):
+            # file urls of a task followed over a websocket are still http urls
+            base_url = base_url.replace(scheme=base_url.scheme.replace("ws", "http"))
+        endpoint = str(base_url)
+    return endpoint.rstrip("/")
+
+
+def _task_with_urls(task: dict, endpoint: str) -> dict:
+    task_dir = utils.task_dir()
+
+    def file_to_uri(file):
+        if not file.startswith(endpoint):
+            _uri_path = file.replace(task_dir, "tasks").replace("\\", "/")
+            _uri_path = f"{endpoint}/{_uri_path}"
+        else:
+            _uri_path = file
+        return _uri_path
+
+    for key in ["videos", "combined_videos"]:
+        if key in task:
+            task[key] = [file_to_uri(v) for v in task[key]]
+    return task
+
+
 @router.get(
     "/tasks/{task_id}", response_model=TaskQueryResponse, summary="Query task status"
 )
@@ -119,43 +234,69 @@ def get_task(
     task_id: str = Path(..., description="Task ID"),
     query: TaskQueryRequest = Depends(),
 ):
-    endpoint = config.app.get("endpoint", "")
-    if not endpoint:
-        endpoint = str(request.base_url)
-    endpoint = endpoint.rstrip("/")
-
     request_id = base.get_task_id(request)
     task = sm.state.get_task(task_id)
     if task:
-        task_dir = utils.task_dir()
-
-        def file_to_uri(file):
-            if not file.startswith(endpoint):
-                _uri_path = v.replace(task_dir, "tasks").replace("\\", "/")
-                _uri_path = f"{endpoint}/{_uri_path}"
-            else:
-                _uri_path = file
-            return _uri_path
-
-        if "videos" in task:
-            videos = task["videos"]
-            urls = []
-            for v in videos:
-                urls.append(file_to_uri(v))
-            task["videos"] = urls
-        if "combined_videos" in task:
-            combined_videos = task["combined_videos"]
-            urls = []
-            for v in combined_videos:
-                urls.append(file_to_uri(v))
-            task["combined_videos"] = urls
-        return utils.get_response(200, task)
+        return utils.get_response(200, _task_with_urls(task, _get_endpoint(request)))
 
     raise HttpException(
         task_id=task_id, status_code=404, message=f"{request_id}: task not found"
     )
 
 
+@router.get(
+    "/tasks/{task_id}/events",
+    summary="Follow the progress of a task with server-sent events",
+)
+async def stream_task_events(
+    request: Request, task_id: str = Path(..., description="Task ID")
+):
+    request_id = base.get_task_id(request)
+    # redis 的读取是阻塞的，不能放在事件循环里
+    if not await asyncio.to_thread(sm.state.get_task, task_id):
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+    endpoint = _get_endpoint(request)
+
+    async def event_stream():
+        async for task in sm.state.subscribe(task_id):
+            if task is None:
+                yield ": keep-alive\n\n"
+                continue
+            data = json.dumps(
+                utils.get_response(200, _task_with_urls(task, endpoint)),
+                ensure_ascii=False,
+                default=str,
+            )
+            yield f"data: {data}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/tasks/{task_id}/ws")
+async def task_progress_websocket(websocket: WebSocket, task_id: str):
+    if not await asyncio.to_thread(sm.state.get_task, task_id):
+        # 握手前关闭，客户端收到 403 而不是一直等待一个不存在的任务
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="task not found")
+        return
+    await websocket.accept()
+    endpoint = _get_endpoint(websocket)
+    try:
+        async for task in sm.state.subscribe(task_id):
+            if task is not None:
+                await websocket.send_json(
+                    utils.get_response(200, _task_with_urls(task, endpoint))
+                )
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
 @router.delete(
     "/tasks/{task_id}",
     response_model=TaskDeletionResponse,
@@ -179,6 +320,26 @@ def delete_video(request: Request, task_id: str = Path(..., description="Task ID
     )
 
 
+@router.get(
+    "/queue",
+    summary="Retrieve the depth and wait time of the task queue per priority",
+)
+def get_queue_stats(request: Request):
+    return utils.get_response(200, task_manager.get_queue_stats())
+
+
+@router.get(
+    "/encode_profiles",
+    summary="Retrieve the encode profiles with their measured encode fps",
+)
+def get_encode_profiles(request: Request):
+    response = {
+        "default": config.app.get("encode_profile", "balanced"),
+        "profiles": video.get_encode_stats(),
+    }
+    return utils.get_response(200, response)
+
+
 @router.get(
     "/musics", response_model=BgmRetrieveResponse, summary="Retrieve local BGM files"
 )
@@ -208,13 +369,12 @@ def upload_bgm_file(request: Request, file: UploadFile = File(...)):
     request_id = base.get_task_id(request)
     # check file ext
     if file.filename.endswith("mp3"):
-        song_dir = utils.song_dir()
-        save_path = os.path.join(song_dir, file.filename)
-        # save file
-        with open(save_path, "wb+") as buffer:
-            # If the file already exists, it will be overwritten
-            file.file.seek(0)
-            buffer.write(file.file.read())
+        try:
+            save_path = upload.save_upload(file.file, utils.song_dir(), file.filename)
+        except upload.UploadTooLargeError as e:
+            raise HttpException("", status_code=413, message=f"{request_id}: {str(e)}")
+        except ValueError as e:
+            raise HttpException("", status_code=400, message=f"{request_id}: {str(e)}")
         response = {"file": save_path}
         return utils.get_response(200, response)
 
@@ -223,65 +383,57 @@ def upload_bgm_file(request: Request, file: UploadFile = File(...)):
     )
 
 
+@router.post(
+    "/materials",
+    response_model=MaterialUploadResponse,
+    summary="Upload a local video or image material",
+)
+def upload_material_file(request: Request, file: UploadFile = File(...)):
+    request_id = base.get_task_id(request)
+    try:
+        material = upload.save_material(file.file, file.filename)
+    except upload.UploadTooLargeError as e:
+        raise HttpException("", status_code=413, message=f"{request_id}: {str(e)}")
+    except ValueError as e:
+        raise HttpException("", status_code=400, message=f"{request_id}: {str(e)}")
+    response = {"provider": material.provider, "url": material.url, "duration": material.duration}
+    return utils.get_response(200, response)
+
+
 @router.get("/stream/{file_path:path}")
 async def stream_video(request: Request, file_path: str):
-    tasks_dir = utils.task_dir()
-    video_path = os.path.join(tasks_dir, file_path)
-    range_header = request.headers.get("Range")
-    video_size = os.path.getsize(video_path)
-    start, end = 0, video_size - 1
-
-    length = video_size
-    if range_header:
-        range_ = range_header.split("bytes=")[1]
-        start, end = [int(part) if part else None for part in range_.split("-")]
-        if start is None:
-            start = video_size - end
-            end = video_size - 1
-        if end is None:
-            end = video_size - 1
-        length = end - start + 1
-
-    def file_iterator(file_path, offset=0, bytes_to_read=None):
-        with open(file_path, "rb") as f:
-            f.seek(offset, os.SEEK_SET)
-            remaining = bytes_to_read or video_size
-            while remaining > 0:
-                bytes_to_read = min(4096, remaining)
-                data = f.read(bytes_to_read)
-                if not data:
-                    break
-                remaining -= len(data)
-                yield data
-
-    response = StreamingResponse(
-        file_iterator(video_path, start, length), media_type="video/mp4"
-    )
-    response.headers["Content-Range"] = f"bytes {start}-{end}/{video_size}"
-    response.headers["Accept-Ranges"] = "bytes"
-    response.headers["Content-Length"] = str(length)
-    response.status_code = 206  # Partial Content
-
-    return response
+    """
+    stream video, with range, if-range and conditional (etag / last-modified) requests
+    :param file_path: video file path, eg: /cd1727ed-3473-42a2-a7da-4faafafec72b/final-1.mp4
+    """
+    request_id = base.get_task_id(request)
+    video_path = get_task_file(file_path)
+    if not video_path:
+        raise HttpException(
+            task_id=request_id, status_code=404, message=f"{request_id}: file not found"
+        )
+    return TaskFileResponse(path=video_path)
 
 
 @router.get("/download/{file_path:path}")
-async def download_video(_: Request, file_path: str):
+async def download_video(request: Request, file_path: str):
     """
     download video
-    :param _: Request request
+    :param request: Request request
     :param file_path: video file path, eg: /cd1727ed-3473-42a2-a7da-4faafafec72b/final-1.mp4
     :return: video file
     """
-    tasks_dir = utils.task_dir()
-    video_path = os.path.join(tasks_dir, file_path)
+    request_id = base.get_task_id(request)
+    video_path = get_task_file(file_path)
+    if not video_path:
+        raise HttpException(
+            task_id=request_id, status_code=404, message=f"{request_id}: file not found"
+        )
     file_path = pathlib.Path(video_path)
     filename = file_path.stem
     extension = file_path.suffix
-    headers = {"Content-Disposition": f"attachment; filename={filename}{extension}"}
-    return FileResponse(
+    return TaskFileResponse(
         path=video_path,
-        headers=headers,
         filename=f"{filename}{extension}",
         media_type=f"video/{extension[1:]}",
     )
@@ -23,3 +23,10 @@ TASK_STATE_PROCESSING = 4
 
 FILE_TYPE_VIDEOS = ["mp4", "mov", "mkv", "webm"]
 FILE_TYPE_IMAGES = ["jpg", "jpeg", "png", "bmp"]
+
+# 排队任务的优先级，从高到低
+TASK_PRIORITY_HIGH = "high"
+TASK_PRIORITY_NORMAL = "normal"
+TASK_PRIORITY_LOW = "low"
+TASK_PRIORITIES = [TASK_PRIORITY_HIGH, TASK_PRIORITY_NORMAL, TASK_PRIORITY_LOW]
+TASK_TENANT_DEFAULT = "default"
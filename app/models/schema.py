@@ -1,6 +1,6 @@
 import warnings
 from enum import Enum
-from typing import Any, List, Optional, Union
+from typing import Any, List, Literal, Optional, Union
 
 import pydantic
 from pydantic import BaseModel
@@ -103,9 +103,17 @@ class VideoParams(BaseModel):
     stroke_width: float = 1.5
     n_threads: Optional[int] = 4  # 增加默认线程数提升性能
     paragraph_number: Optional[int] = 1
+    # 为 false 时不使用缓存的文案和关键词，重新调用大模型生成
+    use_llm_cache: Optional[bool] = True
     
     # 视频生成方法选择
     use_direct_generation: Optional[bool] = True  # 是否使用一步到位生成（默认启用）
+    # 一步到位生成的渲染引擎: moviepy, ffmpeg（ffmpeg 失败时回退到 moviepy）
+    render_engine: Optional[str] = "moviepy"
+    # 字幕渲染方式: image（逐行栅格化后叠加）, ass（转换为 ASS 字幕，在最终编码时由 ffmpeg/libass 烧录）
+    subtitle_renderer: Optional[str] = "image"
+    # 最终编码档位: draft, fast, balanced, archive，为空时使用 config.toml 中的 encode_profile
+    encode_profile: Optional[str] = ""
 
 
 class SubtitleRequest(BaseModel):
@@ -152,6 +160,8 @@ class VideoScriptParams:
     video_subject: Optional[str] = "春天的花海"
     video_language: Optional[str] = ""
     paragraph_number: Optional[int] = 1
+    # 为 false 时不使用缓存的大模型结果，重新生成
+    use_llm_cache: Optional[bool] = True
 
 
 class VideoTermsParams:
@@ -168,6 +178,8 @@ class VideoTermsParams:
         "春天的花海，如诗如画般展现在眼前。万物复苏的季节里，大地披上了一袭绚丽多彩的盛装。金黄的迎春、粉嫩的樱花、洁白的梨花、艳丽的郁金香……"
     )
     amount: Optional[int] = 5
+    # 为 false 时不使用缓存的大模型结果，重新生成
+    use_llm_cache: Optional[bool] = True
 
 
 class BaseResponse(BaseModel):
@@ -177,7 +189,8 @@ class BaseResponse(BaseModel):
 
 
 class TaskVideoRequest(VideoParams, BaseModel):
-    pass
+    # 排队时的优先级: high, normal, low，同一优先级内按租户 (x-tenant-id) 轮流出队
+    priority: Literal["high", "normal", "low"] = "normal"
 
 
 class TaskQueryRequest(BaseModel):
@@ -304,3 +317,18 @@ class BgmUploadResponse(BaseResponse):
                 "data": {"file": "/MoneyPrinterTurbo/resource/songs/example.mp3"},
             },
         }
+
+
+class MaterialUploadResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "provider": "local",
+                    "url": "/MoneyPrinterTurbo/storage/local_videos/example_1b2c3d4e.mp4",
+                    "duration": 12,
+                },
+            },
+        }
@@ -0,0 +1,298 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_hash(file_path: str) -> str:
+    """
+    content hash of a file, memoized by path, size and modification time
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return ""
+
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            return _file_hashes[memo_key]
+
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    with _file_hashes_lock:
+        _file_hashes[memo_key] = digest
+    return digest
+
+
+class FileCache:
+    """
+    a directory of cached files with a size budget, the least recently used files are evicted first.
+    the modification time of a file is used as its last access time.
+    files are copied in and out instead of hard linked, task files are often rewritten in place
+    and that would corrupt a linked cache entry.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key: str, suffix: str = "") -> str:
+        return os.path.join(self.cache_dir, f"{key}{suffix}")
+
+    def get(self, key: str, suffix: str = "") -> str:
+        file = self.path(key, suffix)
+        try:
+            os.utime(file, None)
+        except OSError:
+            return ""
+        return file
+
+    def fetch(self, key: str, dest_file: str, suffix: str = "") -> bool:
+        """
+        copy a cached file to dest_file, returns False on a miss
+        """
+        file = self.get(key, suffix)
+        if not file:
+            return False
+        try:
+            if os.path.exists(dest_file):
+                os.remove(dest_file)
+            shutil.copyfile(file, dest_file)
+            return True
+        except OSError as e:
+            logger.warning(f"failed to fetch cached file: {file} => {str(e)}")
+            return False
+
+    def put(self, key: str, source_file: str, suffix: str = "") -> str:
+        file = self.path(key, suffix)
+        temp_file = f"{file}.{utils.get_uuid(remove_hyphen=True)}.part"
+        try:
+            shutil.copyfile(source_file, temp_file)
+            os.replace(temp_file, file)
+        except OSError as e:
+            logger.warning(f"failed to cache file: {source_file} => {str(e)}")
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+            return ""
+        self.evict()
+        return file
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total_size = 0
+            for entry in os.scandir(self.cache_dir):
+                if not entry.is_file() or entry.name.endswith(".part"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+            if total_size <= self.max_size:
+                return
+
+            entries.sort()
+            for _, size, file in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(file)
+                    total_size -= size
+                    logger.debug(f"evicted cached file: {file}")
+                except OSError:
+                    pass
+
+
+def get_redis_client():
+    """
+    a redis client built from the redis settings in config.toml, None if redis is not enabled
+    """
+    if not config.app.get("enable_redis", False):
+        return None
+    import redis
+
+    return redis.StrictRedis(
+        host=config.app.get("redis_host", "localhost"),
+        port=config.app.get("redis_port", 6379),
+        db=config.app.get("redis_db", 0),
+        password=config.app.get("redis_password", None),
+    )
+
+
+class TTLCache:
+    """
+    an in-process cache of json serializable values that expire after ttl seconds.
+    when a redis client is given the values are also stored in redis, so they are shared by all processes.
+    """
+
+    def __init__(self, name: str, ttl: int, redis_client=None):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._redis = redis_client
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def _redis_key(self, key: str) -> str:
+        # 与任务状态和队列一样在 redis_key_prefix 下，共用 redis 的部署互不影响
+        return f"{config.app.get('redis_key_prefix', 'mpt')}:cache:{self.name}:{key}"
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] > now:
+                self.hits += 1
+                return item[1]
+            self._items.pop(key, None)
+
+        if self._redis is not None:
+            try:
+                data = self._redis.get(self._redis_key(key))
+            except Exception as e:
+                logger.warning(f"failed to read {self.name} cache from redis: {str(e)}")
+                data = None
+            if data is not None:
+                value = json.loads(data)
+                with self._lock:
+                    self._items[key] = (now + self.ttl, value)
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._items[key] = (time.time() + self.ttl, value)
+            # drop the expired items once in a while, the cache is never large
+            if len(self._items) % 100 == 0:
+                now = time.time()
+                for k in [k for k, v in self._items.items() if v[0] <= now]:
+                    del self._items[k]
+
+        if self._redis is not None:
+            try:
+                self._redis.setex(self._redis_key(key), self.ttl, json.dumps(value))
+            except Exception as e:
+                logger.warning(f"failed to write {self.name} cache to redis: {str(e)}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "size": len(self._items),
+            }
+
+
+class PersistentCache:
+    """
+    json serializable values kept in a sqlite file, so they survive restarts and are shared by the
+    processes of a machine. values expire after ttl seconds, the least recently used are evicted
+    once there are more than max_entries. a value can carry metadata, e.g. what producing it cost
+    """
+
+    def __init__(self, db_file: str, ttl: int, max_entries: int):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT, meta TEXT, expires REAL, accessed REAL)"
+        )
+        return conn
+
+    def get(self, key: str):
+        """
+        (value, meta) of a key, None on a miss
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                try:
+                    with conn:
+                        row = conn.execute(
+                            "SELECT value, meta FROM entries WHERE key = ? AND expires > ?",
+                            (key, now),
+                        ).fetchone()
+                        if row:
+                            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+                finally:
+                    conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"failed to read cache {self.db_file}: {str(e)}")
+            return None
+        if not row:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def set(self, key: str, value, meta: dict = None):
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                try:
+                    with conn:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO entries (key, value, meta, expires, accessed) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (key, json.dumps(value), json.dumps(meta or {}), now + self.ttl, now),
+                        )
+                        conn.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+                        conn.execute(
+                            "DELETE FROM entries WHERE key IN "
+                            "(SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                            (self.max_entries,),
+                        )
+                finally:
+                    conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"failed to update cache {self.db_file}: {str(e)}")
+
+    def size(self) -> int:
+        try:
+            with self._lock:
+                conn = self._connect()
+                try:
+                    return conn.execute(
+                        "SELECT COUNT(*) FROM entries WHERE expires > ?", (time.time(),)
+                    ).fetchone()[0]
+                finally:
+                    conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"failed to read cache {self.db_file}: {str(e)}")
+            return 0
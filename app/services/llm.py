@@ -1,299 +1,767 @@
+import asyncio
+import hashlib
 import json
 import logging
+import os
 import re
-import requests
-from typing import List
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Generator, List, Optional
 
 import g4f
+import httpx
 from loguru import logger
-from openai import AzureOpenAI, OpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI
 from openai.types.chat import ChatCompletion
 
 from app.config import config
+from app.services import cache
+from app.utils import utils
 
 _max_retries = 5
 
+# providers with an openai compatible api, called through the openai client
+_openai_providers = ["openai", "moonshot", "ollama", "oneapi", "azure", "deepseek"]
+# providers called with plain http requests
+_http_providers = ["pollinations", "cloudflare", "ernie"]
+# providers only reachable through a blocking sdk, run in a thread by the async interface
+_sdk_providers = ["g4f", "qwen", "gemini"]
 
-def _generate_response(prompt: str) -> str:
+# 连接池，复用 keep-alive 连接
+_pool_limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+_timeout = httpx.Timeout(600, connect=10)
+
+# provider -> settings and provider -> client, rebuilt once the config was changed (config.version)
+_clients_lock = threading.Lock()
+_config_version = None
+_provider_settings: Dict[str, Dict] = {}
+_clients: Dict[str, Any] = {}
+# event loop -> clients, an async connection pool can only be used by the loop it was created on
+_async_clients = weakref.WeakKeyDictionary()
+# (event loop or None, client) replaced at the last config change, closed at the next one
+_retired_clients: List = []
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+_llm_cache_stats = {"hits": 0, "misses": 0, "saved_tokens": 0, "saved_seconds": 0.0}
+
+
+def _check_config_version():
+    global _config_version
+    if _config_version == config.version:
+        return
+    stale = []
+    with _clients_lock:
+        if _config_version != config.version:
+            # 正在进行的请求可能仍持有被替换的客户端，等到下一次配置变更时再关闭，
+            # 那时它们早已空闲
+            stale = _retired_clients[:]
+            _retired_clients[:] = [(None, client) for client in _clients.values()] + [
+                (loop, client)
+                for loop, clients in _async_clients.items()
+                for client in clients.values()
+            ]
+            _provider_settings.clear()
+            _clients.clear()
+            _async_clients.clear()
+            _config_version = config.version
+    for loop, client in stale:
+        _close_client(loop, client)
+
+
+def _close_client(loop, client):
+    """
+    release the connection pool of a client, an async client is closed on the loop it belongs to
+    """
     try:
-        content = ""
-        llm_provider = config.app.get("llm_provider", "openai")
-        logger.info(f"llm provider: {llm_provider}")
-        if llm_provider == "g4f":
-            model_name = config.app.get("g4f_model_name", "")
-            if not model_name:
-                model_name = "gpt-3.5-turbo-16k-0613"
-            content = g4f.ChatCompletion.create(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}],
-            )
-        else:
-            api_version = ""  # for azure
-            if llm_provider == "moonshot":
-                api_key = config.app.get("moonshot_api_key")
-                model_name = config.app.get("moonshot_model_name")
-                base_url = "https://api.moonshot.cn/v1"
-            elif llm_provider == "ollama":
-                # api_key = config.app.get("openai_api_key")
-                api_key = "ollama"  # any string works but you are required to have one
-                model_name = config.app.get("ollama_model_name")
-                base_url = config.app.get("ollama_base_url", "")
-                if not base_url:
-                    base_url = "http://localhost:11434/v1"
-            elif llm_provider == "openai":
-                api_key = config.app.get("openai_api_key")
-                model_name = config.app.get("openai_model_name")
-                base_url = config.app.get("openai_base_url", "")
-                if not base_url:
-                    base_url = "https://api.openai.com/v1"
-            elif llm_provider == "oneapi":
-                api_key = config.app.get("oneapi_api_key")
-                model_name = config.app.get("oneapi_model_name")
-                base_url = config.app.get("oneapi_base_url", "")
-            elif llm_provider == "azure":
-                api_key = config.app.get("azure_api_key")
-                model_name = config.app.get("azure_model_name")
-                base_url = config.app.get("azure_base_url", "")
-                api_version = config.app.get("azure_api_version", "2024-02-15-preview")
-            elif llm_provider == "gemini":
-                api_key = config.app.get("gemini_api_key")
-                model_name = config.app.get("gemini_model_name")
-                base_url = "***"
-            elif llm_provider == "qwen":
-                api_key = config.app.get("qwen_api_key")
-                model_name = config.app.get("qwen_model_name")
-                base_url = "***"
-            elif llm_provider == "cloudflare":
-                api_key = config.app.get("cloudflare_api_key")
-                model_name = config.app.get("cloudflare_model_name")
-                account_id = config.app.get("cloudflare_account_id")
-                base_url = "***"
-            elif llm_provider == "deepseek":
-                api_key = config.app.get("deepseek_api_key")
-                model_name = config.app.get("deepseek_model_name")
-                base_url = config.app.get("deepseek_base_url")
-                if not base_url:
-                    base_url = "https://api.deepseek.com"
-            elif llm_provider == "ernie":
-                api_key = config.app.get("ernie_api_key")
-                secret_key = config.app.get("ernie_secret_key")
-                base_url = config.app.get("ernie_base_url")
-                model_name = "***"
-                if not secret_key:
-                    raise ValueError(
-                        f"{llm_provider}: secret_key is not set, please set it in the config.toml file."
-                    )
-            elif llm_provider == "pollinations":
-                try:
-                    base_url = config.app.get("pollinations_base_url", "")
-                    if not base_url:
-                        base_url = "https://text.pollinations.ai/openai"
-                    model_name = config.app.get("pollinations_model_name", "openai-fast")
-                   
-                    # Prepare the payload
-                    payload = {
-                        "model": model_name,
-                        "messages": [
-                            {"role": "user", "content": prompt}
-                        ],
-                        "seed": 101  # Optional but helps with reproducibility
-                    }
-                    
-                    # Optional parameters if configured
-                    if config.app.get("pollinations_private"):
-                        payload["private"] = True
-                    if config.app.get("pollinations_referrer"):
-                        payload["referrer"] = config.app.get("pollinations_referrer")
-                    
-                    headers = {
-                        "Content-Type": "application/json"
-                    }
-                    
-                    # Make the API request
-                    response = requests.post(base_url, headers=headers, json=payload)
-                    response.raise_for_status()
-                    result = response.json()
-                    
-                    if result and "choices" in result and len(result["choices"]) > 0:
-                        content = result["choices"][0]["message"]["content"]
-                        return content.replace("\n", "")
-                    else:
-                        raise Exception(f"[{llm_provider}] returned an invalid response format")
-                        
-                except requests.exceptions.RequestException as e:
-                    raise Exception(f"[{llm_provider}] request failed: {str(e)}")
-                except Exception as e:
-                    raise Exception(f"[{llm_provider}] error: {str(e)}")
+        if loop is None:
+            client.close()
+        elif loop.is_running():
+            close = client.aclose if isinstance(client, httpx.AsyncClient) else client.close
+            asyncio.run_coroutine_threadsafe(close(), loop)
+    except Exception as e:
+        logger.warning(f"failed to close a replaced llm client: {str(e)}")
 
-            if llm_provider not in ["pollinations", "ollama"]:  # Skip validation for providers that don't require API key
-                if not api_key:
-                    raise ValueError(
-                        f"{llm_provider}: api_key is not set, please set it in the config.toml file."
-                    )
-                if not model_name:
-                    raise ValueError(
-                        f"{llm_provider}: model_name is not set, please set it in the config.toml file."
-                    )
-                if not base_url:
-                    raise ValueError(
-                        f"{llm_provider}: base_url is not set, please set it in the config.toml file."
-                    )
 
-            if llm_provider == "qwen":
-                import dashscope
-                from dashscope.api_entities.dashscope_response import GenerationResponse
+def _get_provider_settings(llm_provider: str) -> Dict:
+    """
+    api_key, model_name, base_url and the other settings of a provider, read from the config once per config version
+    """
+    _check_config_version()
+    settings = _provider_settings.get(llm_provider)
+    if settings is None:
+        settings = _read_provider_settings(llm_provider)
+        _provider_settings[llm_provider] = settings
+    return settings
+
 
-                dashscope.api_key = api_key
-                response = dashscope.Generation.call(
-                    model=model_name, messages=[{"role": "user", "content": prompt}]
+def _read_provider_settings(llm_provider: str) -> Dict:
+    settings = {
+        "api_key": config.app.get(f"{llm_provider}_api_key", ""),
+        "model_name": config.app.get(f"{llm_provider}_model_name", ""),
+        "base_url": config.app.get(f"{llm_provider}_base_url", ""),
+        "api_version": "",  # for azure
+    }
+    if llm_provider == "g4f":
+        settings["model_name"] = settings["model_name"] or "gpt-3.5-turbo-16k-0613"
+    elif llm_provider == "moonshot":
+        settings["base_url"] = "https://api.moonshot.cn/v1"
+    elif llm_provider == "ollama":
+        settings["api_key"] = "ollama"  # any string works but you are required to have one
+        settings["base_url"] = settings["base_url"] or "http://localhost:11434/v1"
+    elif llm_provider == "openai":
+        settings["base_url"] = settings["base_url"] or "https://api.openai.com/v1"
+    elif llm_provider == "azure":
+        settings["api_version"] = config.app.get("azure_api_version", "2024-02-15-preview")
+    elif llm_provider in ("gemini", "qwen"):
+        settings["base_url"] = "***"
+    elif llm_provider == "cloudflare":
+        settings["account_id"] = config.app.get("cloudflare_account_id")
+        settings["base_url"] = "***"
+    elif llm_provider == "deepseek":
+        settings["base_url"] = settings["base_url"] or "https://api.deepseek.com"
+    elif llm_provider == "ernie":
+        settings["secret_key"] = config.app.get("ernie_secret_key")
+        settings["model_name"] = "***"
+        if not settings["secret_key"]:
+            raise ValueError(
+                f"{llm_provider}: secret_key is not set, please set it in the config.toml file."
+            )
+    elif llm_provider == "pollinations":
+        settings["base_url"] = settings["base_url"] or "https://text.pollinations.ai/openai"
+        settings["model_name"] = settings["model_name"] or "openai-fast"
+
+    # Skip validation for providers that don't require API key
+    if llm_provider not in ["g4f", "pollinations", "ollama"]:
+        for key in ["api_key", "model_name", "base_url"]:
+            if not settings[key]:
+                raise ValueError(
+                    f"{llm_provider}: {key} is not set, please set it in the config.toml file."
                 )
-                if response:
-                    if isinstance(response, GenerationResponse):
-                        status_code = response.status_code
-                        if status_code != 200:
-                            raise Exception(
-                                f'[{llm_provider}] returned an error response: "{response}"'
-                            )
-
-                        content = response["output"]["text"]
-                        return content.replace("\n", "")
-                    else:
-                        raise Exception(
-                            f'[{llm_provider}] returned an invalid response: "{response}"'
-                        )
-                else:
-                    raise Exception(f"[{llm_provider}] returned an empty response")
-
-            if llm_provider == "gemini":
-                import google.generativeai as genai
-
-                genai.configure(api_key=api_key, transport="rest")
-
-                generation_config = {
-                    "temperature": 0.5,
-                    "top_p": 1,
-                    "top_k": 1,
-                    "max_output_tokens": 2048,
-                }
+    return settings
 
-                safety_settings = [
-                    {
-                        "category": "HARM_CATEGORY_HARASSMENT",
-                        "threshold": "BLOCK_ONLY_HIGH",
-                    },
-                    {
-                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                        "threshold": "BLOCK_ONLY_HIGH",
-                    },
-                    {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_ONLY_HIGH",
-                    },
+
+def get_llm_providers() -> List[str]:
+    """
+    the providers a call can be routed to: llm_providers, or the single llm_provider when it is not set
+    """
+    providers = config.app.get("llm_providers", []) or []
+    if isinstance(providers, str):
+        providers = [p.strip() for p in providers.split(",")]
+    providers = [p for p in providers if p]
+    return providers or [config.app.get("llm_provider", "openai")]
+
+
+def _new_http_client() -> httpx.Client:
+    return httpx.Client(limits=_pool_limits, timeout=_timeout)
+
+
+def _new_async_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(limits=_pool_limits, timeout=_timeout)
+
+
+def _build_client(llm_provider: str, settings: Dict, http_client, is_async: bool):
+    if llm_provider in _http_providers:
+        return http_client
+    if llm_provider == "azure":
+        client_class = AsyncAzureOpenAI if is_async else AzureOpenAI
+        return client_class(
+            api_key=settings["api_key"],
+            api_version=settings["api_version"],
+            azure_endpoint=settings["base_url"],
+            http_client=http_client,
+        )
+    client_class = AsyncOpenAI if is_async else OpenAI
+    return client_class(
+        api_key=settings["api_key"],
+        base_url=settings["base_url"],
+        http_client=http_client,
+    )
+
+
+def get_client(llm_provider: str, settings: Dict):
+    """
+    the client of a provider, built once per config version on a pooled (keep-alive) transport:
+    an OpenAI / AzureOpenAI client for the openai compatible providers, an httpx client for the others
+    """
+    _check_config_version()
+    client = _clients.get(llm_provider)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(llm_provider)
+            if client is None:
+                client = _build_client(llm_provider, settings, _new_http_client(), is_async=False)
+                _clients[llm_provider] = client
+    return client
+
+
+def get_async_client(llm_provider: str, settings: Dict):
+    """
+    the asyncio counterpart of get_client, one per provider, config version and event loop
+    """
+    _check_config_version()
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(llm_provider)
+    if client is None:
+        client = _build_client(llm_provider, settings, _new_async_http_client(), is_async=True)
+        clients[llm_provider] = client
+    return client
+
+
+def _messages(prompt: str) -> List[Dict]:
+    return [{"role": "user", "content": prompt}]
+
+
+def _chat_content(llm_provider: str, response) -> str:
+    if not response:
+        raise Exception(
+            f"[{llm_provider}] returned an empty response, please check your network connection and try again."
+        )
+    if not isinstance(response, ChatCompletion):
+        raise Exception(
+            f'[{llm_provider}] returned an invalid response: "{response}", please check your network '
+            f"connection and try again."
+        )
+    return response.choices[0].message.content.replace("\n", "")
+
+
+def _http_requests(llm_provider: str, settings: Dict, prompt: str) -> Generator[Dict, Any, str]:
+    """
+    the requests of a plain http provider: yields the arguments of each request, gets back its json
+    and returns the content, so the same steps run on a sync and an async client
+    """
+    if llm_provider == "pollinations":
+        # Prepare the payload
+        payload = {
+            "model": settings["model_name"],
+            "messages": _messages(prompt),
+            "seed": 101,  # Optional but helps with reproducibility
+        }
+        # Optional parameters if configured
+        if config.app.get("pollinations_private"):
+            payload["private"] = True
+        if config.app.get("pollinations_referrer"):
+            payload["referrer"] = config.app.get("pollinations_referrer")
+
+        result = yield {"method": "POST", "url": settings["base_url"], "json": payload}
+        if result and "choices" in result and len(result["choices"]) > 0:
+            content = result["choices"][0]["message"]["content"]
+            return content.replace("\n", "")
+        raise Exception(f"[{llm_provider}] returned an invalid response format")
+
+    if llm_provider == "cloudflare":
+        result = yield {
+            "method": "POST",
+            "url": f"https://api.cloudflare.com/client/v4/accounts/{settings['account_id']}/ai/run/{settings['model_name']}",
+            "headers": {"Authorization": f"Bearer {settings['api_key']}"},
+            "json": {
+                "messages": [
                     {
-                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                        "threshold": "BLOCK_ONLY_HIGH",
+                        "role": "system",
+                        "content": "You are a friendly assistant",
                     },
+                    {"role": "user", "content": prompt},
                 ]
+            },
+        }
+        logger.info(result)
+        return result["result"]["response"]
 
-                model = genai.GenerativeModel(
-                    model_name=model_name,
-                    generation_config=generation_config,
-                    safety_settings=safety_settings,
-                )
+    if llm_provider == "ernie":
+        token = yield {
+            "method": "POST",
+            "url": "https://aip.baidubce.com/oauth/2.0/token",
+            "params": {
+                "grant_type": "client_credentials",
+                "client_id": settings["api_key"],
+                "client_secret": settings["secret_key"],
+            },
+        }
+        result = yield {
+            "method": "POST",
+            "url": settings["base_url"],
+            "params": {"access_token": token.get("access_token")},
+            "json": {
+                "messages": _messages(prompt),
+                "temperature": 0.5,
+                "top_p": 0.8,
+                "penalty_score": 1,
+                "disable_search": False,
+                "enable_citation": False,
+                "response_format": "text",
+            },
+        }
+        return result.get("result")
 
-                try:
-                    response = model.generate_content(prompt)
-                    candidates = response.candidates
-                    generated_text = candidates[0].content.parts[0].text
-                except (AttributeError, IndexError) as e:
-                    print("Gemini Error:", e)
-
-                return generated_text
-
-            if llm_provider == "cloudflare":
-                response = requests.post(
-                    f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/{model_name}",
-                    headers={"Authorization": f"Bearer {api_key}"},
-                    json={
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "You are a friendly assistant",
-                            },
-                            {"role": "user", "content": prompt},
-                        ]
-                    },
-                )
-                result = response.json()
-                logger.info(result)
-                return result["result"]["response"]
-
-            if llm_provider == "ernie":
-                response = requests.post(
-                    "https://aip.baidubce.com/oauth/2.0/token", 
-                    params={
-                        "grant_type": "client_credentials",
-                        "client_id": api_key,
-                        "client_secret": secret_key,
-                    }
-                )
-                access_token = response.json().get("access_token")
-                url = f"{base_url}?access_token={access_token}"
+    raise ValueError(f"{llm_provider}: not an http provider")
 
-                payload = json.dumps(
-                    {
-                        "messages": [{"role": "user", "content": prompt}],
-                        "temperature": 0.5,
-                        "top_p": 0.8,
-                        "penalty_score": 1,
-                        "disable_search": False,
-                        "enable_citation": False,
-                        "response_format": "text",
-                    }
-                )
-                headers = {"Content-Type": "application/json"}
-
-                response = requests.request(
-                    "POST", url, headers=headers, data=payload
-                ).json()
-                return response.get("result")
-
-            if llm_provider == "azure":
-                client = AzureOpenAI(
-                    api_key=api_key,
-                    api_version=api_version,
-                    azure_endpoint=base_url,
-                )
-            else:
-                client = OpenAI(
-                    api_key=api_key,
-                    base_url=base_url,
-                )
 
-            response = client.chat.completions.create(
-                model=model_name, messages=[{"role": "user", "content": prompt}]
-            )
-            if response:
-                if isinstance(response, ChatCompletion):
-                    content = response.choices[0].message.content
-                else:
+def _sdk_generate(llm_provider: str, settings: Dict, prompt: str) -> str:
+    model_name = settings["model_name"]
+    if llm_provider == "g4f":
+        content = g4f.ChatCompletion.create(model=model_name, messages=_messages(prompt))
+        return content.replace("\n", "")
+
+    if llm_provider == "qwen":
+        import dashscope
+        from dashscope.api_entities.dashscope_response import GenerationResponse
+
+        dashscope.api_key = settings["api_key"]
+        response = dashscope.Generation.call(model=model_name, messages=_messages(prompt))
+        if response:
+            if isinstance(response, GenerationResponse):
+                status_code = response.status_code
+                if status_code != 200:
                     raise Exception(
-                        f'[{llm_provider}] returned an invalid response: "{response}", please check your network '
-                        f"connection and try again."
+                        f'[{llm_provider}] returned an error response: "{response}"'
                     )
+
+                content = response["output"]["text"]
+                return content.replace("\n", "")
             else:
                 raise Exception(
-                    f"[{llm_provider}] returned an empty response, please check your network connection and try again."
+                    f'[{llm_provider}] returned an invalid response: "{response}"'
                 )
+        else:
+            raise Exception(f"[{llm_provider}] returned an empty response")
 
-        return content.replace("\n", "")
+    if llm_provider == "gemini":
+        import google.generativeai as genai
+
+        genai.configure(api_key=settings["api_key"], transport="rest")
+
+        generation_config = {
+            "temperature": 0.5,
+            "top_p": 1,
+            "top_k": 1,
+            "max_output_tokens": 2048,
+        }
+
+        safety_settings = [
+            {
+                "category": "HARM_CATEGORY_HARASSMENT",
+                "threshold": "BLOCK_ONLY_HIGH",
+            },
+            {
+                "category": "HARM_CATEGORY_HATE_SPEECH",
+                "threshold": "BLOCK_ONLY_HIGH",
+            },
+            {
+                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                "threshold": "BLOCK_ONLY_HIGH",
+            },
+            {
+                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+                "threshold": "BLOCK_ONLY_HIGH",
+            },
+        ]
+
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+        )
+
+        try:
+            response = model.generate_content(prompt)
+            candidates = response.candidates
+            generated_text = candidates[0].content.parts[0].text
+        except (AttributeError, IndexError) as e:
+            print("Gemini Error:", e)
+
+        return generated_text
+
+    raise ValueError(f"{llm_provider}: not an sdk provider")
+
+
+def _provider_response(llm_provider: str, prompt: str) -> str:
+    settings = _get_provider_settings(llm_provider)
+    if llm_provider in _sdk_providers:
+        return _sdk_generate(llm_provider, settings, prompt)
+
+    client = get_client(llm_provider, settings)
+    if llm_provider in _http_providers:
+        steps = _http_requests(llm_provider, settings, prompt)
+        try:
+            request = next(steps)
+            while True:
+                response = client.request(**request)
+                response.raise_for_status()
+                request = steps.send(response.json())
+        except StopIteration as e:
+            return e.value
+
+    response = client.chat.completions.create(
+        model=settings["model_name"], messages=_messages(prompt)
+    )
+    return _chat_content(llm_provider, response)
+
+
+async def _aprovider_response(llm_provider: str, prompt: str) -> str:
+    settings = _get_provider_settings(llm_provider)
+    if llm_provider in _sdk_providers:
+        return await asyncio.to_thread(_sdk_generate, llm_provider, settings, prompt)
+
+    client = get_async_client(llm_provider, settings)
+    if llm_provider in _http_providers:
+        steps = _http_requests(llm_provider, settings, prompt)
+        try:
+            request = next(steps)
+            while True:
+                response = await client.request(**request)
+                response.raise_for_status()
+                request = steps.send(response.json())
+        except StopIteration as e:
+            return e.value
+
+    response = await client.chat.completions.create(
+        model=settings["model_name"], messages=_messages(prompt)
+    )
+    return _chat_content(llm_provider, response)
+
+
+class ProviderRouter:
+    """
+    ranks the llm providers by an EWMA of their latency, penalized by an EWMA of their errors.
+    the error EWMA fades with time so a provider that failed gets another chance later,
+    a provider that was never called goes first so every provider gets measured,
+    a provider counts as at least as slow as the oldest request it has not answered yet.
+    the latencies of the last calls give the percentile after which a call is hedged
+    """
+
+    def __init__(self, alpha: float = 0.2, window: int = 100, error_half_life: float = 60):
+        self.alpha = alpha
+        self.error_half_life = error_half_life
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _provider_stats(self, provider: str) -> Dict:
+        stats = self._stats.get(provider)
+        if stats is None:
+            stats = {
+                "calls": 0,
+                "failures": 0,
+                "latency": None,
+                "errors": 0.0,
+                "updated": 0.0,
+                "samples": deque(maxlen=self.window),
+                "inflight": [],
+            }
+            self._stats[provider] = stats
+        return stats
+
+    def _errors(self, stats: Dict, now: float) -> float:
+        return stats["errors"] * 0.5 ** ((now - stats["updated"]) / self.error_half_life)
+
+    def begin(self, provider: str) -> float:
+        """
+        mark the start of a request, returns its start time for record
+        """
+        start_time = time.time()
+        with self._lock:
+            self._provider_stats(provider)["inflight"].append(start_time)
+        return start_time
+
+    def _update_latency(self, stats: Dict, latency: float):
+        if stats["latency"] is None:
+            stats["latency"] = latency
+        else:
+            stats["latency"] += self.alpha * (latency - stats["latency"])
+
+    def record(self, provider: str, start_time: float, ok: bool):
+        now = time.time()
+        latency = now - start_time
+        with self._lock:
+            stats = self._provider_stats(provider)
+            if start_time in stats["inflight"]:
+                stats["inflight"].remove(start_time)
+            stats["calls"] += 1
+            errors = self._errors(stats, now)
+            stats["errors"] = errors + self.alpha * ((0.0 if ok else 1.0) - errors)
+            stats["updated"] = now
+            if ok:
+                stats["samples"].append(latency)
+                self._update_latency(stats, latency)
+            else:
+                stats["failures"] += 1
+
+    def cancel(self, provider: str, start_time: float):
+        """
+        a request that lost to its hedge, it took at least this long
+        """
+        with self._lock:
+            stats = self._provider_stats(provider)
+            if start_time in stats["inflight"]:
+                stats["inflight"].remove(start_time)
+            self._update_latency(stats, time.time() - start_time)
+
+    def rank(self, providers: List[str]) -> List[str]:
+        now = time.time()
+        with self._lock:
+
+            def score(provider: str) -> float:
+                stats = self._stats.get(provider)
+                # a request that lost to its hedge leaves a latency but no call
+                if not stats or not (stats["calls"] or stats["inflight"] or stats["latency"] is not None):
+                    return -1
+                # a provider that only failed so far counts as slow
+                latency = stats["latency"] if stats["latency"] is not None else 60
+                if stats["inflight"]:
+                    latency = max(latency, now - min(stats["inflight"]))
+                return latency * (1 + 10 * self._errors(stats, now))
+
+            return sorted(providers, key=score)
+
+    def hedge_delay(self, provider: str, percentile: float, min_samples: int = 10) -> Optional[float]:
+        """
+        the latency percentile of the provider, None until it has enough samples
+        """
+        with self._lock:
+            stats = self._stats.get(provider)
+            samples = sorted(stats["samples"]) if stats else []
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+    def stats(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            return {
+                provider: {
+                    "calls": stats["calls"],
+                    "failures": stats["failures"],
+                    "latency": round(stats["latency"], 3) if stats["latency"] is not None else None,
+                    "error_rate": round(self._errors(stats, now), 4),
+                }
+                for provider, stats in self._stats.items()
+            }
+
+
+router = ProviderRouter()
+
+# 有多个服务商时同步接口也在这个事件循环中路由，落后的请求被取消时关闭其连接，而不是运行到超时
+_routing_loop = None
+_routing_loop_lock = threading.Lock()
+# threads of the routing loop for the providers without an async api, a slow provider can only hold this many
+_sdk_threads = 8
+
+
+def _get_routing_loop() -> asyncio.AbstractEventLoop:
+    global _routing_loop
+    with _routing_loop_lock:
+        if _routing_loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(
+                ThreadPoolExecutor(max_workers=_sdk_threads, thread_name_prefix="llm")
+            )
+            threading.Thread(target=loop.run_forever, name="llm-routing", daemon=True).start()
+            _routing_loop = loop
+    return _routing_loop
+
+
+def _get_hedge_delay(provider: str) -> Optional[float]:
+    if not config.app.get("enable_llm_hedging", True):
+        return None
+    delay = router.hedge_delay(provider, float(config.app.get("llm_hedge_percentile", 0.9)))
+    if delay is None:
+        delay = float(config.app.get("llm_hedge_delay", 10))
+    return delay
+
+
+def _timed_response(llm_provider: str, prompt: str) -> str:
+    logger.info(f"llm provider: {llm_provider}")
+    start_time = router.begin(llm_provider)
+    try:
+        content = _provider_response(llm_provider, prompt)
+        if not content:
+            raise Exception(f"[{llm_provider}] returned an empty response")
+    except Exception:
+        router.record(llm_provider, start_time, ok=False)
+        raise
+    router.record(llm_provider, start_time, ok=True)
+    return content
+
+
+async def _atimed_response(llm_provider: str, prompt: str) -> str:
+    logger.info(f"llm provider: {llm_provider}")
+    start_time = router.begin(llm_provider)
+    try:
+        content = await _aprovider_response(llm_provider, prompt)
+        if not content:
+            raise Exception(f"[{llm_provider}] returned an empty response")
+    except asyncio.CancelledError:
+        router.cancel(llm_provider, start_time)
+        raise
+    except Exception:
+        router.record(llm_provider, start_time, ok=False)
+        raise
+    router.record(llm_provider, start_time, ok=True)
+    return content
+
+
+def _generate_response(prompt: str) -> str:
+    """
+    ask the best provider, the next one takes over when it fails, and also gets the same request
+    when the answer takes longer than the hedge delay, the first answer wins.
+    with several providers this runs _agenerate_response on the routing loop, so the slower request is cancelled
+    """
+    providers = get_llm_providers()
+    if len(providers) == 1:
+        try:
+            return _timed_response(providers[0], prompt)
+        except Exception as e:
+            return f"Error: {str(e)}"
+    return asyncio.run_coroutine_threadsafe(
+        _agenerate_response(prompt), _get_routing_loop()
+    ).result()
+
+
+async def _agenerate_response(prompt: str) -> str:
+    """
+    _generate_response for asyncio, the providers without an async api run in a thread.
+    the slower request is cancelled once there is an answer, which closes its connection
+    """
+    try:
+        providers = router.rank(get_llm_providers())
+        if len(providers) == 1:
+            return await _atimed_response(providers[0], prompt)
+
+        pending = {}
+        last_error = None
+        hedged = False
+        try:
+            while pending or providers:
+                if not pending:
+                    provider = providers.pop(0)
+                    pending[asyncio.ensure_future(_atimed_response(provider, prompt))] = provider
+                timeout = None
+                if providers and not hedged:
+                    timeout = _get_hedge_delay(next(iter(pending.values())))
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    provider = providers.pop(0)
+                    logger.warning(f"llm request is slow, hedging it with {provider}")
+                    pending[asyncio.ensure_future(_atimed_response(provider, prompt))] = provider
+                    hedged = True
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        logger.warning(f"llm provider {provider} failed: {str(e)}")
+                        last_error = e
+            raise last_error
+        finally:
+            # the slower request is not needed any more, a thread of an sdk provider runs on to its end
+            for task in pending:
+                task.cancel()
     except Exception as e:
         return f"Error: {str(e)}"
 
 
-def generate_script(
-    video_subject: str, language: str = "", paragraph_number: int = 1
-) -> str:
+def get_llm_provider_stats() -> Dict:
+    return {"providers": get_llm_providers(), "stats": router.stats()}
+
+
+def _retry_delay(attempt: int) -> float:
+    # exponential backoff between the attempts of generate_script / generate_terms
+    return min(float(config.app.get("llm_retry_backoff", 1)) * 2**attempt, 30)
+
+
+def get_llm_cache() -> Optional[cache.PersistentCache]:
+    """
+    the cache of the generated scripts and terms, None if it is disabled
+    """
+    global _llm_cache
+    if _llm_cache is None and config.app.get("enable_llm_cache", True):
+        with _llm_cache_lock:
+            if _llm_cache is None:
+                _llm_cache = cache.PersistentCache(
+                    os.path.join(utils.storage_dir("cache_llm", create=True), "llm_cache.db"),
+                    ttl=int(config.app.get("llm_cache_ttl", 7 * 24 * 3600)),
+                    max_entries=int(config.app.get("llm_cache_max_entries", 10000)),
+                )
+    return _llm_cache
+
+
+def _cache_key(kind: str, prompt: str, **params) -> str:
+    models = []
+    for llm_provider in get_llm_providers():
+        try:
+            models.append([llm_provider, _get_provider_settings(llm_provider)["model_name"]])
+        except ValueError:
+            models.append([llm_provider, ""])
+    # 忽略空白的差异
+    normalized_prompt = " ".join(prompt.split())
+    data = json.dumps(
+        [models, kind, normalized_prompt, params],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _estimate_tokens(text: str) -> int:
+    # about 4 bytes of utf-8 per token for english, a bit more than 1 token per chinese character
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def _cache_get(key: str, use_cache: bool):
+    llm_cache = get_llm_cache()
+    if not llm_cache or not use_cache:
+        return None
+    item = llm_cache.get(key)
+    with _llm_cache_lock:
+        if not item:
+            _llm_cache_stats["misses"] += 1
+            return None
+        value, meta = item
+        _llm_cache_stats["hits"] += 1
+        _llm_cache_stats["saved_tokens"] += meta.get("tokens", 0)
+        _llm_cache_stats["saved_seconds"] += meta.get("seconds", 0)
+    logger.info("llm response served from the cache")
+    return value
+
+
+def _cache_set(key: str, value, prompt: str, elapsed: float):
+    llm_cache = get_llm_cache()
+    if not llm_cache:
+        return
+    tokens = _estimate_tokens(prompt) + _estimate_tokens(json.dumps(value, ensure_ascii=False))
+    llm_cache.set(key, value, meta={"tokens": tokens, "seconds": round(elapsed, 3)})
+
+
+def get_llm_cache_stats() -> Dict:
+    """
+    hit rate of the llm cache and the llm calls it saved, the cost is estimated from the tokens
+    of the prompts and responses and llm_cost_per_1k_tokens
+    """
+    llm_cache = get_llm_cache()
+    with _llm_cache_lock:
+        stats = dict(_llm_cache_stats)
+    total = stats["hits"] + stats["misses"]
+    return {
+        "enabled": llm_cache is not None,
+        "size": llm_cache.size() if llm_cache else 0,
+        "hits": stats["hits"],
+        "misses": stats["misses"],
+        "hit_rate": round(stats["hits"] / total, 4) if total else 0.0,
+        "saved_tokens": stats["saved_tokens"],
+        "saved_seconds": round(stats["saved_seconds"], 3),
+        "saved_cost": round(
+            stats["saved_tokens"] / 1000 * float(config.app.get("llm_cost_per_1k_tokens", 0)), 6
+        ),
+    }
+
+
+def _script_prompt(video_subject: str, language: str, paragraph_number: int) -> str:
     prompt = f"""
 # Role: Video Script Generator
 
@@ -316,48 +784,46 @@ Generate a script for a video, depending on the subject of the video.
 """.strip()
     if language:
         prompt += f"\n- language: {language}"
+    return prompt
 
-    final_script = ""
-    logger.info(f"subject: {video_subject}")
 
-    def format_response(response):
-        # Clean the script
-        # Remove asterisks, hashes
-        response = response.replace("*", "")
-        response = response.replace("#", "")
+def _format_script(response: str) -> str:
+    # Clean the script
+    # Remove asterisks, hashes
+    response = response.replace("*", "")
+    response = response.replace("#", "")
 
-        # Remove markdown syntax
-        response = re.sub(r"\[.*\]", "", response)
-        response = re.sub(r"\(.*\)", "", response)
+    # Remove markdown syntax
+    response = re.sub(r"\[.*\]", "", response)
+    response = re.sub(r"\(.*\)", "", response)
 
-        # Split the script into paragraphs
-        paragraphs = response.split("\n\n")
+    # Split the script into paragraphs
+    paragraphs = response.split("\n\n")
 
-        # Select the specified number of paragraphs
-        # selected_paragraphs = paragraphs[:paragraph_number]
+    # Select the specified number of paragraphs
+    # selected_paragraphs = paragraphs[:paragraph_number]
 
-        # Join the selected paragraphs into a single string
-        return "\n\n".join(paragraphs)
+    # Join the selected paragraphs into a single string
+    return "\n\n".join(paragraphs)
 
-    for i in range(_max_retries):
-        try:
-            response = _generate_response(prompt=prompt)
-            if response:
-                final_script = format_response(response)
-            else:
-                logging.error("gpt returned an empty response")
 
-            # g4f may return an error message
-            if final_script and "当日额度已消耗完" in final_script:
-                raise ValueError(final_script)
+def _script_attempt(response: str) -> str:
+    final_script = ""
+    try:
+        if response:
+            final_script = _format_script(response)
+        else:
+            logging.error("gpt returned an empty response")
+
+        # g4f may return an error message
+        if final_script and "当日额度已消耗完" in final_script:
+            raise ValueError(final_script)
+    except Exception as e:
+        logger.error(f"failed to generate script: {e}")
+    return final_script
 
-            if final_script:
-                break
-        except Exception as e:
-            logger.error(f"failed to generate script: {e}")
 
-        if i < _max_retries:
-            logger.warning(f"failed to generate video script, trying again... {i + 1}")
+def _script_result(final_script: str) -> str:
     if "Error: " in final_script:
         logger.error(f"failed to generate video script: {final_script}")
     else:
@@ -365,8 +831,67 @@ Generate a script for a video, depending on the subject of the video.
     return final_script.strip()
 
 
-def generate_terms(video_subject: str, video_script: str, amount: int = 5) -> List[str]:
-    prompt = f"""
+def _cache_script(cache_key: str, final_script: str, prompt: str, start_time: float):
+    if final_script and "Error: " not in final_script:
+        _cache_set(cache_key, final_script, prompt, time.time() - start_time)
+
+
+def generate_script(
+    video_subject: str, language: str = "", paragraph_number: int = 1, use_cache: bool = True
+) -> str:
+    """
+    use_cache=False asks the llm again, the new script replaces the cached one
+    """
+    prompt = _script_prompt(video_subject, language, paragraph_number)
+    logger.info(f"subject: {video_subject}")
+    cache_key = _cache_key("script", prompt)
+    cached = _cache_get(cache_key, use_cache)
+    if cached is not None:
+        return cached
+
+    start_time = time.time()
+    final_script = ""
+    for i in range(_max_retries):
+        final_script = _script_attempt(_generate_response(prompt=prompt))
+        if final_script:
+            break
+        logger.warning(f"failed to generate video script, trying again... {i + 1}")
+        if i < _max_retries - 1:
+            time.sleep(_retry_delay(i))
+    final_script = _script_result(final_script)
+    _cache_script(cache_key, final_script, prompt, start_time)
+    return final_script
+
+
+async def agenerate_script(
+    video_subject: str, language: str = "", paragraph_number: int = 1, use_cache: bool = True
+) -> str:
+    """
+    generate_script for asyncio, many calls can wait on the llm at once without a thread each
+    """
+    prompt = _script_prompt(video_subject, language, paragraph_number)
+    logger.info(f"subject: {video_subject}")
+    cache_key = _cache_key("script", prompt)
+    cached = await asyncio.to_thread(_cache_get, cache_key, use_cache)
+    if cached is not None:
+        return cached
+
+    start_time = time.time()
+    final_script = ""
+    for i in range(_max_retries):
+        final_script = _script_attempt(await _agenerate_response(prompt=prompt))
+        if final_script:
+            break
+        logger.warning(f"failed to generate video script, trying again... {i + 1}")
+        if i < _max_retries - 1:
+            await asyncio.sleep(_retry_delay(i))
+    final_script = _script_result(final_script)
+    await asyncio.to_thread(_cache_script, cache_key, final_script, prompt, start_time)
+    return final_script
+
+
+def _terms_prompt(video_subject: str, video_script: str, amount: int) -> str:
+    return f"""
 # Role: Video Search Terms Generator
 
 ## Goals:
@@ -392,40 +917,96 @@ Generate {amount} search terms for stock videos, depending on the subject of a v
 Please note that you must use English for generating video search terms; Chinese is not accepted.
 """.strip()
 
+
+def _terms_attempt(response: str) -> List[str]:
+    search_terms = []
+    try:
+        search_terms = json.loads(response)
+        if not isinstance(search_terms, list) or not all(
+            isinstance(term, str) for term in search_terms
+        ):
+            logger.error("response is not a list of strings.")
+            return []
+
+    except Exception as e:
+        logger.warning(f"failed to generate video terms: {str(e)}")
+        if response:
+            match = re.search(r"\[.*]", response)
+            if match:
+                try:
+                    search_terms = json.loads(match.group())
+                except Exception as e:
+                    logger.warning(f"failed to generate video terms: {str(e)}")
+                    pass
+    return search_terms
+
+
+def _cache_terms(cache_key: str, search_terms: List[str], prompt: str, start_time: float):
+    if search_terms and isinstance(search_terms, list):
+        _cache_set(cache_key, search_terms, prompt, time.time() - start_time)
+
+
+def generate_terms(
+    video_subject: str, video_script: str, amount: int = 5, use_cache: bool = True
+) -> List[str]:
+    """
+    use_cache=False asks the llm again, the new terms replace the cached ones
+    """
+    prompt = _terms_prompt(video_subject, video_script, amount)
     logger.info(f"subject: {video_subject}")
+    cache_key = _cache_key("terms", prompt)
+    cached = _cache_get(cache_key, use_cache)
+    if cached is not None:
+        return cached
 
+    start_time = time.time()
     search_terms = []
-    response = ""
     for i in range(_max_retries):
-        try:
-            response = _generate_response(prompt)
-            if "Error: " in response:
-                logger.error(f"failed to generate video script: {response}")
-                return response
-            search_terms = json.loads(response)
-            if not isinstance(search_terms, list) or not all(
-                isinstance(term, str) for term in search_terms
-            ):
-                logger.error("response is not a list of strings.")
-                continue
+        response = _generate_response(prompt)
+        if "Error: " in response:
+            logger.error(f"failed to generate video script: {response}")
+            return response
+        search_terms = _terms_attempt(response)
+        if search_terms and len(search_terms) > 0:
+            break
+        logger.warning(f"failed to generate video terms, trying again... {i + 1}")
+        if i < _max_retries - 1:
+            time.sleep(_retry_delay(i))
 
-        except Exception as e:
-            logger.warning(f"failed to generate video terms: {str(e)}")
-            if response:
-                match = re.search(r"\[.*]", response)
-                if match:
-                    try:
-                        search_terms = json.loads(match.group())
-                    except Exception as e:
-                        logger.warning(f"failed to generate video terms: {str(e)}")
-                        pass
+    logger.success(f"completed: \n{search_terms}")
+    _cache_terms(cache_key, search_terms, prompt, start_time)
+    return search_terms
+
+
+async def agenerate_terms(
+    video_subject: str, video_script: str, amount: int = 5, use_cache: bool = True
+) -> List[str]:
+    """
+    generate_terms for asyncio
+    """
+    prompt = _terms_prompt(video_subject, video_script, amount)
+    logger.info(f"subject: {video_subject}")
+    cache_key = _cache_key("terms", prompt)
+    cached = await asyncio.to_thread(_cache_get, cache_key, use_cache)
+    if cached is not None:
+        return cached
 
+    start_time = time.time()
+    search_terms = []
+    for i in range(_max_retries):
+        response = await _agenerate_response(prompt)
+        if "Error: " in response:
+            logger.error(f"failed to generate video script: {response}")
+            return response
+        search_terms = _terms_attempt(response)
         if search_terms and len(search_terms) > 0:
             break
-        if i < _max_retries:
-            logger.warning(f"failed to generate video terms, trying again... {i + 1}")
+        logger.warning(f"failed to generate video terms, trying again... {i + 1}")
+        if i < _max_retries - 1:
+            await asyncio.sleep(_retry_delay(i))
 
     logger.success(f"completed: \n{search_terms}")
+    await asyncio.to_thread(_cache_terms, cache_key, search_terms, prompt, start_time)
     return search_terms
 
 
@@ -1,18 +1,96 @@
 import os
 import random
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import List
 from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode
+from app.services import cache, probe
 from app.utils import utils
 
 requested_count = 0
 
+_user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+_sessions = {}
+_sessions_lock = threading.Lock()
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+
+def get_session(provider: str) -> requests.Session:
+    """
+    a keep-alive session shared by all searches and downloads of a provider
+    """
+    with _sessions_lock:
+        session = _sessions.get(provider)
+        if not session:
+            pool_size = max(get_download_workers(), 10)
+            adapter = HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"User-Agent": _user_agent})
+            _sessions[provider] = session
+        return session
+
+
+def get_download_workers() -> int:
+    return max(1, int(config.app.get("material_download_workers", 4)))
+
+
+def get_search_cache():
+    """
+    the cache of search results, None if it is disabled
+    """
+    global _search_cache
+    if _search_cache is None and config.app.get("enable_search_cache", True):
+        with _search_cache_lock:
+            if _search_cache is None:
+                _search_cache = cache.TTLCache(
+                    name="search",
+                    ttl=int(config.app.get("search_cache_ttl", 3600)),
+                    redis_client=cache.get_redis_client(),
+                )
+    return _search_cache
+
+
+def _search_cache_key(
+    provider: str, search_term: str, orientation: str, minimum_duration: int
+) -> str:
+    search_term = " ".join(search_term.lower().split())
+    return f"{provider}:{orientation}:{minimum_duration}:{search_term}"
+
+
+def _get_cached_search(key: str):
+    search_cache = get_search_cache()
+    if not search_cache:
+        return None
+    items = search_cache.get(key)
+    if items is None:
+        return None
+    logger.info(f"search cache hit: {key}, stats: {search_cache.stats()}")
+    return [MaterialInfo(**item) for item in items]
+
+
+def _set_cached_search(key: str, video_items: List[MaterialInfo]):
+    search_cache = get_search_cache()
+    if search_cache:
+        search_cache.set(
+            key,
+            [
+                {"provider": item.provider, "url": item.url, "duration": item.duration}
+                for item in video_items
+            ],
+        )
+
 
 def get_api_key(cfg_key: str):
     api_keys = config.app.get(cfg_key)
@@ -39,18 +117,20 @@ def search_videos_pexels(
     aspect = VideoAspect(video_aspect)
     video_orientation = aspect.name
     video_width, video_height = aspect.to_resolution()
+    cache_key = _search_cache_key("pexels", search_term, aspect.name, minimum_duration)
+    video_items = _get_cached_search(cache_key)
+    if video_items is not None:
+        return video_items
+
     api_key = get_api_key("pexels_api_keys")
-    headers = {
-        "Authorization": api_key,
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    }
+    headers = {"Authorization": api_key}
     # Build URL
     params = {"query": search_term, "per_page": 20, "orientation": video_orientation}
     query_url = f"https://api.pexels.com/videos/search?{urlencode(params)}"
     logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
 
     try:
-        r = requests.get(
+        r = get_session("pexels").get(
             query_url,
             headers=headers,
             proxies=config.proxy,
@@ -81,6 +161,7 @@ def search_videos_pexels(
                     item.duration = duration
                     video_items.append(item)
                     break
+        _set_cached_search(cache_key, video_items)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -96,6 +177,10 @@ def search_videos_pixabay(
     aspect = VideoAspect(video_aspect)
 
     video_width, video_height = aspect.to_resolution()
+    cache_key = _search_cache_key("pixabay", search_term, aspect.name, minimum_duration)
+    video_items = _get_cached_search(cache_key)
+    if video_items is not None:
+        return video_items
 
     api_key = get_api_key("pixabay_api_keys")
     # Build URL
@@ -109,7 +194,7 @@ def search_videos_pixabay(
     logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
 
     try:
-        r = requests.get(
+        r = get_session("pixabay").get(
             query_url, proxies=config.proxy, verify=False, timeout=(30, 60)
         )
         response = r.json()
@@ -137,6 +222,7 @@ def search_videos_pixabay(
                     item.duration = duration
                     video_items.append(item)
                     break
+        _set_cached_search(cache_key, video_items)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -144,46 +230,61 @@ def search_videos_pixabay(
     return []
 
 
-def save_video(video_url: str, save_dir: str = "") -> str:
+def get_video_path(video_url: str, save_dir: str = "") -> str:
     if not save_dir:
         save_dir = utils.storage_dir("cache_videos")
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-
     url_without_query = video_url.split("?")[0]
     url_hash = utils.md5(url_without_query)
     video_id = f"vid-{url_hash}"
-    video_path = f"{save_dir}/{video_id}.mp4"
+    return f"{save_dir}/{video_id}.mp4"
+
+
+def save_video(
+    video_url: str,
+    save_dir: str = "",
+    provider: str = "",
+    cancel_event: threading.Event = None,
+) -> str:
+    video_path = get_video_path(video_url, save_dir)
+    save_dir = os.path.dirname(video_path)
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir, exist_ok=True)
 
     # if video already exists, return the path
     if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
         logger.info(f"video already exists: {video_path}")
         return video_path
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
-    }
-
     # if video does not exist, download it
-    with open(video_path, "wb") as f:
-        f.write(
-            requests.get(
-                video_url,
-                headers=headers,
-                proxies=config.proxy,
-                verify=False,
-                timeout=(60, 240),
-            ).content
-        )
+    # stream into a temp file and rename it when it is complete, so an interrupted download never looks like a cached video
+    part_path = f"{video_path}.{utils.get_uuid(remove_hyphen=True)}.part"
+    try:
+        with get_session(provider).get(
+            video_url,
+            proxies=config.proxy,
+            verify=False,
+            timeout=(60, 240),
+            stream=True,
+        ) as r:
+            r.raise_for_status()
+            with open(part_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    if cancel_event and cancel_event.is_set():
+                        logger.info(f"download cancelled: {video_url}")
+                        break
+                    f.write(chunk)
+        if cancel_event and cancel_event.is_set():
+            return ""
+        os.replace(part_path, video_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
 
     if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
         try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
+            media = probe.probe(video_path)
+            if media.duration > 0 and media.fps > 0:
                 return video_path
         except Exception as e:
             try:
@@ -202,7 +303,27 @@ def download_videos(
     video_contact_mode: VideoConcatMode = VideoConcatMode.random,
     audio_duration: float = 0.0,
     max_clip_duration: int = 5,
+    downloaded_videos: List[str] = None,
 ) -> List[str]:
+    """
+    download videos until they cover audio_duration.
+    downloaded_videos are the videos of an earlier call, e.g. one made with an estimated duration,
+    they count toward the duration and are kept at the front of the result.
+    """
+    total_duration = 0.0
+    downloaded_videos = downloaded_videos or []
+    for video_path in downloaded_videos:
+        try:
+            total_duration += min(max_clip_duration, probe.probe(video_path).duration)
+        except Exception as e:
+            logger.warning(f"invalid video file: {video_path} => {str(e)}")
+    if downloaded_videos:
+        logger.info(
+            f"{len(downloaded_videos)} videos already downloaded, duration: {total_duration} seconds"
+        )
+        if total_duration > audio_duration:
+            return downloaded_videos
+
     valid_video_items = []
     valid_video_urls = []
     found_duration = 0.0
@@ -210,24 +331,30 @@ def download_videos(
     if source == "pixabay":
         search_videos = search_videos_pixabay
 
-    for search_term in search_terms:
-        video_items = search_videos(
-            search_term=search_term,
-            minimum_duration=max_clip_duration,
-            video_aspect=video_aspect,
+    workers = get_download_workers()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        search_results = executor.map(
+            lambda term: search_videos(
+                search_term=term,
+                minimum_duration=max_clip_duration,
+                video_aspect=video_aspect,
+            ),
+            search_terms,
         )
-        logger.info(f"found {len(video_items)} videos for '{search_term}'")
+        for search_term, video_items in zip(search_terms, search_results):
+            logger.info(f"found {len(video_items)} videos for '{search_term}'")
 
-        for item in video_items:
-            if item.url not in valid_video_urls:
-                valid_video_items.append(item)
-                valid_video_urls.append(item.url)
-                found_duration += item.duration
+            for item in video_items:
+                if item.url not in valid_video_urls:
+                    valid_video_items.append(item)
+                    valid_video_urls.append(item.url)
+                    found_duration += item.duration
 
+    if get_search_cache():
+        logger.info(f"search cache stats: {get_search_cache().stats()}")
     logger.info(
         f"found total videos: {len(valid_video_items)}, required duration: {audio_duration} seconds, found duration: {found_duration} seconds"
     )
-    video_paths = []
 
     material_directory = config.app.get("material_directory", "").strip()
     if material_directory == "task":
@@ -235,30 +362,72 @@ def download_videos(
     elif material_directory and not os.path.isdir(material_directory):
         material_directory = ""
 
+    if downloaded_videos:
+        valid_video_items = [
+            item
+            for item in valid_video_items
+            if get_video_path(item.url, material_directory) not in downloaded_videos
+        ]
+
     if video_contact_mode.value == VideoConcatMode.random.value:
         random.shuffle(valid_video_items)
 
-    total_duration = 0.0
-    for item in valid_video_items:
-        try:
+    # download with a bounded pool, only keep enough downloads in flight to cover the audio duration,
+    # once the downloaded videos are long enough the remaining downloads are cancelled
+    saved_videos = {}
+    cancel_event = threading.Event()
+    pending_items = iter(enumerate(valid_video_items))
+    in_flight = {}
+
+    def submit_next():
+        planned_duration = total_duration + sum(
+            min(max_clip_duration, item.duration) for _, item in in_flight.values()
+        )
+        while len(in_flight) < workers and planned_duration <= audio_duration:
+            next_item = next(pending_items, None)
+            if next_item is None:
+                return
+            index, item = next_item
             logger.info(f"downloading video: {item.url}")
-            saved_video_path = save_video(
-                video_url=item.url, save_dir=material_directory
+            future = executor.submit(
+                save_video,
+                video_url=item.url,
+                save_dir=material_directory,
+                provider=item.provider,
+                cancel_event=cancel_event,
             )
-            if saved_video_path:
-                logger.info(f"video saved: {saved_video_path}")
-                video_paths.append(saved_video_path)
-                seconds = min(max_clip_duration, item.duration)
-                total_duration += seconds
-                if total_duration > audio_duration:
+            in_flight[future] = (index, item)
+            planned_duration += min(max_clip_duration, item.duration)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        submit_next()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, item = in_flight.pop(future)
+                try:
+                    saved_video_path = future.result()
+                except Exception as e:
+                    logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+                    continue
+                if saved_video_path and not cancel_event.is_set():
+                    logger.info(f"video saved: {saved_video_path}")
+                    saved_videos[index] = saved_video_path
+                    total_duration += min(max_clip_duration, item.duration)
+
+            if total_duration > audio_duration:
+                if not cancel_event.is_set():
                     logger.info(
                         f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
                     )
-                    break
-        except Exception as e:
-            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+                    cancel_event.set()
+            else:
+                submit_next()
+
+    # keep the order of the candidates, it matters for the sequential concat mode
+    video_paths = [saved_videos[index] for index in sorted(saved_videos)]
     logger.success(f"downloaded {len(video_paths)} videos")
-    return video_paths
+    return downloaded_videos + video_paths
 
 
 if __name__ == "__main__":
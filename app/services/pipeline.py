@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+
+# 资源类别: io（等待网络，如 LLM、TTS、下载）, cpu（本地计算，如 whisper、图片转视频）, render（视频渲染）
+RESOURCE_IO = "io"
+RESOURCE_CPU = "cpu"
+RESOURCE_RENDER = "render"
+
+# cores given to each render by default, a render encodes its segments in a pool sized
+# to its share of the cores (see get_render_cores), so the default number of render slots
+# is the number of cores divided by it
+RENDER_CORES = 4
+
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def get_resource_limit(resource: str) -> int:
+    """
+    how many stages of a resource class may run at the same time in this process, across all tasks
+    """
+    cpu_count = os.cpu_count() or 1
+    if resource == RESOURCE_IO:
+        return int(config.app.get("io_stage_concurrency", 16))
+    if resource == RESOURCE_CPU:
+        return int(config.app.get("cpu_stage_concurrency", 0)) or cpu_count
+    return int(config.app.get("render_stage_concurrency", 0)) or max(1, cpu_count // RENDER_CORES)
+
+
+def get_render_cores() -> int:
+    """
+    the cores one render may use, the render slots share the cores of the host
+    """
+    cpu_count = os.cpu_count() or 1
+    return max(1, cpu_count // get_resource_limit(RESOURCE_RENDER))
+
+
+def _get_slots(resource: str) -> threading.BoundedSemaphore:
+    with _slots_lock:
+        if resource not in _slots:
+            _slots[resource] = threading.BoundedSemaphore(get_resource_limit(resource))
+        return _slots[resource]
+
+
+class Stage:
+    """
+    a step of a task, it runs once all the stages it depends on have finished.
+    the function is called with the results of those stages as keyword arguments,
+    returning None means the stage failed.
+
+    a stage with inputs (the parameters it reads besides its dependencies) is checkpointed:
+    its result must be json serializable, and it is reused from the manifest while the inputs,
+    the results of its dependencies and the files returned by `files(result)` are unchanged.
+
+    a stage only runs while it holds a slot of its resource class (io, cpu or render),
+    the slots are shared by the stages of all the tasks in the process.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        deps: List[str] = None,
+        inputs: dict = None,
+        files: Callable[[object], List[str]] = None,
+        resource: str = RESOURCE_IO,
+    ):
+        self.name = name
+        self.func = func
+        self.deps = deps or []
+        self.inputs = inputs
+        self.files = files
+        self.resource = resource
+
+    def __str__(self):
+        return f"Stage(name={self.name}, deps={self.deps}, resource={self.resource})"
+
+    def run(self, **kwargs):
+        slots = _get_slots(self.resource)
+        start_time = time.time()
+        with slots:
+            waited = time.time() - start_time
+            if waited > 1:
+                logger.info(f"stage {self.name} waited {waited:.1f}s for a {self.resource} slot")
+            return self.func(**kwargs)
+
+
+def _digest(value) -> str:
+    return hashlib.md5(
+        json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class Manifest:
+    """
+    the results of the checkpointed stages of a task with the hash of their inputs, saved as a json file
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self._lock = threading.Lock()
+        self.data = {"stages": {}}
+        if os.path.exists(file):
+            try:
+                with open(file, "r", encoding="utf-8") as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"invalid manifest: {file} => {str(e)}")
+        self.data.setdefault("stages", {})
+
+    def _save(self):
+        temp_file = f"{self.file}.{utils.get_uuid(remove_hyphen=True)}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=4, default=str)
+        os.replace(temp_file, self.file)
+
+    def update(self, **kwargs):
+        with self._lock:
+            self.data.update(kwargs)
+            self._save()
+
+    def get_stage(self, name: str, input_hash: str):
+        with self._lock:
+            stage = self.data["stages"].get(name)
+        if stage and stage.get("input_hash") == input_hash:
+            return stage.get("result")
+        return None
+
+    def set_stage(self, name: str, input_hash: str, result):
+        with self._lock:
+            self.data["stages"][name] = {"input_hash": input_hash, "result": result}
+            self._save()
+
+
+def _required_stages(stages: Dict[str, Stage], targets: List[str]) -> set:
+    required = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name in required:
+            continue
+        if name not in stages:
+            raise ValueError(f"unknown stage: {name}")
+        required.add(name)
+        pending.extend(stages[name].deps)
+    return required
+
+
+def run_stages(
+    stages: List[Stage],
+    targets: List[str] = None,
+    on_done: Callable[[str, object], None] = None,
+    max_workers: int = 4,
+    manifest: Manifest = None,
+) -> Dict[str, object]:
+    """
+    run the stages needed by targets (all stages by default), stages that do not depend on each other run at the same time.
+    with a manifest, checkpointed stages whose inputs are unchanged are not run again.
+    once a stage fails no more stages are started, the stages that are already running are waited for.
+    returns the results of the finished stages by name, a failed stage is missing from it.
+    an exception raised by a stage is raised again after the running stages have finished.
+    """
+    stages = {stage.name: stage for stage in stages}
+    required = _required_stages(stages, targets or list(stages))
+
+    results = {}
+    input_hashes = {}
+    reused = set()
+    running = {}
+    failed = False
+    error = None
+
+    def _reuse(stage: Stage) -> bool:
+        if not manifest or stage.inputs is None:
+            return False
+        input_hash = _digest(
+            {
+                "inputs": stage.inputs,
+                "deps": {dep: _digest(results[dep]) for dep in stage.deps},
+            }
+        )
+        input_hashes[stage.name] = input_hash
+        # a stage runs again when one of its dependencies ran, even if it returned the same result,
+        # e.g. the same file path with new content
+        if any(dep not in reused for dep in stage.deps):
+            return False
+        result = manifest.get_stage(stage.name, input_hash)
+        if result is None:
+            return False
+        files = stage.files(result) if stage.files else []
+        if not all(file and os.path.exists(file) for file in files):
+            return False
+        logger.info(f"stage reused from the manifest: {stage.name}")
+        reused.add(stage.name)
+        results[stage.name] = result
+        if on_done:
+            on_done(stage.name, result)
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # reusing a stage can make its dependents ready, so keep scheduling until nothing changes
+            scheduled = True
+            while scheduled and not failed:
+                scheduled = False
+                for name in sorted(required - set(results) - set(running.values())):
+                    stage = stages[name]
+                    if not all(dep in results for dep in stage.deps):
+                        continue
+                    scheduled = True
+                    if _reuse(stage):
+                        continue
+                    logger.debug(f"starting stage: {name}")
+                    kwargs = {dep: results[dep] for dep in stage.deps}
+                    running[executor.submit(stage.run, **kwargs)] = name
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"stage failed: {name} => {str(e)}")
+                    failed = True
+                    error = error or e
+                    continue
+                if result is None:
+                    logger.error(f"stage failed: {name}")
+                    failed = True
+                    continue
+                results[name] = result
+                if name in input_hashes:
+                    manifest.set_stage(name, input_hashes[name], result)
+                if on_done:
+                    on_done(name, result)
+
+    if error:
+        raise error
+    return results
@@ -0,0 +1,201 @@
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+from typing import Optional
+
+from loguru import logger
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from app.services.utils import ffmpeg
+from app.utils import utils
+
+_index_lock = threading.Lock()
+_memo = {}
+_ffprobe_binary = None
+
+
+class MediaInfo:
+    def __init__(
+        self,
+        duration: float = 0,
+        fps: float = 0,
+        width: int = 0,
+        height: int = 0,
+        codec: str = "",
+        bitrate: int = 0,
+        has_video: bool = False,
+        has_audio: bool = False,
+    ):
+        self.duration = duration
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.codec = codec
+        # kb/s
+        self.bitrate = bitrate
+        self.has_video = has_video
+        self.has_audio = has_audio
+
+    @property
+    def size(self):
+        return [self.width, self.height]
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    def __str__(self):
+        return f"MediaInfo({', '.join(f'{k}={v}' for k, v in self.__dict__.items())})"
+
+
+def _index_file() -> str:
+    return os.path.join(utils.storage_dir(create=True), "media_index.db")
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(_index_file(), timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS media ("
+        "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, info TEXT)"
+    )
+    return conn
+
+
+def _load(path: str, size: int, mtime_ns: int) -> Optional[MediaInfo]:
+    try:
+        with _index_lock:
+            conn = _connect()
+            try:
+                row = conn.execute(
+                    "SELECT info FROM media WHERE path = ? AND size = ? AND mtime_ns = ?",
+                    (path, size, mtime_ns),
+                ).fetchone()
+            finally:
+                conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"failed to read media index: {str(e)}")
+        return None
+    if not row:
+        return None
+    return MediaInfo(**json.loads(row[0]))
+
+
+def _save(path: str, size: int, mtime_ns: int, info: MediaInfo):
+    try:
+        with _index_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO media (path, size, mtime_ns, info) VALUES (?, ?, ?, ?)",
+                        (path, size, mtime_ns, json.dumps(info.to_dict())),
+                    )
+            finally:
+                conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"failed to update media index: {str(e)}")
+
+
+def get_ffprobe_binary() -> str:
+    """
+    ffprobe next to the ffmpeg binary, or the one on PATH, "" if there is none
+    """
+    global _ffprobe_binary
+    if _ffprobe_binary is None:
+        ffmpeg_binary = ffmpeg.get_ffmpeg_binary()
+        name = "ffprobe.exe" if ffmpeg_binary.lower().endswith(".exe") else "ffprobe"
+        sibling = os.path.join(os.path.dirname(ffmpeg_binary), name)
+        if os.path.isfile(sibling):
+            _ffprobe_binary = sibling
+        else:
+            _ffprobe_binary = shutil.which("ffprobe") or ""
+    return _ffprobe_binary
+
+
+def _parse_rate(rate: str) -> float:
+    try:
+        num, _, den = rate.partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0
+
+
+def _ffprobe(file_path: str) -> MediaInfo:
+    cmd = [
+        get_ffprobe_binary(),
+        "-v", "error",
+        "-print_format", "json",
+        "-show_format",
+        "-show_streams",
+        file_path,
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        stderr = result.stderr.decode("utf-8", errors="ignore").strip()
+        raise RuntimeError(f"ffprobe exited with code {result.returncode}: {stderr}")
+
+    data = json.loads(result.stdout)
+    fmt = data.get("format", {})
+    info = MediaInfo(
+        duration=float(fmt.get("duration") or 0),
+        bitrate=int(fmt.get("bit_rate") or 0) // 1000,
+    )
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "video" and not info.has_video:
+            info.has_video = True
+            info.width = int(stream.get("width") or 0)
+            info.height = int(stream.get("height") or 0)
+            info.codec = stream.get("codec_name", "")
+            info.fps = _parse_rate(stream.get("avg_frame_rate", "")) or _parse_rate(
+                stream.get("r_frame_rate", "")
+            )
+            if stream.get("bit_rate"):
+                info.bitrate = int(stream["bit_rate"]) // 1000
+        elif stream.get("codec_type") == "audio":
+            info.has_audio = True
+    return info
+
+
+def _ffmpeg_probe(file_path: str) -> MediaInfo:
+    # `ffmpeg -i` parsed by moviepy, used when there is no ffprobe (imageio-ffmpeg only ships ffmpeg)
+    infos = ffmpeg_parse_infos(file_path)
+    size = infos.get("video_size") or [0, 0]
+    return MediaInfo(
+        duration=infos.get("duration") or 0,
+        fps=infos.get("video_fps") or 0,
+        width=size[0],
+        height=size[1],
+        codec=infos.get("video_codec_name") or "",
+        bitrate=infos.get("video_bitrate") or infos.get("bitrate") or 0,
+        has_video=infos.get("video_found", False),
+        has_audio=infos.get("audio_found", False),
+    )
+
+
+def probe(file_path: str) -> MediaInfo:
+    """
+    duration, fps, size, codec and bitrate of a media file.
+    results are kept in a persistent index keyed by path, size and modification time,
+    so a file is only probed once until it changes.
+    raises an error if the file can not be read.
+    """
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    info = _memo.get(memo_key)
+    if info:
+        return info
+
+    info = _load(path, stat.st_size, stat.st_mtime_ns)
+    if not info:
+        if get_ffprobe_binary():
+            info = _ffprobe(path)
+        else:
+            info = _ffmpeg_probe(path)
+        _save(path, stat.st_size, stat.st_mtime_ns, info)
+        logger.debug(f"probed media: {path} => {info}")
+
+    _memo[memo_key] = info
+    return info
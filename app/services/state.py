@@ -1,12 +1,27 @@
 import ast
+import asyncio
+import json
+import threading
+import time
 from abc import ABC, abstractmethod
 
+from loguru import logger
+
 from app.config import config
 from app.models import const
 
 
+def is_task_finished(task: dict) -> bool:
+    return task.get("state") in (const.TASK_STATE_COMPLETE, const.TASK_STATE_FAILED)
+
+
 # Base class for state management
 class BaseState(ABC):
+    def __init__(self):
+        # task_id => [(event loop, asyncio queue)] of the clients following the task in this process
+        self._subscribers = {}
+        self._subscribers_lock = threading.Lock()
+
     @abstractmethod
     def update_task(self, task_id: str, state: int, progress: int = 0, **kwargs):
         pass
@@ -19,10 +34,56 @@ class BaseState(ABC):
     def get_all_tasks(self, page: int, page_size: int):
         pass
 
+    def _start_listening(self):
+        pass
+
+    def _notify(self, task_id: str, fields: dict):
+        """
+        hand the updated fields of a task to the subscribers in this process, called from any thread
+        """
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers.get(task_id, []))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, fields)
+            except RuntimeError:
+                # the event loop of the subscriber is closed
+                pass
+
+    async def subscribe(self, task_id: str, timeout: float = 15):
+        """
+        an async iterator of the task, first as it is now then after every update, until it completes or fails.
+        yields None when the task is not updated within timeout seconds, e.g. to send a keep-alive
+        """
+        self._start_listening()
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._subscribers_lock:
+            self._subscribers.setdefault(task_id, []).append(subscriber)
+        try:
+            # subscribed before reading the task, so no update in between is missed
+            task = await asyncio.to_thread(self.get_task, task_id) or {"task_id": task_id}
+            yield dict(task)
+            while not is_task_finished(task):
+                try:
+                    fields = await asyncio.wait_for(subscriber[1].get(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                task.update(fields)
+                yield dict(task)
+        finally:
+            with self._subscribers_lock:
+                subscribers = self._subscribers.get(task_id, [])
+                if subscriber in subscribers:
+                    subscribers.remove(subscriber)
+                if not subscribers:
+                    self._subscribers.pop(task_id, None)
+
 
 # Memory state management
 class MemoryState(BaseState):
     def __init__(self):
+        super().__init__()
         self._tasks = {}
 
     def get_all_tasks(self, page: int, page_size: int):
@@ -57,6 +118,7 @@ class MemoryState(BaseState):
         })
         
         self._tasks[task_id] = task_data
+        self._notify(task_id, {"state": state, "progress": progress, **kwargs})
 
     def get_task(self, task_id: str):
         return self._tasks.get(task_id, None)
@@ -66,33 +128,136 @@ class MemoryState(BaseState):
             del self._tasks[task_id]
 
 
+# State of a worker process, the updates are applied by the process that owns the state
+class ForwardingState(BaseState):
+    def __init__(self, queue):
+        super().__init__()
+        self._queue = queue
+
+    def update_task(
+        self,
+        task_id: str,
+        state: int = const.TASK_STATE_PROCESSING,
+        progress: int = 0,
+        **kwargs,
+    ):
+        self._queue.put((task_id, state, progress, kwargs))
+
+    def get_task(self, task_id: str):
+        return None
+
+    def get_all_tasks(self, page: int, page_size: int):
+        return [], 0
+
+
 # Redis state management
 class RedisState(BaseState):
-    def __init__(self, host="localhost", port=6379, db=0, password=None):
+    """
+    every task is a hash of json encoded fields under `{prefix}:task:{task_id}`,
+    indexed by creation time in the sorted set `{prefix}:tasks`.
+    updates are published on `{prefix}:progress:{task_id}`, a process has a single subscription
+    to all of them which is shared by its clients.
+    tasks of older versions (a hash under the bare task id) are moved to this layout when they are read
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, prefix="mpt"):
         import redis
 
+        super().__init__()
         self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        self._prefix = prefix
+        self._listener = None
+        self._legacy_migrated = False
+
+    def _progress_channel(self, task_id: str) -> str:
+        return f"{self._prefix}:progress:{task_id}"
+
+    def _start_listening(self):
+        with self._subscribers_lock:
+            if self._listener:
+                return
+            self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def _listen(self):
+        channel_prefix = self._progress_channel("")
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{channel_prefix}*")
+                for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    task_id = message["channel"].decode("utf-8")[len(channel_prefix):]
+                    self._notify(task_id, json.loads(message["data"]))
+            except Exception as e:
+                logger.warning(f"task progress subscription failed: {str(e)}, reconnecting")
+                time.sleep(1)
+
+    def _task_key(self, task_id: str) -> str:
+        return f"{self._prefix}:task:{task_id}"
+
+    def _index_key(self) -> str:
+        return f"{self._prefix}:tasks"
+
+    def _migrate_task(self, task_id: str) -> dict:
+        """
+        move a task stored by an older version under its bare task id to the current layout,
+        returns the task or an empty dict if there is none
+        """
+        task_data = self._redis.hgetall(task_id)
+        if task_data.get(b"task_id") != task_id.encode("utf-8"):
+            return {}
+        task = {
+            key.decode("utf-8"): self._convert_to_original_type(value)
+            for key, value in task_data.items()
+        }
+        pipe = self._redis.pipeline()
+        pipe.hset(
+            self._task_key(task_id),
+            mapping={
+                field: json.dumps(value, ensure_ascii=False, default=str)
+                for field, value in task.items()
+            },
+        )
+        pipe.zadd(self._index_key(), {task_id: time.time()}, nx=True)
+        pipe.delete(task_id)
+        pipe.execute()
+        logger.info(f"migrated task {task_id} to {self._task_key(task_id)}")
+        return task
+
+    def migrate_legacy_tasks(self) -> int:
+        """
+        move all the tasks stored by an older version (a hash under the bare task id), returns the number of tasks
+        """
+        migrated = 0
+        for key in self._redis.scan_iter(_type="HASH"):
+            task_id = key.decode("utf-8")
+            # 旧版本的任务键就是任务 id，字段 task_id 与键相同
+            if ":" in task_id or self._redis.hget(key, "task_id") != key:
+                continue
+            if self._migrate_task(task_id):
+                migrated += 1
+        return migrated
 
     def get_all_tasks(self, page: int, page_size: int):
+        if not self._legacy_migrated:
+            try:
+                self.migrate_legacy_tasks()
+                self._legacy_migrated = True
+            except Exception as e:
+                logger.warning(f"failed to migrate legacy tasks: {str(e)}")
         start = (page - 1) * page_size
-        end = start + page_size
-        tasks = []
-        cursor = 0
-        total = 0
-        while True:
-            cursor, keys = self._redis.scan(cursor, count=page_size)
-            total += len(keys)
-            if total > start:
-                for key in keys[max(0, start - total):end - total]:
-                    task_data = self._redis.hgetall(key)
-                    task = {
-                        k.decode("utf-8"): self._convert_to_original_type(v) for k, v in task_data.items()
-                    }
-                    tasks.append(task)
-                    if len(tasks) >= page_size:
-                        break
-            if cursor == 0 or len(tasks) >= page_size:
-                break
+        end = start + page_size - 1
+        total = self._redis.zcard(self._index_key())
+        task_ids = self._redis.zrange(self._index_key(), start, end)
+        if not task_ids:
+            return [], total
+
+        pipe = self._redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(self._task_key(task_id.decode("utf-8")))
+        tasks = [self._decode_task(task_data) for task_data in pipe.execute() if task_data]
         return tasks, total
 
     def update_task(
@@ -113,22 +278,40 @@ class RedisState(BaseState):
             **kwargs,
         }
 
-        for field, value in fields.items():
-            self._redis.hset(task_id, field, str(value))
+        # 所有字段和索引在一次往返中写入
+        pipe = self._redis.pipeline()
+        pipe.hset(
+            self._task_key(task_id),
+            mapping={
+                field: json.dumps(value, ensure_ascii=False, default=str)
+                for field, value in fields.items()
+            },
+        )
+        # only the first update of a task sets its creation time
+        pipe.zadd(self._index_key(), {task_id: time.time()}, nx=True)
+        pipe.publish(
+            self._progress_channel(task_id),
+            json.dumps(fields, ensure_ascii=False, default=str),
+        )
+        pipe.execute()
 
     def get_task(self, task_id: str):
-        task_data = self._redis.hgetall(task_id)
+        task_data = self._redis.hgetall(self._task_key(task_id))
         if not task_data:
-            return None
-
-        task = {
-            key.decode("utf-8"): self._convert_to_original_type(value)
-            for key, value in task_data.items()
-        }
-        return task
+            return self._migrate_task(task_id) or None
+        return self._decode_task(task_data)
 
     def delete_task(self, task_id: str):
-        self._redis.delete(task_id)
+        pipe = self._redis.pipeline()
+        pipe.delete(self._task_key(task_id))
+        pipe.zrem(self._index_key(), task_id)
+        pipe.execute()
+
+    def _decode_task(self, task_data: dict) -> dict:
+        task = {}
+        for key, value in task_data.items():
+            task[key.decode("utf-8")] = json.loads(value)
+        return task
 
     @staticmethod
     def _convert_to_original_type(value):
@@ -156,10 +339,15 @@ _redis_host = config.app.get("redis_host", "localhost")
 _redis_port = config.app.get("redis_port", 6379)
 _redis_db = config.app.get("redis_db", 0)
 _redis_password = config.app.get("redis_password", None)
+_redis_key_prefix = config.app.get("redis_key_prefix", "mpt")
 
 state = (
     RedisState(
-        host=_redis_host, port=_redis_port, db=_redis_db, password=_redis_password
+        host=_redis_host,
+        port=_redis_port,
+        db=_redis_db,
+        password=_redis_password,
+        prefix=_redis_key_prefix,
     )
     if _enable_redis
     else MemoryState()
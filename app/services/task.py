@@ -7,8 +7,13 @@ from loguru import logger
 
 from app.config import config
 from app.models import const
-from app.models.schema import VideoConcatMode, VideoParams
-from app.services import llm, material, subtitle, video, voice
+from app.models.schema import (
+    AudioRequest,
+    SubtitleRequest,
+    VideoConcatMode,
+    VideoParams,
+)
+from app.services import llm, material, pipeline, subtitle, video, voice
 from app.services import state as sm
 from app.utils import utils
 
@@ -21,6 +26,7 @@ def generate_script(task_id, params):
             video_subject=params.video_subject,
             language=params.video_language,
             paragraph_number=params.paragraph_number,
+            use_cache=params.use_llm_cache,
         )
     else:
         logger.debug(f"video script: \n{video_script}")
@@ -38,7 +44,10 @@ def generate_terms(task_id, params, video_script):
     video_terms = params.video_terms
     if not video_terms:
         video_terms = llm.generate_terms(
-            video_subject=params.video_subject, video_script=video_script, amount=5
+            video_subject=params.video_subject,
+            video_script=video_script,
+            amount=5,
+            use_cache=params.use_llm_cache,
         )
     else:
         if isinstance(video_terms, str):
@@ -123,7 +132,20 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
     return subtitle_path
 
 
-def get_video_materials(task_id, params, video_terms, audio_duration):
+def estimate_audio_duration(video_script, voice_rate=1.0):
+    """
+    a rough duration of the narration, used to start downloading materials before the audio is generated
+    """
+    cjk = r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]"
+    # about 4.5 CJK characters or 2.5 words are spoken per second
+    seconds = len(re.findall(cjk, video_script)) / 4.5
+    seconds += len(re.sub(cjk, " ", video_script).split()) / 2.5
+    return math.ceil(seconds / (voice_rate or 1.0))
+
+
+def get_video_materials(
+    task_id, params, video_terms, audio_duration, downloaded_videos=None
+):
     if params.video_source == "local":
         logger.info("\n\n## preprocess local materials")
         materials = video.preprocess_video(
@@ -146,6 +168,7 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
             video_contact_mode=params.video_concat_mode,
             audio_duration=audio_duration * params.video_count,
             max_clip_duration=params.video_clip_duration,
+            downloaded_videos=downloaded_videos,
         )
         if not downloaded_videos:
             sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -177,6 +200,35 @@ def generate_final_videos(
     )
     video_transition_mode = params.video_transition_mode
 
+    if use_direct_generation and params.video_count > 1 and params.render_engine == "ffmpeg":
+        # 多个视频共享素材：所有时间线先规划好，每个素材片段和字幕只渲染一次
+        # 只用于 ffmpeg 引擎，选择 moviepy 时仍逐个生成
+        output_files = [
+            path.join(utils.task_dir(task_id), f"final-{i + 1}.mp4")
+            for i in range(params.video_count)
+        ]
+        logger.info(f"\n\n## 批量生成 {params.video_count} 个视频")
+        try:
+            final_video_paths = video.generate_videos_batch(
+                video_paths=downloaded_videos,
+                audio_file=audio_file,
+                subtitle_path=subtitle_path,
+                output_files=output_files,
+                params=params,
+                video_aspect=params.video_aspect,
+                video_transition_mode=video_transition_mode,
+                max_clip_duration=params.video_clip_duration,
+                threads=params.n_threads,
+                on_variant=lambda done: sm.state.update_task(
+                    task_id, progress=50 + 50 * done / params.video_count
+                ),
+            )
+            if final_video_paths:
+                return final_video_paths, [None] * len(final_video_paths)
+        except Exception as e:
+            logger.error(f"批量生成失败: {str(e)}")
+        logger.warning("回退到逐个生成视频")
+
     _progress = 50
     for i in range(params.video_count):
         index = i + 1
@@ -245,6 +297,35 @@ def generate_final_videos(
     return final_video_paths, combined_video_paths
 
 
+def get_manifest_file(task_id):
+    return path.join(utils.task_dir(), task_id, "manifest.json")
+
+
+def load_task_params(task_id):
+    """
+    the params, stop_at and priority a task was started with, read from its manifest,
+    (None, None, None) if there is no manifest
+    """
+    manifest_file = get_manifest_file(task_id)
+    if not os.path.exists(manifest_file):
+        return None, None, None
+    manifest = pipeline.Manifest(manifest_file)
+    stop_at = manifest.data.get("stop_at", "video")
+    params = manifest.data.get("params")
+    priority = manifest.data.get("priority", const.TASK_PRIORITY_NORMAL)
+    if not params:
+        return None, None, None
+    if stop_at == "audio":
+        return AudioRequest(**params), stop_at, priority
+    if stop_at == "subtitle":
+        return SubtitleRequest(**params), stop_at, priority
+    return VideoParams(**params), stop_at, priority
+
+
+def _stage_inputs(params, *names):
+    return {name: getattr(params, name, None) for name in names}
+
+
 def start(task_id, params: VideoParams, stop_at: str = "video"):
     logger.info(f"start task: {task_id}, stop_at: {stop_at}")
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=5)
@@ -252,48 +333,206 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     if type(params.video_concat_mode) is str:
         params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
 
-    # 1. Generate script
-    video_script = generate_script(task_id, params)
-    if not video_script or "Error: " in video_script:
+    # the stages of a task, stages that do not depend on each other run at the same time.
+    # materials are downloaded for an estimated duration while the audio and subtitle are generated,
+    # and topped up once the real audio duration is known.
+    def _script():
+        video_script = generate_script(task_id, params)
+        if not video_script or "Error: " in video_script:
+            return None
+        return video_script
+
+    def _terms(script):
+        video_terms = ""
+        if params.video_source != "local":
+            video_terms = generate_terms(task_id, params, script)
+            if not video_terms:
+                return None
+        save_script_data(task_id, script, video_terms, params)
+        return video_terms
+
+    def _audio(script):
+        audio_file, audio_duration, sub_maker = generate_audio(task_id, params, script)
+        if not audio_file:
+            return None
+        # the word boundaries are kept in the result, so the subtitle can be generated from a reused audio
+        return {
+            "audio_file": audio_file,
+            "audio_duration": audio_duration,
+            "subs": sub_maker.subs,
+            "offset": sub_maker.offset,
+        }
+
+    def _subtitle(script, audio):
+        sub_maker = voice.SubMaker()
+        sub_maker.subs = audio["subs"]
+        sub_maker.offset = audio["offset"]
+        return generate_subtitle(task_id, params, script, sub_maker, audio["audio_file"])
+
+    def _prefetch_materials(script, terms):
+        audio_duration = estimate_audio_duration(script, params.voice_rate)
+        logger.info(f"estimated audio duration: {audio_duration} seconds")
+        return get_video_materials(task_id, params, terms, audio_duration)
+
+    def _materials(terms, prefetch_materials, audio):
+        return get_video_materials(
+            task_id,
+            params,
+            terms,
+            audio["audio_duration"],
+            downloaded_videos=prefetch_materials,
+        )
+
+    def _local_materials():
+        return get_video_materials(task_id, params, [], 0)
+
+    def _video(audio, subtitle, materials):
+        final_video_paths, combined_video_paths = generate_final_videos(
+            task_id,
+            params,
+            materials,
+            audio["audio_file"],
+            subtitle,
+            params.use_direct_generation,
+        )
+        if not final_video_paths:
+            return None
+        return final_video_paths, combined_video_paths
+
+    # the checkpointed stages are reused from the manifest of the task while their inputs are unchanged,
+    # so running a failed task again only runs the stages that did not finish
+    material_inputs = _stage_inputs(
+        params,
+        "video_source",
+        "video_aspect",
+        "video_concat_mode",
+        "video_clip_duration",
+        "video_count",
+        "voice_rate",
+    )
+    stages = [
+        pipeline.Stage(
+            "script",
+            _script,
+            inputs=_stage_inputs(
+                params, "video_subject", "video_script", "video_language", "paragraph_number"
+            ),
+        ),
+        pipeline.Stage(
+            "terms",
+            _terms,
+            ["script"],
+            inputs=_stage_inputs(params, "video_terms", "video_source"),
+        ),
+        pipeline.Stage(
+            "audio",
+            _audio,
+            ["script"],
+            inputs=_stage_inputs(params, "voice_name", "voice_rate", "voice_volume"),
+            files=lambda audio: [audio["audio_file"]],
+        ),
+        pipeline.Stage(
+            "subtitle",
+            _subtitle,
+            ["script", "audio"],
+            inputs={
+                **_stage_inputs(params, "subtitle_enabled"),
+                "subtitle_provider": config.app.get("subtitle_provider", "edge"),
+            },
+            files=lambda subtitle_path: [subtitle_path] if subtitle_path else [],
+            # whisper 在本地识别语音，edge 只整理 TTS 返回的时间轴
+            resource=(
+                pipeline.RESOURCE_CPU
+                if config.app.get("subtitle_provider", "edge").strip().lower() == "whisper"
+                else pipeline.RESOURCE_IO
+            ),
+        ),
+        pipeline.Stage(
+            "video",
+            _video,
+            ["audio", "subtitle", "materials"],
+            resource=pipeline.RESOURCE_RENDER,
+        ),
+    ]
+    if params.video_source == "local":
+        stages.append(
+            pipeline.Stage(
+                "materials",
+                _local_materials,
+                inputs={
+                    **material_inputs,
+                    "video_materials": [
+                        m.url for m in (getattr(params, "video_materials", None) or [])
+                    ],
+                },
+                files=lambda materials: materials,
+                # 本地图片需要先转换为视频
+                resource=pipeline.RESOURCE_CPU,
+            )
+        )
+    else:
+        stages.append(
+            pipeline.Stage(
+                "prefetch_materials",
+                _prefetch_materials,
+                ["script", "terms"],
+                inputs=material_inputs,
+                files=lambda materials: materials,
+            )
+        )
+        stages.append(
+            pipeline.Stage(
+                "materials",
+                _materials,
+                ["terms", "prefetch_materials", "audio"],
+                inputs=material_inputs,
+                files=lambda materials: materials,
+            )
+        )
+
+    stage_progress = {"script": 10, "terms": 20, "audio": 30, "subtitle": 40, "materials": 50}
+    progress = [5]
+
+    def _on_stage_done(name, result):
+        if name in stage_progress and stage_progress[name] > progress[0]:
+            progress[0] = stage_progress[name]
+            sm.state.update_task(
+                task_id, state=const.TASK_STATE_PROCESSING, progress=progress[0]
+            )
+
+    # the terms are always generated, except when stopping at the script, as script.json is saved with them
+    targets = [stop_at] if stop_at == "script" else [stop_at, "terms"]
+    utils.task_dir(task_id)
+    manifest = pipeline.Manifest(get_manifest_file(task_id))
+    manifest.update(
+        stop_at=stop_at,
+        params=params.model_dump(mode="json", warnings=False),
+        # a resumed task is queued with the priority it was created with
+        priority=getattr(params, "priority", const.TASK_PRIORITY_NORMAL),
+    )
+    results = pipeline.run_stages(
+        stages, targets=targets, on_done=_on_stage_done, manifest=manifest
+    )
+    if any(target not in results for target in targets):
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
         return
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=10)
-
+    video_script = results["script"]
     if stop_at == "script":
         sm.state.update_task(
             task_id, state=const.TASK_STATE_COMPLETE, progress=100, script=video_script
         )
         return {"script": video_script}
 
-    # 2. Generate terms
-    video_terms = ""
-    if params.video_source != "local":
-        video_terms = generate_terms(task_id, params, video_script)
-        if not video_terms:
-            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-            return
-
-    save_script_data(task_id, video_script, video_terms, params)
-
+    video_terms = results["terms"]
     if stop_at == "terms":
         sm.state.update_task(
             task_id, state=const.TASK_STATE_COMPLETE, progress=100, terms=video_terms
         )
         return {"script": video_script, "terms": video_terms}
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=20)
-
-    # 3. Generate audio
-    audio_file, audio_duration, sub_maker = generate_audio(
-        task_id, params, video_script
-    )
-    if not audio_file:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
-
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=30)
-
+    audio_file = results["audio"]["audio_file"]
+    audio_duration = results["audio"]["audio_duration"]
     if stop_at == "audio":
         sm.state.update_task(
             task_id,
@@ -303,11 +542,7 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         )
         return {"audio_file": audio_file, "audio_duration": audio_duration}
 
-    # 4. Generate subtitle
-    subtitle_path = generate_subtitle(
-        task_id, params, video_script, sub_maker, audio_file
-    )
-
+    subtitle_path = results["subtitle"]
     if stop_at == "subtitle":
         sm.state.update_task(
             task_id,
@@ -317,16 +552,7 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         )
         return {"subtitle_path": subtitle_path}
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
-
-    # 5. Get video materials
-    downloaded_videos = get_video_materials(
-        task_id, params, video_terms, audio_duration
-    )
-    if not downloaded_videos:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
-
+    downloaded_videos = results["materials"]
     if stop_at == "materials":
         sm.state.update_task(
             task_id,
@@ -336,16 +562,7 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         )
         return {"materials": downloaded_videos}
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
-
-    # 6. Generate final videos
-    final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path, params.use_direct_generation
-    )
-
-    if not final_video_paths:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
+    final_video_paths, combined_video_paths = results["video"]
 
     logger.success(
         f"task {task_id} finished, generated {len(final_video_paths)} videos."
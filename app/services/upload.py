@@ -0,0 +1,204 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import BinaryIO, Optional, Tuple
+
+from loguru import logger
+from PIL import Image
+
+from app.config import config
+from app.models import const
+from app.models.schema import MaterialInfo
+from app.services import probe
+from app.utils import utils
+
+_index_lock = threading.Lock()
+# 按页对齐的大块写入
+_chunk_size = 1024 * 1024
+_min_material_size = 480
+
+
+class UploadTooLargeError(ValueError):
+    pass
+
+
+def get_max_upload_size() -> int:
+    """
+    size cap of an upload in bytes, 0 for none
+    """
+    return int(config.app.get("max_upload_size", 1024)) * 1024 * 1024
+
+
+def _index_file() -> str:
+    return os.path.join(utils.storage_dir(create=True), "upload_index.db")
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(_index_file(), timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS uploads ("
+        "directory TEXT, sha256 TEXT, path TEXT, PRIMARY KEY (directory, sha256))"
+    )
+    return conn
+
+
+def _file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(_chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _find(directory: str, sha256: str, size: int) -> Optional[str]:
+    try:
+        with _index_lock:
+            conn = _connect()
+            try:
+                row = conn.execute(
+                    "SELECT path FROM uploads WHERE directory = ? AND sha256 = ?",
+                    (directory, sha256),
+                ).fetchone()
+            finally:
+                conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"failed to read upload index: {str(e)}")
+        return None
+    if not row:
+        return None
+    # 文件在记录之后可能被覆盖或修改，内容仍然一致才复用
+    try:
+        if os.path.getsize(row[0]) == size and _file_sha256(row[0]) == sha256:
+            return row[0]
+    except OSError:
+        pass
+    _update(row[0])
+    return None
+
+
+def _update(path: str, directory: str = "", sha256: str = ""):
+    """
+    drop the entries of path, then record its new content if sha256 is given
+    """
+    try:
+        with _index_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM uploads WHERE path = ?", (path,))
+                    if sha256:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO uploads (directory, sha256, path) VALUES (?, ?, ?)",
+                            (directory, sha256, path),
+                        )
+            finally:
+                conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"failed to update upload index: {str(e)}")
+
+
+def _store_upload(file: BinaryIO, directory: str, filename: str, max_size: int) -> Tuple[str, bool]:
+    """
+    save_upload, also tells whether the file was written by this call (False for a duplicate)
+    """
+    if max_size < 0:
+        max_size = get_max_upload_size()
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.basename(filename)
+    if not filename:
+        raise ValueError("missing file name")
+
+    if file.seekable():
+        file.seek(0)
+    sha256 = hashlib.sha256()
+    size = 0
+    # 临时文件与目标文件在同一目录，保证可以原子地重命名
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            while chunk := file.read(_chunk_size):
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise UploadTooLargeError(
+                        f"file is larger than the upload limit of {max_size // 1024 // 1024} MB"
+                    )
+                sha256.update(chunk)
+                temp_file.write(chunk)
+
+        digest = sha256.hexdigest()
+        existing = _find(directory, digest, size)
+        if existing:
+            logger.info(f"upload of {filename} is a duplicate of {existing}")
+            return existing, False
+
+        path = os.path.join(directory, filename)
+        os.replace(temp_path, path)
+        # 同名文件被覆盖，它原来的记录随之删除
+        _update(path, directory, digest)
+        logger.info(f"uploaded file saved: {path}, {size} bytes")
+        return path, True
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def save_upload(file: BinaryIO, directory: str, filename: str, max_size: int = -1) -> str:
+    """
+    copy an uploaded file into directory in chunks, hashing it on the way.
+    the file only appears under its name once complete (atomic rename), a file with the same content
+    uploaded before to the same directory is reused instead of stored again.
+    raises UploadTooLargeError if the file is larger than max_size (bytes, -1 for max_upload_size, 0 for no cap)
+    """
+    return _store_upload(file, directory, filename, max_size)[0]
+
+
+def save_material(file: BinaryIO, filename: str) -> MaterialInfo:
+    """
+    store an uploaded local video or image material, it is probed now so starting a task that uses it
+    has nothing left to check. raises ValueError for a file that can not be used as a material
+    """
+    directory = utils.storage_dir("local_videos", create=True)
+    name, ext = os.path.splitext(os.path.basename(filename))
+    # 同名的不同文件不会互相覆盖
+    path, created = _store_upload(
+        file, directory, f"{name}_{utils.get_uuid(remove_hyphen=True)[:8]}{ext}", -1
+    )
+
+    def _discard():
+        # 重复上传时文件属于之前的素材，不能删除
+        if created:
+            os.remove(path)
+            _update(path)
+
+    try:
+        if utils.parse_extension(path) in const.FILE_TYPE_IMAGES:
+            with Image.open(path) as image:
+                image.verify()
+                width, height = image.size
+            duration = 0
+        else:
+            # 结果写入 probe 的索引，任务开始时直接命中
+            media = probe.probe(path)
+            if not media.has_video:
+                raise ValueError("no video stream")
+            width, height = media.size
+            duration = media.duration
+    except Exception as e:
+        _discard()
+        raise ValueError(f"invalid material {filename}: {str(e)}")
+
+    if width < _min_material_size or height < _min_material_size:
+        _discard()
+        raise ValueError(
+            f"low resolution material {filename}: {width}x{height}, "
+            f"minimum {_min_material_size}x{_min_material_size} required"
+        )
+
+    material = MaterialInfo()
+    material.provider = "local"
+    material.url = path
+    material.duration = int(duration)
+    return material
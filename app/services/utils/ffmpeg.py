@@ -0,0 +1,53 @@
+import os
+import subprocess
+from typing import List
+
+from loguru import logger
+from moviepy.config import FFMPEG_BINARY
+
+
+def get_ffmpeg_binary() -> str:
+    # moviepy resolves the binary from IMAGEIO_FFMPEG_EXE (set by `ffmpeg_path` in config.toml)
+    # or from the one bundled with imageio-ffmpeg, so both render engines use the same ffmpeg
+    return FFMPEG_BINARY
+
+
+def escape_filter_value(value: str) -> str:
+    """
+    escape a value (e.g. a file path) that is embedded in a filter graph option
+    """
+    value = value.replace("\\", "/")
+    value = value.replace(":", "\\:")
+    value = value.replace("'", "\\'")
+    return value
+
+
+def run(args: List[str]) -> subprocess.CompletedProcess:
+    cmd = [get_ffmpeg_binary(), "-hide_banner", "-nostdin", "-loglevel", "error", "-y", *args]
+    logger.debug(f"running ffmpeg: {subprocess.list2cmdline(cmd)}")
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        stderr = result.stderr.decode("utf-8", errors="ignore").strip()
+        raise RuntimeError(
+            f"ffmpeg exited with code {result.returncode}: {stderr[-2000:]}"
+        )
+    return result
+
+
+def concat_copy(files: List[str], output_file: str):
+    """
+    join files that share the same codec parameters with the concat demuxer, without re-encoding
+    """
+    list_file = f"{output_file}.concat.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for file in files:
+            file = os.path.abspath(file).replace("\\", "/").replace("'", "'\\''")
+            f.write(f"file '{file}'\n")
+
+    args = ["-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy"]
+    if output_file.endswith(".mp4"):
+        args += ["-movflags", "+faststart"]
+    try:
+        run([*args, output_file])
+    finally:
+        os.remove(list_file)
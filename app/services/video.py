@@ -1,10 +1,18 @@
+import bisect
+import functools
 import glob
 import itertools
+import multiprocessing
 import os
 import random
 import gc
 import shutil
-from typing import List
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List
+import numpy as np
 from loguru import logger
 from moviepy import (
     AudioFileClip,
@@ -17,9 +25,10 @@ from moviepy import (
     afx,
     concatenate_videoclips,
 )
-from moviepy.video.tools.subtitles import SubtitlesClip
-from PIL import ImageFont
+from moviepy.video.tools.subtitles import file_to_subtitles
+from PIL import Image, ImageColor, ImageFont
 
+from app.config import config
 from app.models import const
 from app.models.schema import (
     MaterialInfo,
@@ -28,7 +37,8 @@ from app.models.schema import (
     VideoParams,
     VideoTransitionMode,
 )
-from app.services.utils import video_effects
+from app.services import cache, pipeline, probe
+from app.services.utils import ffmpeg, video_effects
 from app.utils import utils
 
 # 视频质量配置 - 可根据需要调整
@@ -41,10 +51,7 @@ class VideoQualityConfig:
     MERGE_BITRATE = "7000k"  # 合并文件码率
     MERGE_PRESET = "medium"  # 合并文件预设
     
-    # 最终文件编码设置
-    FINAL_BITRATE = "8000k"  # 最终文件码率
-    FINAL_PRESET = "slow"  # 最终文件预设
-    FINAL_CRF = "18"  # CRF值，18为高质量
+    # 最终文件编码设置见 ENCODE_PROFILES
     
     # 图片处理设置
     IMAGE_BITRATE = "6000k"  # 图片转视频码率
@@ -56,16 +63,15 @@ def diagnose_video_quality(video_path: str):
     诊断视频质量问题
     """
     try:
-        clip = VideoFileClip(video_path)
+        media = probe.probe(video_path)
         info = {
             "path": video_path,
-            "duration": clip.duration,
-            "fps": clip.fps,
-            "size": clip.size,
-            "bitrate": getattr(clip, 'bitrate', 'Unknown'),
-            "codec": getattr(clip, 'codec', 'Unknown'),
+            "duration": media.duration,
+            "fps": media.fps,
+            "size": media.size,
+            "bitrate": f"{media.bitrate}k" if media.bitrate else "Unknown",
+            "codec": media.codec or "Unknown",
         }
-        clip.close()
         logger.info(f"视频质量诊断: {utils.to_json(info)}")
         return info
     except Exception as e:
@@ -92,6 +98,105 @@ audio_codec = "aac"
 video_codec = "libx264"
 fps = 30
 
+
+class EncodeProfile:
+    """
+    rate control and preset of the final encode.
+    a profile targets either a constant quality (crf) or an average bitrate, never both
+    """
+
+    def __init__(self, name: str, preset: str, crf: int = None, bitrate: str = ""):
+        if crf is None and not bitrate:
+            raise ValueError(f"encode profile {name} needs a crf or a bitrate")
+        self.name = name
+        self.preset = preset
+        self.crf = crf
+        self.bitrate = "" if crf is not None else bitrate
+
+    def rate_control_args(self) -> List[str]:
+        if self.crf is not None:
+            return ["-crf", str(self.crf)]
+        return ["-b:v", self.bitrate]
+
+    def ffmpeg_args(self) -> List[str]:
+        return ["-preset", self.preset, *self.rate_control_args()]
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "preset": self.preset,
+            "crf": self.crf,
+            "bitrate": self.bitrate,
+        }
+
+
+# 最终文件编码档位，可在 config.toml 的 encode_profiles 中覆盖
+ENCODE_PROFILES = {
+    "draft": {"preset": "ultrafast", "crf": 30},
+    "fast": {"preset": "veryfast", "crf": 24},
+    "balanced": {"preset": "medium", "crf": 21},
+    "archive": {"preset": "slow", "crf": 18},
+}
+
+_encode_stats = {}
+_encode_stats_lock = threading.Lock()
+
+
+def get_encode_profile(name: str = "") -> EncodeProfile:
+    """
+    the encode profile by name, the deployment default (encode_profile in config.toml) if name is empty
+    """
+    default_name = config.app.get("encode_profile", "balanced")
+    name = (name or default_name).strip().lower()
+    overrides = config.app.get("encode_profiles", {})
+    if name not in ENCODE_PROFILES and name not in overrides:
+        logger.warning(f"unknown encode profile: {name}, using {default_name}")
+        name = default_name
+    settings = {**ENCODE_PROFILES.get(name, {}), **overrides.get(name, {})}
+    if "bitrate" in overrides.get(name, {}) and "crf" not in overrides.get(name, {}):
+        # a bitrate set in the config switches the profile to bitrate mode
+        settings.pop("crf", None)
+    return EncodeProfile(
+        name=name,
+        preset=settings.get("preset", "medium"),
+        crf=settings.get("crf"),
+        bitrate=settings.get("bitrate", ""),
+    )
+
+
+def record_encode(profile: EncodeProfile, video_duration: float, elapsed: float):
+    """
+    keep the throughput of the final encodes per profile
+    """
+    frames = video_duration * fps
+    encode_fps = frames / elapsed if elapsed > 0 else 0
+    logger.info(
+        f"encode profile: {profile.name}, {frames:.0f} frames in {elapsed:.2f}s, {encode_fps:.1f} fps"
+    )
+    with _encode_stats_lock:
+        stats = _encode_stats.setdefault(profile.name, {"encodes": 0, "frames": 0, "seconds": 0})
+        stats["encodes"] += 1
+        stats["frames"] += frames
+        stats["seconds"] += elapsed
+
+
+def get_encode_stats() -> dict:
+    """
+    the encode profiles with their settings and the measured encode fps of this process
+    """
+    profiles = {}
+    names = list(ENCODE_PROFILES) + [
+        name for name in config.app.get("encode_profiles", {}) if name not in ENCODE_PROFILES
+    ]
+    for name in names:
+        profile = get_encode_profile(name).to_dict()
+        with _encode_stats_lock:
+            stats = dict(_encode_stats.get(name, {"encodes": 0, "frames": 0, "seconds": 0}))
+        profile["encodes"] = stats["encodes"]
+        profile["fps"] = round(stats["frames"] / stats["seconds"], 1) if stats["seconds"] else 0
+        profiles[name] = profile
+    return profiles
+
 def close_clip(clip):
     if clip is None:
         return
@@ -155,169 +260,588 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     return ""
 
 
-def combine_videos(
-    combined_video_path: str,
+def plan_subclips(
     video_paths: List[str],
-    audio_file: str,
-    video_aspect: VideoAspect = VideoAspect.portrait,
     video_concat_mode: VideoConcatMode = VideoConcatMode.random,
-    video_transition_mode: VideoTransitionMode = None,
     max_clip_duration: int = 5,
-    threads: int = 2,
-) -> str:
-    audio_clip = AudioFileClip(audio_file)
-    audio_duration = audio_clip.duration
-    logger.info(f"audio duration: {audio_duration} seconds")
-    # Required duration of each clip
-    req_dur = audio_duration / len(video_paths)
-    req_dur = max_clip_duration
-    logger.info(f"maximum clip duration: {req_dur} seconds")
-    output_dir = os.path.dirname(combined_video_path)
-
-    aspect = VideoAspect(video_aspect)
-    video_width, video_height = aspect.to_resolution()
-
-    processed_clips = []
+) -> List[SubClippedVideoClip]:
+    """
+    split the materials into sub clips of max_clip_duration seconds
+    """
     subclipped_items = []
-    video_duration = 0
     for video_path in video_paths:
-        clip = VideoFileClip(video_path)
-        clip_duration = clip.duration
-        clip_w, clip_h = clip.size
-        close_clip(clip)
-        
-        start_time = 0
+        media = probe.probe(video_path)
+        clip_duration = media.duration
+        clip_w, clip_h = media.size
 
+        start_time = 0
         while start_time < clip_duration:
-            end_time = min(start_time + max_clip_duration, clip_duration)            
+            end_time = min(start_time + max_clip_duration, clip_duration)
             if clip_duration - start_time >= max_clip_duration:
-                subclipped_items.append(SubClippedVideoClip(file_path= video_path, start_time=start_time, end_time=end_time, width=clip_w, height=clip_h))
-            start_time = end_time    
+                subclipped_items.append(
+                    SubClippedVideoClip(
+                        file_path=video_path,
+                        start_time=start_time,
+                        end_time=end_time,
+                        width=clip_w,
+                        height=clip_h,
+                    )
+                )
+            start_time = end_time
             if video_concat_mode.value == VideoConcatMode.sequential.value:
                 break
 
     # random subclipped_items order
     if video_concat_mode.value == VideoConcatMode.random.value:
         random.shuffle(subclipped_items)
-        
+
     logger.debug(f"total subclipped items: {len(subclipped_items)}")
-    
-    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
-    for i, subclipped_item in enumerate(subclipped_items):
+    return subclipped_items
+
+
+def select_subclips(
+    subclipped_items: List[SubClippedVideoClip],
+    audio_duration: float,
+    max_clip_duration: int = 5,
+):
+    """
+    pick sub clips in order until the audio duration is covered,
+    loop the picked clips if the materials are not long enough.
+    returns the selected sub clips and their total duration
+    """
+    selected_items = []
+    video_duration = 0
+    for subclipped_item in subclipped_items:
         if video_duration > audio_duration:
             break
-        
-        logger.debug(f"processing clip {i+1}: {subclipped_item.width}x{subclipped_item.height}, current duration: {video_duration:.2f}s, remaining: {audio_duration - video_duration:.2f}s")
-        
-        try:
-            clip = VideoFileClip(subclipped_item.file_path).subclipped(subclipped_item.start_time, subclipped_item.end_time)
-            clip_duration = clip.duration
-            # Not all videos are same size, so we need to resize them
-            clip_w, clip_h = clip.size
-            if clip_w != video_width or clip_h != video_height:
-                clip_ratio = clip.w / clip.h
-                video_ratio = video_width / video_height
-                logger.debug(f"resizing clip, source: {clip_w}x{clip_h}, ratio: {clip_ratio:.2f}, target: {video_width}x{video_height}, ratio: {video_ratio:.2f}")
-                
-                if clip_ratio == video_ratio:
-                    clip = clip.resized(new_size=(video_width, video_height))
-                else:
-                    if clip_ratio > video_ratio:
-                        scale_factor = video_width / clip_w
-                    else:
-                        scale_factor = video_height / clip_h
-
-                    new_width = int(clip_w * scale_factor)
-                    new_height = int(clip_h * scale_factor)
-
-                    background = ColorClip(size=(video_width, video_height), color=(0, 0, 0)).with_duration(clip_duration)
-                    clip_resized = clip.resized(new_size=(new_width, new_height)).with_position("center")
-                    clip = CompositeVideoClip([background, clip_resized])
-                    
-            shuffle_side = random.choice(["left", "right", "top", "bottom"])
-            if video_transition_mode.value == VideoTransitionMode.none.value:
-                clip = clip
-            elif video_transition_mode.value == VideoTransitionMode.fade_in.value:
-                clip = video_effects.fadein_transition(clip, 1)
-            elif video_transition_mode.value == VideoTransitionMode.fade_out.value:
-                clip = video_effects.fadeout_transition(clip, 1)
-            elif video_transition_mode.value == VideoTransitionMode.slide_in.value:
-                clip = video_effects.slidein_transition(clip, 1, shuffle_side)
-            elif video_transition_mode.value == VideoTransitionMode.slide_out.value:
-                clip = video_effects.slideout_transition(clip, 1, shuffle_side)
-            elif video_transition_mode.value == VideoTransitionMode.shuffle.value:
-                transition_funcs = [
-                    lambda c: video_effects.fadein_transition(c, 1),
-                    lambda c: video_effects.fadeout_transition(c, 1),
-                    lambda c: video_effects.slidein_transition(c, 1, shuffle_side),
-                    lambda c: video_effects.slideout_transition(c, 1, shuffle_side),
-                ]
-                shuffle_transition = random.choice(transition_funcs)
-                clip = shuffle_transition(clip)
+        selected_items.append(subclipped_item)
+        video_duration += min(subclipped_item.duration, max_clip_duration)
 
-            if clip.duration > max_clip_duration:
-                clip = clip.subclipped(0, max_clip_duration)
-                
-            # wirte clip to temp file
-            clip_file = f"{output_dir}/temp-clip-{i+1}.mp4"
-            clip.write_videofile(
-                clip_file, 
-                logger=None, 
-                fps=fps, 
-                codec=video_codec, 
-                bitrate=VideoQualityConfig.TEMP_BITRATE,  # 使用配置的临时文件码率
-                preset=VideoQualityConfig.TEMP_PRESET,  # 使用配置的临时文件预设
-                threads=threads
-            )
-            
-            close_clip(clip)
-        
-            processed_clips.append(SubClippedVideoClip(file_path=clip_file, duration=clip.duration, width=clip_w, height=clip_h))
-            video_duration += clip.duration
-            
-        except Exception as e:
-            logger.error(f"failed to process clip: {str(e)}")
-    
-    # loop processed clips until the video duration matches or exceeds the audio duration.
-    if video_duration < audio_duration:
-        logger.warning(f"video duration ({video_duration:.2f}s) is shorter than audio duration ({audio_duration:.2f}s), looping clips to match audio length.")
-        base_clips = processed_clips.copy()
-        for clip in itertools.cycle(base_clips):
+    if selected_items and video_duration < audio_duration:
+        base_items = selected_items.copy()
+        for subclipped_item in itertools.cycle(base_items):
             if video_duration >= audio_duration:
                 break
-            processed_clips.append(clip)
-            video_duration += clip.duration
-        logger.info(f"video duration: {video_duration:.2f}s, audio duration: {audio_duration:.2f}s, looped {len(processed_clips)-len(base_clips)} clips")
-     
-    # 优化：使用一次性合并替代逐个合并，大幅提升性能
-    logger.info("starting optimized clip merging process")
-    if not processed_clips:
-        logger.warning("no clips available for merging")
-        return combined_video_path
-    
-    # if there is only one clip, use it directly
-    if len(processed_clips) == 1:
-        logger.info("using single clip directly")
-        shutil.copy(processed_clips[0].file_path, combined_video_path)
-        delete_files([processed_clips[0].file_path])
-        logger.info("video combining completed")
-        return combined_video_path
-    
+            selected_items.append(subclipped_item)
+            video_duration += min(subclipped_item.duration, max_clip_duration)
+    return selected_items, video_duration
+
+
+def pick_transition(video_transition_mode: VideoTransitionMode = None):
+    """
+    resolve the transition of a single clip, "Shuffle" picks one of the transitions at random.
+    returns the transition mode value (None for no transition) and the side used by the slide transitions
+    """
+    if (
+        not video_transition_mode
+        or video_transition_mode.value == VideoTransitionMode.none.value
+    ):
+        return None, None
+
+    shuffle_side = random.choice(["left", "right", "top", "bottom"])
+    transition = video_transition_mode.value
+    if transition == VideoTransitionMode.shuffle.value:
+        transition = random.choice(
+            [
+                VideoTransitionMode.fade_in.value,
+                VideoTransitionMode.fade_out.value,
+                VideoTransitionMode.slide_in.value,
+                VideoTransitionMode.slide_out.value,
+            ]
+        )
+    if transition not in (
+        VideoTransitionMode.slide_in.value,
+        VideoTransitionMode.slide_out.value,
+    ):
+        shuffle_side = None
+    return transition, shuffle_side
+
+
+def apply_transition(clip, transition: str, side: str):
+    if transition == VideoTransitionMode.fade_in.value:
+        return video_effects.fadein_transition(clip, 1)
+    if transition == VideoTransitionMode.fade_out.value:
+        return video_effects.fadeout_transition(clip, 1)
+    if transition == VideoTransitionMode.slide_in.value:
+        return video_effects.slidein_transition(clip, 1, side)
+    if transition == VideoTransitionMode.slide_out.value:
+        return video_effects.slideout_transition(clip, 1, side)
+    return clip
+
+
+def get_font_path(params: VideoParams) -> str:
+    if not params.font_name:
+        params.font_name = "STHeitiMedium.ttc"
+    font_path = os.path.join(utils.font_dir(), params.font_name)
+    if os.name == "nt":
+        font_path = font_path.replace("\\", "/")
+    return font_path
+
+
+def get_subtitle_y(params: VideoParams, text_height: int, video_height: int) -> float:
+    if params.subtitle_position == "bottom":
+        return video_height * 0.95 - text_height
+    if params.subtitle_position == "top":
+        return video_height * 0.05
+    if params.subtitle_position == "custom":
+        # Ensure the subtitle is fully within the screen bounds
+        margin = 10  # Additional margin, in pixels
+        max_y = video_height - text_height - margin
+        min_y = margin
+        custom_y = (video_height - text_height) * (params.custom_position / 100)
+        # Constrain the y value within the valid range
+        return max(min_y, min(custom_y, max_y))
+    # center
+    return (video_height - text_height) / 2
+
+
+@functools.lru_cache(maxsize=128)
+def _render_text(
+    phrase: str,
+    font_path: str,
+    font_size: int,
+    color: str,
+    bg_color,
+    stroke_color: str,
+    stroke_width: int,
+    video_width: int,
+):
+    # 同一行字幕在批量生成、多次渲染中只栅格化一次
+    # the same line is only rasterized once across the variants of a batch and the renders of a process
+    wrapped_txt, _ = wrap_text(
+        phrase, max_width=video_width * 0.9, font=font_path, fontsize=font_size
+    )
+    text_clip = TextClip(
+        text=wrapped_txt,
+        font=font_path,
+        font_size=font_size,
+        color=color,
+        bg_color=bg_color,
+        stroke_color=stroke_color,
+        stroke_width=stroke_width,
+    )
+    rgb = text_clip.get_frame(0)
+    alpha = text_clip.mask.get_frame(0)
+    close_clip(text_clip)
+    image = np.dstack([rgb, np.round(alpha * 255)]).astype(np.uint8)
+    image.setflags(write=False)
+    return image
+
+
+def render_subtitle_image(phrase: str, params: VideoParams, font_path: str, video_width: int):
+    """
+    the rgba bitmap of a subtitle line, cached by text, font, size, colors, stroke and video width
+    """
+    params.font_size = int(params.font_size)
+    params.stroke_width = int(params.stroke_width)
+    return _render_text(
+        phrase,
+        font_path,
+        params.font_size,
+        params.text_fore_color,
+        params.text_background_color,
+        params.stroke_color,
+        params.stroke_width,
+        video_width,
+    )
+
+
+class SubtitleSprite:
+    def __init__(self, start: float, end: float, x: int, y: int, image):
+        self.start = start
+        self.end = end
+        self.x = x
+        self.y = y
+        self.image = image
+
+
+def create_subtitle_sprites(
+    subtitle_path: str, params: VideoParams, video_width: int, video_height: int
+) -> List[SubtitleSprite]:
+    """
+    every subtitle line rasterized once and placed on the video, sorted by start time
+    """
+    font_path = get_font_path(params)
+    sprites = []
+    for (start, end), phrase in file_to_subtitles(subtitle_path, encoding="utf-8"):
+        image = render_subtitle_image(phrase, params, font_path, video_width)
+        h, w = image.shape[:2]
+        x = int((video_width - w) / 2)
+        y = int(get_subtitle_y(params, h, video_height))
+        sprites.append(SubtitleSprite(start, end, x, y, image))
+    sprites.sort(key=lambda sprite: sprite.start)
+    return sprites
+
+
+def blit_subtitles(frame, sprites: List[SubtitleSprite]):
+    """
+    alpha blend the sprites onto a copy of the frame, parts outside of the frame are cut off
+    """
+    frame = frame.copy()
+    frame_h, frame_w = frame.shape[:2]
+    for sprite in sprites:
+        h, w = sprite.image.shape[:2]
+        x0, y0 = max(sprite.x, 0), max(sprite.y, 0)
+        x1, y1 = min(sprite.x + w, frame_w), min(sprite.y + h, frame_h)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        image = sprite.image[y0 - sprite.y : y1 - sprite.y, x0 - sprite.x : x1 - sprite.x]
+        alpha = image[:, :, 3:4].astype(np.float32) / 255
+        region = frame[y0:y1, x0:x1].astype(np.float32)
+        frame[y0:y1, x0:x1] = (image[:, :, :3] * alpha + region * (1 - alpha)).astype(np.uint8)
+    return frame
+
+
+def add_subtitles(video_clip, subtitle_path: str, params: VideoParams, video_width: int, video_height: int):
+    """
+    draw the subtitles on the video, a frame only gets the lines that are shown at its time,
+    instead of compositing a text clip per line on every frame
+    """
+    sprites = create_subtitle_sprites(subtitle_path, params, video_width, video_height)
+    if not sprites:
+        return video_clip
+    starts = [sprite.start for sprite in sprites]
+    longest = max(sprite.end - sprite.start for sprite in sprites)
+
+    def draw(get_frame, t):
+        frame = get_frame(t)
+        # 字幕按开始时间排序，只检查在 t 之前最长一行时长内开始的行
+        # only the lines that started within the longest line duration before t can be shown
+        first = bisect.bisect_left(starts, t - longest)
+        last = bisect.bisect_right(starts, t)
+        active = [sprite for sprite in sprites[first:last] if sprite.end > t]
+        if not active:
+            return frame
+        return blit_subtitles(frame, active)
+
+    return video_clip.transform(draw)
+
+
+def _ass_color(color: str) -> str:
+    r, g, b = ImageColor.getrgb(color)[:3]
+    return f"&H00{b:02X}{g:02X}{r:02X}"
+
+
+def _ass_time(seconds: float) -> str:
+    centiseconds = int(round(seconds * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def create_ass_subtitles(
+    subtitle_path: str,
+    params: VideoParams,
+    video_width: int,
+    video_height: int,
+    ass_file: str,
+) -> str:
+    """
+    convert a srt file into an ass file styled by the subtitle params, to be burned in by libass.
+    lines are wrapped and positioned the same way as the rasterized subtitles
+    """
+    params.font_size = int(params.font_size)
+    params.stroke_width = int(params.stroke_width)
+    font_path = get_font_path(params)
+    font = ImageFont.truetype(font_path, params.font_size)
+    family, style = font.getname()
+    ascent, descent = font.getmetrics()
+    # ass font sizes are line heights, pillow font sizes are em sizes
+    font_size = ascent + descent
+
+    if isinstance(params.text_background_color, str) and params.text_background_color:
+        # opaque box, libass fills it with the outline color
+        border_style, outline_color = 3, _ass_color(params.text_background_color)
+    else:
+        border_style, outline_color = 1, _ass_color(params.stroke_color or "#000000")
+
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {video_width}",
+        f"PlayResY: {video_height}",
+        "WrapStyle: 2",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+        "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+        "Alignment, MarginL, MarginR, MarginV, Encoding",
+        f"Style: Default,{family},{font_size},{_ass_color(params.text_fore_color)},&H00FFFFFF,"
+        f"{outline_color},&H00000000,{-1 if 'Bold' in style else 0},0,0,0,100,100,0,0,"
+        f"{border_style},{params.stroke_width},0,8,0,0,0,1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+    ]
+    for (start, end), phrase in file_to_subtitles(subtitle_path, encoding="utf-8"):
+        wrapped_txt, txt_height = wrap_text(
+            phrase, max_width=video_width * 0.9, font=font_path, fontsize=params.font_size
+        )
+        y = get_subtitle_y(params, txt_height, video_height)
+        text = wrapped_txt.replace("{", "\\{").replace("}", "\\}").replace("\n", "\\N")
+        lines.append(
+            f"Dialogue: 0,{_ass_time(start)},{_ass_time(end)},Default,,0,0,0,,"
+            f"{{\\pos({video_width / 2:.0f},{y:.0f})}}{text}"
+        )
+
+    with open(ass_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return ass_file
+
+
+def get_subtitles_filter(ass_file: str) -> str:
+    """
+    the ffmpeg filter that burns the ass file into the video, using the fonts of the project
+    """
+    return (
+        f"subtitles=filename='{ffmpeg.escape_filter_value(ass_file)}'"
+        f":fontsdir='{ffmpeg.escape_filter_value(utils.font_dir())}'"
+    )
+
+
+def resize_clip(clip, video_width: int, video_height: int):
+    """
+    resize the clip to the video resolution, letterbox it with black bars if the aspect ratio differs
+    """
+    clip_w, clip_h = clip.size
+    if clip_w == video_width and clip_h == video_height:
+        return clip
+
+    clip_ratio = clip_w / clip_h
+    video_ratio = video_width / video_height
+    logger.debug(f"resizing clip, source: {clip_w}x{clip_h}, ratio: {clip_ratio:.2f}, target: {video_width}x{video_height}, ratio: {video_ratio:.2f}")
+
+    if clip_ratio == video_ratio:
+        return clip.resized(new_size=(video_width, video_height))
+
+    if clip_ratio > video_ratio:
+        scale_factor = video_width / clip_w
+    else:
+        scale_factor = video_height / clip_h
+
+    new_width = int(clip_w * scale_factor)
+    new_height = int(clip_h * scale_factor)
+
+    background = ColorClip(size=(video_width, video_height), color=(0, 0, 0)).with_duration(clip.duration)
+    clip_resized = clip.resized(new_size=(new_width, new_height)).with_position("center")
+    return CompositeVideoClip([background, clip_resized])
+
+
+# all temp clips are encoded with the same codec, fps, pixel format and GOP,
+# so they can be joined by the ffmpeg concat demuxer without re-encoding
+segment_gop = fps * 2
+segment_ffmpeg_params = [
+    "-pix_fmt", "yuv420p",
+    "-profile:v", "high",
+    "-g", str(segment_gop),
+    "-keyint_min", str(segment_gop),
+    "-sc_threshold", "0",
+]
+
+
+_segment_cache = None
+
+
+def get_segment_cache():
+    """
+    the cache of normalized segments shared across tasks, None if it is disabled
+    """
+    global _segment_cache
+    if not config.app.get("enable_segment_cache", True):
+        return None
+    if _segment_cache is None:
+        max_size = int(config.app.get("segment_cache_max_size", 2048)) * 1024 * 1024
+        _segment_cache = cache.FileCache(utils.storage_dir("cache_segments"), max_size)
+    return _segment_cache
+
+
+def get_segment_cache_key(
+    subclipped_item: SubClippedVideoClip,
+    video_width: int,
+    video_height: int,
+    transition: str,
+    side: str,
+    max_clip_duration: int,
+) -> str:
+    """
+    a normalized segment is keyed by the content of its source file, the time range,
+    the target resolution, fps, transition and the encoding settings
+    """
+    source_hash = cache.file_hash(subclipped_item.file_path)
+    if not source_hash:
+        return ""
+    return utils.md5(
+        "|".join(
+            str(v)
+            for v in [
+                source_hash,
+                subclipped_item.start_time,
+                subclipped_item.end_time,
+                max_clip_duration,
+                video_width,
+                video_height,
+                fps,
+                transition,
+                side,
+                video_codec,
+                VideoQualityConfig.TEMP_BITRATE,
+                VideoQualityConfig.TEMP_PRESET,
+                segment_gop,
+            ]
+        )
+    )
+
+
+def render_segment(segment: dict) -> float:
+    """
+    resize and apply the transition to a sub clip, then encode it to segment["clip_file"].
+    runs in a worker process, returns the duration of the encoded clip
+    """
+    clip = VideoFileClip(segment["file_path"]).subclipped(
+        segment["start_time"], segment["end_time"]
+    )
+    clip = resize_clip(clip, segment["video_width"], segment["video_height"])
+    clip = apply_transition(clip, segment["transition"], segment["side"])
+    if clip.duration > segment["max_clip_duration"]:
+        clip = clip.subclipped(0, segment["max_clip_duration"])
+
+    clip.write_videofile(
+        segment["clip_file"],
+        logger=None,
+        fps=fps,
+        codec=video_codec,
+        audio=False,
+        bitrate=VideoQualityConfig.TEMP_BITRATE,  # 使用配置的临时文件码率
+        preset=VideoQualityConfig.TEMP_PRESET,  # 使用配置的临时文件预设
+        threads=segment.get("threads", 2),
+        ffmpeg_params=segment_ffmpeg_params,
+    )
+    duration = clip.duration
+    close_clip(clip)
+    return duration
+
+
+def render_segments(segments: List[dict]) -> List[float]:
+    """
+    encode the segments concurrently in a process pool sized to this render's share of the cores,
+    so the renders running in the other render slots do not oversubscribe the host.
+    returns the duration of each encoded segment, None for the failed ones
+    """
+    results = [None] * len(segments)
+    if not segments:
+        return results
+
+    cores = pipeline.get_render_cores()
+    workers = min(cores, len(segments))
+    for segment in segments:
+        segment["threads"] = max(1, cores // workers)
+
+    try:
+        # spawn, a fork of the api process could inherit a lock held by one of its other threads
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(render_segment, segment): i
+                for i, segment in enumerate(segments)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    logger.error(f"failed to process clip: {segments[i]['file_path']} => {str(e)}")
+    except Exception as e:
+        logger.warning(f"process pool is not available, processing clips one by one: {str(e)}")
+        for i, segment in enumerate(segments):
+            if results[i] is not None:
+                continue
+            try:
+                results[i] = render_segment(segment)
+            except Exception as e:
+                logger.error(f"failed to process clip: {segment['file_path']} => {str(e)}")
+    return results
+
+
+def new_segment(
+    subclipped_item: SubClippedVideoClip,
+    video_width: int,
+    video_height: int,
+    transition: str,
+    side: str,
+    max_clip_duration: int,
+    clip_file: str,
+) -> dict:
+    """
+    the description of a normalized segment to encode with encode_segments
+    """
+    cache_key = ""
+    if get_segment_cache():
+        cache_key = get_segment_cache_key(
+            subclipped_item, video_width, video_height, transition, side, max_clip_duration
+        )
+    return {
+        "file_path": subclipped_item.file_path,
+        "start_time": subclipped_item.start_time,
+        "end_time": subclipped_item.end_time,
+        "width": subclipped_item.width,
+        "height": subclipped_item.height,
+        "video_width": video_width,
+        "video_height": video_height,
+        "transition": transition,
+        "side": side,
+        "max_clip_duration": max_clip_duration,
+        "clip_file": clip_file,
+        "cache_key": cache_key,
+    }
+
+
+def encode_segments(segments: List[dict], max_clip_duration: int) -> List[float]:
+    """
+    encode the segments to their clip files, the ones cached by previous tasks are copied from the cache.
+    returns the duration of each segment, None for the failed ones
+    """
+    segment_cache = get_segment_cache()
+    durations = [None] * len(segments)
+    missed = []
+    for i, segment in enumerate(segments):
+        cache_key = segment.get("cache_key")
+        if cache_key and segment_cache.fetch(cache_key, segment["clip_file"], ".mp4"):
+            durations[i] = min(segment["end_time"] - segment["start_time"], max_clip_duration)
+        else:
+            missed.append(i)
+    if segment_cache:
+        logger.info(f"segment cache hits: {len(segments) - len(missed)}/{len(segments)}")
+
+    rendered_durations = render_segments([segments[i] for i in missed])
+    for i, clip_duration in zip(missed, rendered_durations):
+        durations[i] = clip_duration
+        if clip_duration and segments[i].get("cache_key"):
+            segment_cache.put(segments[i]["cache_key"], segments[i]["clip_file"], ".mp4")
+    return durations
+
+
+def _merge_clips(processed_clips: List[SubClippedVideoClip], combined_video_path: str, threads: int) -> bool:
     # 一次性加载所有视频片段并合并
     logger.info(f"loading {len(processed_clips)} clips for batch merging")
+    output_dir = os.path.dirname(combined_video_path)
     video_clips = []
-    
+
     try:
         # 批量加载所有视频片段
         for i, clip_info in enumerate(processed_clips):
             logger.debug(f"loading clip {i+1}/{len(processed_clips)}: {clip_info.file_path}")
             clip = VideoFileClip(clip_info.file_path)
             video_clips.append(clip)
-        
+
         # 一次性合并所有片段
         logger.info("concatenating all clips at once...")
         merged_clip = concatenate_videoclips(video_clips)
-        
+
         # 写入最终合并结果
         merged_clip.write_videofile(
             filename=combined_video_path,
@@ -329,14 +853,15 @@ def combine_videos(
             bitrate=VideoQualityConfig.MERGE_BITRATE,  # 使用配置的合并文件码率
             preset=VideoQualityConfig.MERGE_PRESET,  # 使用配置的合并文件预设
         )
-        
+
         # 清理资源
         for clip in video_clips:
             close_clip(clip)
         close_clip(merged_clip)
-        
+
         logger.info("video combining completed successfully")
-        
+        return True
+
     except Exception as e:
         logger.error(f"failed to merge clips: {str(e)}")
         # 清理可能的残留资源
@@ -345,10 +870,113 @@ def combine_videos(
                 close_clip(clip)
             except:
                 pass
-        return None
+        return False
+
+
+def combine_videos(
+    combined_video_path: str,
+    video_paths: List[str],
+    audio_file: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    threads: int = 2,
+) -> str:
+    audio_duration = probe.probe(audio_file).duration
+    logger.info(f"audio duration: {audio_duration} seconds")
+    # Required duration of each clip
+    req_dur = audio_duration / len(video_paths)
+    req_dur = max_clip_duration
+    logger.info(f"maximum clip duration: {req_dur} seconds")
+    output_dir = os.path.dirname(combined_video_path)
+
+    aspect = VideoAspect(video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    processed_clips = []
+    video_duration = 0
+    subclipped_items = plan_subclips(video_paths, video_concat_mode, max_clip_duration)
+
+    # encode the sub clips concurrently until the duration of the audio has been reached,
+    # plan another batch from the remaining sub clips if some of them failed
+    pending_items = iter(subclipped_items)
+    clip_index = 0
+    while video_duration <= audio_duration:
+        segments = []
+        planned_duration = video_duration
+        for subclipped_item in pending_items:
+            clip_index += 1
+            transition, shuffle_side = pick_transition(video_transition_mode)
+            segments.append(
+                new_segment(
+                    subclipped_item,
+                    video_width,
+                    video_height,
+                    transition,
+                    shuffle_side,
+                    max_clip_duration,
+                    f"{output_dir}/temp-clip-{clip_index}.mp4",
+                )
+            )
+            planned_duration += min(subclipped_item.duration, max_clip_duration)
+            if planned_duration > audio_duration:
+                break
+        if not segments:
+            break
+
+        logger.info(f"processing {len(segments)} clips, current duration: {video_duration:.2f}s, audio duration: {audio_duration:.2f}s")
+        segment_durations = encode_segments(segments, max_clip_duration)
+        for segment, clip_duration in zip(segments, segment_durations):
+            if not clip_duration:
+                continue
+            processed_clips.append(
+                SubClippedVideoClip(
+                    file_path=segment["clip_file"],
+                    duration=clip_duration,
+                    width=segment["width"],
+                    height=segment["height"],
+                )
+            )
+            video_duration += clip_duration
+
+    # loop processed clips until the video duration matches or exceeds the audio duration.
+    if video_duration < audio_duration:
+        logger.warning(f"video duration ({video_duration:.2f}s) is shorter than audio duration ({audio_duration:.2f}s), looping clips to match audio length.")
+        base_clips = processed_clips.copy()
+        for clip in itertools.cycle(base_clips):
+            if video_duration >= audio_duration:
+                break
+            processed_clips.append(clip)
+            video_duration += clip.duration
+        logger.info(f"video duration: {video_duration:.2f}s, audio duration: {audio_duration:.2f}s, looped {len(processed_clips)-len(base_clips)} clips")
+     
+    # 优化：使用一次性合并替代逐个合并，大幅提升性能
+    logger.info("starting optimized clip merging process")
+    if not processed_clips:
+        logger.warning("no clips available for merging")
+        return combined_video_path
     
-    # 清理临时文件
+    # if there is only one clip, use it directly
+    if len(processed_clips) == 1:
+        logger.info("using single clip directly")
+        shutil.copy(processed_clips[0].file_path, combined_video_path)
+        delete_files([processed_clips[0].file_path])
+        logger.info("video combining completed")
+        return combined_video_path
+    
+    # all clips share the same encoding profile, join them by stream copy without re-encoding
     clip_files = [clip.file_path for clip in processed_clips]
+    try:
+        logger.info(f"concatenating {len(clip_files)} clips by stream copy")
+        ffmpeg.concat_copy(clip_files, combined_video_path)
+        logger.info("video combining completed successfully")
+    except Exception as e:
+        logger.warning(f"failed to concatenate clips by stream copy, re-encoding: {str(e)}")
+        if not _merge_clips(processed_clips, combined_video_path, threads):
+            return None
+
+    # 清理临时文件
     delete_files(clip_files)
             
     logger.info("video combining completed")
@@ -432,79 +1060,27 @@ def generate_video(
 
     font_path = ""
     if params.subtitle_enabled:
-        if not params.font_name:
-            params.font_name = "STHeitiMedium.ttc"
-        font_path = os.path.join(utils.font_dir(), params.font_name)
-        if os.name == "nt":
-            font_path = font_path.replace("\\", "/")
-
+        font_path = get_font_path(params)
         logger.info(f"  ⑤ font: {font_path}")
 
-    def create_text_clip(subtitle_item):
-        params.font_size = int(params.font_size)
-        params.stroke_width = int(params.stroke_width)
-        phrase = subtitle_item[1]
-        max_width = video_width * 0.9
-        wrapped_txt, txt_height = wrap_text(
-            phrase, max_width=max_width, font=font_path, fontsize=params.font_size
-        )
-        interline = int(params.font_size * 0.25)
-        size=(int(max_width), int(txt_height + params.font_size * 0.25 + (interline * (wrapped_txt.count("\n") + 1))))
-
-        _clip = TextClip(
-            text=wrapped_txt,
-            font=font_path,
-            font_size=params.font_size,
-            color=params.text_fore_color,
-            bg_color=params.text_background_color,
-            stroke_color=params.stroke_color,
-            stroke_width=params.stroke_width,
-            # interline=interline,
-            # size=size,
-        )
-        duration = subtitle_item[0][1] - subtitle_item[0][0]
-        _clip = _clip.with_start(subtitle_item[0][0])
-        _clip = _clip.with_end(subtitle_item[0][1])
-        _clip = _clip.with_duration(duration)
-        if params.subtitle_position == "bottom":
-            _clip = _clip.with_position(("center", video_height * 0.95 - _clip.h))
-        elif params.subtitle_position == "top":
-            _clip = _clip.with_position(("center", video_height * 0.05))
-        elif params.subtitle_position == "custom":
-            # Ensure the subtitle is fully within the screen bounds
-            margin = 10  # Additional margin, in pixels
-            max_y = video_height - _clip.h - margin
-            min_y = margin
-            custom_y = (video_height - _clip.h) * (params.custom_position / 100)
-            custom_y = max(
-                min_y, min(custom_y, max_y)
-            )  # Constrain the y value within the valid range
-            _clip = _clip.with_position(("center", custom_y))
-        else:  # center
-            _clip = _clip.with_position(("center", "center"))
-        return _clip
-
     video_clip = VideoFileClip(video_path).without_audio()
     audio_clip = AudioFileClip(audio_path).with_effects(
         [afx.MultiplyVolume(params.voice_volume)]
     )
 
-    def make_textclip(text):
-        return TextClip(
-            text=text,
-            font=font_path,
-            font_size=params.font_size,
-        )
-
+    ffmpeg_params = []
+    ass_file = ""
     if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(
-            subtitles=subtitle_path, encoding="utf-8", make_textclip=make_textclip
-        )
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
+        if params.subtitle_renderer == "ass":
+            # 字幕在编码时由 ffmpeg 烧录，不再逐帧在 python 中合成
+            ass_file = create_ass_subtitles(
+                subtitle_path, params, video_width, video_height, f"{output_file}.ass"
+            )
+            ffmpeg_params = ["-vf", get_subtitles_filter(ass_file)]
+        else:
+            video_clip = add_subtitles(
+                video_clip, subtitle_path, params, video_width, video_height
+            )
 
     bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
     if bgm_file:
@@ -521,6 +1097,8 @@ def generate_video(
             logger.error(f"failed to add bgm: {str(e)}")
 
     video_clip = video_clip.with_audio(audio_clip)
+    encode_profile = get_encode_profile(params.encode_profile)
+    start_time = time.time()
     video_clip.write_videofile(
         output_file,
         audio_codec=audio_codec,
@@ -528,19 +1106,22 @@ def generate_video(
         threads=params.n_threads or 2,
         logger=None,
         fps=fps,
-        bitrate=VideoQualityConfig.FINAL_BITRATE,  # 使用配置的最终文件码率
-        preset=VideoQualityConfig.FINAL_PRESET,  # 使用配置的最终文件预设
+        preset=encode_profile.preset,  # 使用编码档位的预设
         # 添加更多质量控制参数
         ffmpeg_params=[
-            "-crf", VideoQualityConfig.FINAL_CRF,  # 使用配置的CRF值
+            *encode_profile.rate_control_args(),  # 使用编码档位的 CRF 或码率
             "-profile:v", "high",  # 使用高质量配置文件
             "-level", "4.1",  # 设置编码级别
             "-pix_fmt", "yuv420p",  # 确保兼容性
             "-movflags", "+faststart",  # 支持流式播放
+            *ffmpeg_params,
         ]
     )
+    record_encode(encode_profile, video_clip.duration, time.time() - start_time)
     video_clip.close()
     del video_clip
+    if ass_file:
+        delete_files(ass_file)
 
 
 def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
@@ -549,13 +1130,11 @@ def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
             continue
 
         ext = utils.parse_extension(material.url)
-        try:
-            clip = VideoFileClip(material.url)
-        except Exception:
-            clip = ImageClip(material.url)
-
-        width = clip.size[0]
-        height = clip.size[1]
+        if ext in const.FILE_TYPE_IMAGES:
+            with Image.open(material.url) as image:
+                width, height = image.size
+        else:
+            width, height = probe.probe(material.url).size
         if width < 480 or height < 480:
             logger.warning(f"low resolution material: {width}x{height}, minimum 480x480 required")
             continue
@@ -621,7 +1200,27 @@ def generate_video_directly(
         生成的视频文件路径
     """
     logger.info("🚀 开始一步到位视频生成流程")
-    
+
+    if params.render_engine == "ffmpeg":
+        try:
+            result = generate_video_ffmpeg(
+                video_paths=video_paths,
+                audio_file=audio_file,
+                subtitle_path=subtitle_path,
+                output_file=output_file,
+                params=params,
+                video_aspect=video_aspect,
+                video_concat_mode=video_concat_mode,
+                video_transition_mode=video_transition_mode,
+                max_clip_duration=max_clip_duration,
+                threads=threads,
+            )
+            if result:
+                return result
+        except Exception as e:
+            logger.error(f"ffmpeg 渲染引擎失败: {str(e)}")
+        logger.warning("回退到 moviepy 渲染引擎")
+
     # 1. 准备音频和字幕
     audio_clip = AudioFileClip(audio_file)
     audio_duration = audio_clip.duration
@@ -635,35 +1234,11 @@ def generate_video_directly(
     
     # 3. 处理视频片段（内存中处理，不保存临时文件）
     logger.info("📹 直接处理视频片段（跳过临时文件）")
-    processed_clips = []
     video_duration = 0
     
-    # 准备子片段列表
-    subclipped_items = []
-    for video_path in video_paths:
-        clip = VideoFileClip(video_path)
-        clip_duration = clip.duration
-        clip_w, clip_h = clip.size
-        close_clip(clip)
-        
-        start_time = 0
-        while start_time < clip_duration:
-            end_time = min(start_time + max_clip_duration, clip_duration)
-            if clip_duration - start_time >= max_clip_duration:
-                subclipped_items.append(SubClippedVideoClip(
-                    file_path=video_path, 
-                    start_time=start_time, 
-                    end_time=end_time, 
-                    width=clip_w, 
-                    height=clip_h
-                ))
-            start_time = end_time
-            if video_concat_mode.value == VideoConcatMode.sequential.value:
-                break
-    
-    # 随机排序
-    if video_concat_mode.value == VideoConcatMode.random.value:
-        random.shuffle(subclipped_items)
+    # 准备子片段列表（随机模式下已打乱顺序）
+    subclipped_items = plan_subclips(video_paths, video_concat_mode, max_clip_duration)
+    segment_cache = get_segment_cache()
     
     # 4. 直接处理成最终可用的视频片段
     video_clips = []
@@ -674,51 +1249,31 @@ def generate_video_directly(
         logger.debug(f"直接处理片段 {i+1}: {subclipped_item.file_path}")
         
         try:
-            # 加载和处理片段
-            clip = VideoFileClip(subclipped_item.file_path).subclipped(
-                subclipped_item.start_time, subclipped_item.end_time
-            )
-            
-            # 调整尺寸
-            if clip.size != (video_width, video_height):
-                clip_ratio = clip.w / clip.h
-                video_ratio = video_width / video_height
-                
-                if clip_ratio == video_ratio:
-                    clip = clip.resized(new_size=(video_width, video_height))
-                else:
-                    if clip_ratio > video_ratio:
-                        scale_factor = video_width / clip.w
-                    else:
-                        scale_factor = video_height / clip.h
-                    
-                    new_width = int(clip.w * scale_factor)
-                    new_height = int(clip.h * scale_factor)
-                    
-                    background = ColorClip(size=(video_width, video_height), color=(0, 0, 0)).with_duration(clip.duration)
-                    clip_resized = clip.resized(new_size=(new_width, new_height)).with_position("center")
-                    clip = CompositeVideoClip([background, clip_resized])
-            
-            # 添加转场效果
-            if video_transition_mode and video_transition_mode.value != VideoTransitionMode.none.value:
-                shuffle_side = random.choice(["left", "right", "top", "bottom"])
-                if video_transition_mode.value == VideoTransitionMode.fade_in.value:
-                    clip = video_effects.fadein_transition(clip, 1)
-                elif video_transition_mode.value == VideoTransitionMode.fade_out.value:
-                    clip = video_effects.fadeout_transition(clip, 1)
-                elif video_transition_mode.value == VideoTransitionMode.slide_in.value:
-                    clip = video_effects.slidein_transition(clip, 1, shuffle_side)
-                elif video_transition_mode.value == VideoTransitionMode.slide_out.value:
-                    clip = video_effects.slideout_transition(clip, 1, shuffle_side)
-                elif video_transition_mode.value == VideoTransitionMode.shuffle.value:
-                    transition_funcs = [
-                        lambda c: video_effects.fadein_transition(c, 1),
-                        lambda c: video_effects.fadeout_transition(c, 1),
-                        lambda c: video_effects.slidein_transition(c, 1, shuffle_side),
-                        lambda c: video_effects.slideout_transition(c, 1, shuffle_side),
-                    ]
-                    shuffle_transition = random.choice(transition_funcs)
-                    clip = shuffle_transition(clip)
+            transition, shuffle_side = pick_transition(video_transition_mode)
+            cached_file = ""
+            if segment_cache:
+                cached_file = segment_cache.get(
+                    get_segment_cache_key(
+                        subclipped_item, video_width, video_height, transition, shuffle_side, max_clip_duration
+                    ),
+                    ".mp4",
+                )
+
+            if cached_file:
+                # 命中片段缓存，直接使用已调整尺寸和转场的片段
+                logger.debug(f"片段缓存命中: {cached_file}")
+                clip = VideoFileClip(cached_file).without_audio()
+            else:
+                # 加载和处理片段
+                clip = VideoFileClip(subclipped_item.file_path).subclipped(
+                    subclipped_item.start_time, subclipped_item.end_time
+                )
+
+                # 调整尺寸
+                clip = resize_clip(clip, video_width, video_height)
+
+                # 添加转场效果
+                clip = apply_transition(clip, transition, shuffle_side)
             
             # 限制片段时长
             if clip.duration > max_clip_duration:
@@ -735,7 +1290,6 @@ def generate_video_directly(
     if video_duration < audio_duration:
         logger.info(f"视频时长不够，循环使用片段: {video_duration:.2f}s < {audio_duration:.2f}s")
         base_clips = video_clips.copy()
-        import itertools
         for clip in itertools.cycle(base_clips):
             if video_duration >= audio_duration:
                 break
@@ -755,65 +1309,17 @@ def generate_video_directly(
         video_clip = concatenate_videoclips(video_clips)
     
     # 7. 添加字幕
+    ffmpeg_params = []
+    ass_file = ""
     if subtitle_path and os.path.exists(subtitle_path) and params.subtitle_enabled:
         logger.info("📝 添加字幕")
-        
-        # 准备字体路径
-        font_path = ""
-        if not params.font_name:
-            params.font_name = "STHeitiMedium.ttc"
-        font_path = os.path.join(utils.font_dir(), params.font_name)
-        if os.name == "nt":
-            font_path = font_path.replace("\\", "/")
-        
-        def create_text_clip(subtitle_item):
-            params.font_size = int(params.font_size)
-            params.stroke_width = int(params.stroke_width)
-            phrase = subtitle_item[1]
-            max_width = video_width * 0.9
-            wrapped_txt, txt_height = wrap_text(
-                phrase, max_width=max_width, font=font_path, fontsize=params.font_size
-            )
-            
-            _clip = TextClip(
-                text=wrapped_txt,
-                font=font_path,
-                font_size=params.font_size,
-                color=params.text_fore_color,
-                bg_color=params.text_background_color,
-                stroke_color=params.stroke_color,
-                stroke_width=params.stroke_width,
+        if params.subtitle_renderer == "ass":
+            ass_file = create_ass_subtitles(
+                subtitle_path, params, video_width, video_height, f"{output_file}.ass"
             )
-            
-            duration = subtitle_item[0][1] - subtitle_item[0][0]
-            _clip = _clip.with_start(subtitle_item[0][0]).with_end(subtitle_item[0][1]).with_duration(duration)
-            
-            if params.subtitle_position == "bottom":
-                _clip = _clip.with_position(("center", video_height * 0.95 - _clip.h))
-            elif params.subtitle_position == "top":
-                _clip = _clip.with_position(("center", video_height * 0.05))
-            elif params.subtitle_position == "custom":
-                margin = 10
-                max_y = video_height - _clip.h - margin
-                min_y = margin
-                custom_y = (video_height - _clip.h) * (params.custom_position / 100)
-                custom_y = max(min_y, min(custom_y, max_y))
-                _clip = _clip.with_position(("center", custom_y))
-            else:
-                _clip = _clip.with_position(("center", "center"))
-            
-            return _clip
-        
-        def make_textclip(text):
-            return TextClip(text=text, font=font_path, font_size=params.font_size)
-        
-        sub = SubtitlesClip(subtitles=subtitle_path, encoding="utf-8", make_textclip=make_textclip)
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
+            ffmpeg_params = ["-vf", get_subtitles_filter(ass_file)]
+        else:
+            video_clip = add_subtitles(video_clip, subtitle_path, params, video_width, video_height)
     
     # 8. 添加背景音乐
     final_audio = audio_clip
@@ -836,6 +1342,8 @@ def generate_video_directly(
     # 10. 一次性输出最终视频（只编码一次！）
     logger.info("💾 一次性输出最终视频")
     output_dir = os.path.dirname(output_file)
+    encode_profile = get_encode_profile(params.encode_profile)
+    start_time = time.time()
     
     video_clip.write_videofile(
         output_file,
@@ -844,18 +1352,22 @@ def generate_video_directly(
         threads=threads,
         logger=None,
         fps=fps,
-        bitrate=VideoQualityConfig.FINAL_BITRATE,
-        preset=VideoQualityConfig.FINAL_PRESET,
+        preset=encode_profile.preset,
         ffmpeg_params=[
-            "-crf", VideoQualityConfig.FINAL_CRF,
+            *encode_profile.rate_control_args(),
             "-profile:v", "high",
             "-level", "4.1",
             "-pix_fmt", "yuv420p",
             "-movflags", "+faststart",
+            *ffmpeg_params,
         ]
     )
     
+    record_encode(encode_profile, video_clip.duration, time.time() - start_time)
+    
     # 11. 清理资源
+    if ass_file:
+        delete_files(ass_file)
     for clip in video_clips:
         close_clip(clip)
     close_clip(video_clip)
@@ -864,4 +1376,383 @@ def generate_video_directly(
         close_clip(bgm_clip)
     
     logger.success("✅ 一步到位视频生成完成")
-    return output_file
\ No newline at end of file
+    return output_file
+
+def _ffmpeg_slide_position(transition: str, side: str, duration: float):
+    """
+    overlay x/y expressions that match moviepy's SlideIn/SlideOut effects (1 second long)
+    """
+    ts = max(0.0, duration - 1)
+    if transition == VideoTransitionMode.slide_in.value:
+        positions = {
+            "left": ("min(0,w*(t-1))", "0"),
+            "right": ("max(0,w*(1-t))", "0"),
+            "top": ("0", "min(0,h*(t-1))"),
+            "bottom": ("0", "max(0,h*(1-t))"),
+        }
+    else:
+        positions = {
+            "left": (f"min(0,w*({ts:.3f}-t))", "0"),
+            "right": (f"max(0,w*(t-{ts:.3f}))", "0"),
+            "top": ("0", f"min(0,h*({ts:.3f}-t))"),
+            "bottom": ("0", f"max(0,h*(t-{ts:.3f}))"),
+        }
+    return positions.get(side, positions["left"])
+
+
+def _ffmpeg_segment_filter(
+    index: int,
+    duration: float,
+    transition: str,
+    side: str,
+    video_width: int,
+    video_height: int,
+) -> str:
+    # resize and letterbox the sub clip, same as the moviepy path does with ColorClip + CompositeVideoClip
+    chain = (
+        f"[{index}:v]scale={video_width}:{video_height}:force_original_aspect_ratio=decrease:force_divisible_by=2,"
+        f"pad={video_width}:{video_height}:(ow-iw)/2:(oh-ih)/2:color=black,setsar=1,"
+        f"fps={fps},format=yuv420p,trim=duration={duration:.3f},setpts=PTS-STARTPTS"
+    )
+    if transition == VideoTransitionMode.fade_in.value:
+        return f"{chain},fade=t=in:st=0:d=1[v{index}]"
+    if transition == VideoTransitionMode.fade_out.value:
+        return f"{chain},fade=t=out:st={max(0.0, duration - 1):.3f}:d=1[v{index}]"
+    if transition in (
+        VideoTransitionMode.slide_in.value,
+        VideoTransitionMode.slide_out.value,
+    ):
+        x, y = _ffmpeg_slide_position(transition, side, duration)
+        return (
+            f"{chain}[s{index}];"
+            f"color=c=black:s={video_width}x{video_height}:r={fps}:d={duration:.3f}[bg{index}];"
+            f"[bg{index}][s{index}]overlay=x='{x}':y='{y}':eval=frame:shortest=1,format=yuv420p[v{index}]"
+        )
+    return f"{chain}[v{index}]"
+
+
+def _rasterize_subtitles(
+    subtitle_path: str,
+    params: VideoParams,
+    video_width: int,
+    video_height: int,
+    work_dir: str,
+):
+    """
+    render every subtitle line once into a transparent png,
+    returns a list of (png_file, x, y, start_time, end_time)
+    """
+    images = []
+    sprites = create_subtitle_sprites(subtitle_path, params, video_width, video_height)
+    for i, sprite in enumerate(sprites):
+        image_file = os.path.join(work_dir, f"subtitle-{i + 1}.png")
+        Image.fromarray(sprite.image, "RGBA").save(image_file)
+        images.append((image_file, sprite.x, sprite.y, sprite.start, sprite.end))
+    return images
+
+
+def _prepare_subtitles(
+    subtitle_path: str,
+    params: VideoParams,
+    video_width: int,
+    video_height: int,
+    work_dir: str,
+):
+    """
+    the subtitle images to overlay and the ass file to burn in, depending on the subtitle renderer
+    """
+    if not (subtitle_path and os.path.exists(subtitle_path) and params.subtitle_enabled):
+        return [], ""
+    if params.subtitle_renderer == "ass":
+        ass_file = os.path.join(work_dir, "subtitle.ass")
+        return [], create_ass_subtitles(subtitle_path, params, video_width, video_height, ass_file)
+    return _rasterize_subtitles(subtitle_path, params, video_width, video_height, work_dir), ""
+
+
+def _ffmpeg_compose(
+    inputs: List[str],
+    filters: List[str],
+    video_label: str,
+    input_index: int,
+    subtitle_images: list,
+    audio_file: str,
+    params: VideoParams,
+    video_duration: float,
+    output_file: str,
+    work_dir: str,
+    threads: int,
+    ass_file: str = "",
+):
+    """
+    overlay the rasterized subtitles (or burn in the ass file) on the video labelled video_label, mix in
+    the voice and the background music and encode the final video, input_index is the index of the next input
+    """
+    inputs = list(inputs)
+    filters = list(filters)
+
+    if ass_file:
+        filters.append(f"[{video_label}]{get_subtitles_filter(ass_file)}[subs]")
+        video_label = "subs"
+
+    # subtitles, every line is overlaid only while it is on screen
+    for i, (image_file, x, y, start_time, end_time) in enumerate(subtitle_images):
+        inputs += ["-i", image_file]
+        filters.append(
+            f"[{video_label}][{input_index}:v]overlay=x={x}:y={y}:"
+            f"enable='between(t,{start_time:.3f},{end_time:.3f})'[sub{i}]"
+        )
+        video_label = f"sub{i}"
+        input_index += 1
+
+    # voice and background music
+    inputs += ["-i", audio_file]
+    filters.append(f"[{input_index}:a]volume={params.voice_volume}[voice]")
+    audio_label = "voice"
+    input_index += 1
+
+    bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+    if bgm_file:
+        inputs += ["-stream_loop", "-1", "-i", bgm_file]
+        fade_start = max(0.0, video_duration - 3)
+        filters.append(
+            f"[{input_index}:a]volume={params.bgm_volume},atrim=0:{video_duration:.3f},"
+            f"afade=t=out:st={fade_start:.3f}:d=3[bgm]"
+        )
+        filters.append(
+            "[voice][bgm]amix=inputs=2:duration=longest:dropout_transition=0:normalize=0[aout]"
+        )
+        audio_label = "aout"
+
+    # long graphs (one overlay per subtitle line) may exceed the command line limit on windows
+    filter_script = os.path.join(work_dir, "filter_complex.txt")
+    with open(filter_script, "w", encoding="utf-8") as f:
+        f.write(";\n".join(filters))
+
+    encode_profile = get_encode_profile(params.encode_profile)
+    start_time = time.time()
+    ffmpeg.run(
+        [
+            *inputs,
+            "-filter_complex_script", filter_script,
+            "-map", f"[{video_label}]",
+            "-map", f"[{audio_label}]",
+            "-t", f"{video_duration:.3f}",
+            "-r", str(fps),
+            "-c:v", video_codec,
+            *encode_profile.ffmpeg_args(),
+            "-profile:v", "high",
+            "-level", "4.1",
+            "-pix_fmt", "yuv420p",
+            "-c:a", audio_codec,
+            "-threads", str(threads or 2),
+            "-movflags", "+faststart",
+            output_file,
+        ]
+    )
+    record_encode(encode_profile, video_duration, time.time() - start_time)
+
+
+def generate_video_ffmpeg(
+    video_paths: List[str],
+    audio_file: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    threads: int = 2,
+) -> str:
+    """
+    render the final video with a single ffmpeg filter_complex invocation,
+    the video frames are decoded, composited and encoded inside ffmpeg and never cross into python.
+    takes the same inputs as generate_video_directly
+    """
+    logger.info("rendering video with the ffmpeg engine")
+    aspect = VideoAspect(video_aspect)
+    video_width, video_height = aspect.to_resolution()
+    output_dir = os.path.dirname(output_file)
+
+    audio_duration = probe.probe(audio_file).duration
+
+    subclipped_items = plan_subclips(video_paths, video_concat_mode, max_clip_duration)
+    segments, video_duration = select_subclips(
+        subclipped_items, audio_duration, max_clip_duration
+    )
+    if not segments:
+        logger.error("no clips available for rendering")
+        return None
+    logger.info(
+        f"segments: {len(segments)}, video duration: {video_duration:.2f}s, audio duration: {audio_duration:.2f}s"
+    )
+
+    work_dir = os.path.join(output_dir, f"ffmpeg-{utils.get_uuid(remove_hyphen=True)}")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        inputs = []
+        filters = []
+
+        # 1. sub clips, seek on the input side so only the used range is decoded
+        segment_cache = get_segment_cache()
+        cache_hits = 0
+        for i, item in enumerate(segments):
+            duration = min(item.duration, max_clip_duration)
+            transition, side = pick_transition(video_transition_mode)
+            cached_file = ""
+            if segment_cache:
+                cached_file = segment_cache.get(
+                    get_segment_cache_key(
+                        item, video_width, video_height, transition, side, max_clip_duration
+                    ),
+                    ".mp4",
+                )
+            if cached_file:
+                # the cached segment is already resized and has the transition applied
+                cache_hits += 1
+                inputs += ["-t", f"{duration:.3f}", "-i", cached_file]
+                transition, side = None, None
+            else:
+                inputs += ["-ss", f"{item.start_time:.3f}", "-t", f"{duration:.3f}", "-i", item.file_path]
+            filters.append(
+                _ffmpeg_segment_filter(i, duration, transition, side, video_width, video_height)
+            )
+        if segment_cache:
+            logger.info(f"segment cache hits: {cache_hits}/{len(segments)}")
+        concat_labels = "".join(f"[v{i}]" for i in range(len(segments)))
+        filters.append(f"{concat_labels}concat=n={len(segments)}:v=1:a=0[vcat]")
+        video_label = "vcat"
+        input_index = len(segments)
+
+        # 2. subtitles, voice and background music
+        images, ass_file = _prepare_subtitles(
+            subtitle_path, params, video_width, video_height, work_dir
+        )
+        _ffmpeg_compose(
+            inputs,
+            filters,
+            video_label,
+            input_index,
+            images,
+            audio_file,
+            params,
+            video_duration,
+            output_file,
+            work_dir,
+            threads,
+            ass_file,
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    logger.success(f"ffmpeg engine completed: {output_file}")
+    return output_file
+
+
+def generate_videos_batch(
+    video_paths: List[str],
+    audio_file: str,
+    subtitle_path: str,
+    output_files: List[str],
+    params: VideoParams,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    threads: int = 2,
+    on_variant: Callable[[int], None] = None,
+) -> List[str]:
+    """
+    render several variants of a video from the same materials, audio and subtitles with the ffmpeg engine.
+    the timelines of all the variants are planned first, then every distinct sub clip is normalized once
+    and the subtitles are rasterized once, the variants only differ in the order of the sub clips.
+    on_variant is called with the number of variants done after each one
+    """
+    aspect = VideoAspect(video_aspect)
+    video_width, video_height = aspect.to_resolution()
+    output_dir = os.path.dirname(output_files[0])
+    audio_duration = probe.probe(audio_file).duration
+
+    # 1. plan the timeline of every variant
+    subclipped_items = plan_subclips(video_paths, VideoConcatMode.random, max_clip_duration)
+    if not subclipped_items:
+        logger.error("no clips available for rendering")
+        return []
+    timelines = []
+    for i in range(len(output_files)):
+        items = subclipped_items if i == 0 else random.sample(subclipped_items, len(subclipped_items))
+        selected, _ = select_subclips(items, audio_duration, max_clip_duration)
+        timelines.append(selected)
+
+    work_dir = os.path.join(output_dir, f"batch-{utils.get_uuid(remove_hyphen=True)}")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        # 2. normalize every distinct sub clip once, with a transition shared by all the variants
+        segments = {}
+        for timeline in timelines:
+            for item in timeline:
+                key = (item.file_path, item.start_time, item.end_time)
+                if key not in segments:
+                    transition, side = pick_transition(video_transition_mode)
+                    segments[key] = new_segment(
+                        item,
+                        video_width,
+                        video_height,
+                        transition,
+                        side,
+                        max_clip_duration,
+                        os.path.join(work_dir, f"segment-{len(segments) + 1}.mp4"),
+                    )
+        logger.info(
+            f"rendering {len(output_files)} variants, {sum(len(t) for t in timelines)} clips from {len(segments)} distinct segments"
+        )
+        durations = dict(
+            zip(segments, encode_segments(list(segments.values()), max_clip_duration))
+        )
+
+        # 3. rasterize (or convert) the subtitles once
+        images, ass_file = _prepare_subtitles(
+            subtitle_path, params, video_width, video_height, work_dir
+        )
+
+        # 4. join the segments of each variant by stream copy and compose it
+        results = []
+        for i, (output_file, timeline) in enumerate(zip(output_files, timelines)):
+            keys = [
+                key
+                for key in ((item.file_path, item.start_time, item.end_time) for item in timeline)
+                if durations.get(key)
+            ]
+            if not keys:
+                logger.error(f"no clips available for variant: {output_file}")
+                continue
+            video_duration = sum(durations[key] for key in keys)
+            # loop the clips if some of them failed to render
+            for key in itertools.cycle(list(keys)):
+                if video_duration >= audio_duration:
+                    break
+                keys.append(key)
+                video_duration += durations[key]
+
+            timeline_file = os.path.join(work_dir, f"timeline-{i + 1}.mp4")
+            ffmpeg.concat_copy([segments[key]["clip_file"] for key in keys], timeline_file)
+            _ffmpeg_compose(
+                ["-i", timeline_file],
+                ["[0:v]null[vcat]"],
+                "vcat",
+                1,
+                images,
+                audio_file,
+                params,
+                video_duration,
+                output_file,
+                work_dir,
+                threads,
+                ass_file,
+            )
+            logger.success(f"variant rendered: {output_file}")
+            results.append(output_file)
+            if on_variant:
+                on_variant(i + 1)
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import re
 from datetime import datetime
@@ -13,8 +14,13 @@ from loguru import logger
 from moviepy.video.tools import subtitles
 
 from app.config import config
+from app.models import const
+from app.services import cache, probe
+from app.services.utils import ffmpeg
 from app.utils import utils
 
+_tts_cache = None
+
 
 def get_siliconflow_voices() -> list[str]:
     """
@@ -1077,12 +1083,195 @@ def is_siliconflow_voice(voice_name: str):
     return voice_name.startswith("siliconflow:")
 
 
+def get_tts_cache():
+    """
+    the cache of synthesized speech, None if it is disabled
+    """
+    global _tts_cache
+    if _tts_cache is None and config.app.get("enable_tts_cache", True):
+        max_size = int(config.app.get("tts_cache_max_size", 512)) * 1024 * 1024
+        _tts_cache = cache.FileCache(
+            utils.storage_dir("cache_tts", create=True), max_size
+        )
+    return _tts_cache
+
+
+def get_tts_cache_key(
+    text: str, voice_name: str, voice_rate: float, voice_volume: float
+) -> str:
+    if is_azure_v2_voice(voice_name):
+        provider = "azure_v2"
+    elif is_siliconflow_voice(voice_name):
+        provider = "siliconflow"
+    else:
+        provider = "edge"
+    text = " ".join(text.split())
+    return utils.md5(
+        f"{provider}|{voice_name}|{float(voice_rate)}|{float(voice_volume)}|{text}"
+    )
+
+
+def _load_cached_tts(key: str, voice_file: str) -> Union[SubMaker, None]:
+    tts_cache = get_tts_cache()
+    sub_file = tts_cache.get(key, ".json")
+    if not sub_file:
+        return None
+    suffix = os.path.splitext(voice_file)[1]
+    try:
+        with open(sub_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"invalid cached subtitle data: {sub_file} => {str(e)}")
+        return None
+    if not tts_cache.fetch(key, voice_file, suffix):
+        return None
+
+    sub_maker = SubMaker()
+    sub_maker.subs = data["subs"]
+    sub_maker.offset = [tuple(offset) for offset in data["offset"]]
+    logger.info(f"tts cache hit, output file: {voice_file}")
+    return sub_maker
+
+
+def _save_cached_tts(key: str, voice_file: str, sub_maker: SubMaker):
+    tts_cache = get_tts_cache()
+    sub_file = f"{voice_file}.{utils.get_uuid(remove_hyphen=True)}.json"
+    try:
+        with open(sub_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {"subs": sub_maker.subs, "offset": sub_maker.offset},
+                f,
+                ensure_ascii=False,
+            )
+        # the audio goes first, a cached entry is only complete once its subtitle data exists
+        if tts_cache.put(key, voice_file, os.path.splitext(voice_file)[1]):
+            tts_cache.put(key, sub_file, ".json")
+    except OSError as e:
+        logger.warning(f"failed to cache tts: {voice_file} => {str(e)}")
+    finally:
+        if os.path.exists(sub_file):
+            os.remove(sub_file)
+
+
 def tts(
     text: str,
     voice_name: str,
     voice_rate: float,
     voice_file: str,
     voice_volume: float = 1.0,
+) -> Union[SubMaker, None]:
+    if not get_tts_cache():
+        return _tts_in_chunks(text, voice_name, voice_rate, voice_file, voice_volume)
+
+    # the same narration is often synthesized again, e.g. when a task is rendered with another subtitle style
+    key = get_tts_cache_key(text, voice_name, voice_rate, voice_volume)
+    sub_maker = _load_cached_tts(key, voice_file)
+    if sub_maker:
+        return sub_maker
+
+    sub_maker = _tts_in_chunks(text, voice_name, voice_rate, voice_file, voice_volume)
+    if sub_maker and sub_maker.subs and os.path.exists(voice_file):
+        _save_cached_tts(key, voice_file, sub_maker)
+    return sub_maker
+
+
+def split_tts_chunks(text: str, max_length: int = 300) -> list[str]:
+    """
+    split the text at punctuations into chunks of at most max_length characters.
+    unlike utils.split_string_by_punctuations the punctuations are kept, they matter for the prosody.
+    """
+    sentences = []
+    sentence = ""
+    for i, char in enumerate(text):
+        sentence += char
+        if char == "." and 0 < i < len(text) - 1:
+            # "2.5" is not the end of a sentence
+            if text[i - 1].isdigit() and text[i + 1].isdigit():
+                continue
+        if char in const.PUNCTUATIONS or char == "\n":
+            sentences.append(sentence)
+            sentence = ""
+    sentences.append(sentence)
+
+    chunks = []
+    chunk = ""
+    for sentence in sentences:
+        if chunk.strip() and len(chunk) + len(sentence) > max_length:
+            chunks.append(chunk.strip())
+            chunk = ""
+        chunk += sentence
+    if chunk.strip():
+        chunks.append(chunk.strip())
+    return chunks
+
+
+def _tts_in_chunks(
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    voice_volume: float = 1.0,
+) -> Union[SubMaker, None]:
+    """
+    synthesize the chunks of a long text concurrently and stitch the audio and the word boundaries together
+    """
+    concurrency = int(config.app.get("tts_concurrency", 4))
+    chunks = split_tts_chunks(text)
+    if concurrency <= 1 or len(chunks) <= 1:
+        return _tts(text, voice_name, voice_rate, voice_file, voice_volume)
+
+    logger.info(f"synthesizing {len(chunks)} chunks, concurrency: {concurrency}")
+    suffix = os.path.splitext(voice_file)[1]
+    chunk_files = [f"{voice_file}.chunk-{i}{suffix}" for i in range(len(chunks))]
+
+    async def _do() -> list:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _synthesize(chunk: str, chunk_file: str):
+            async with semaphore:
+                return await asyncio.to_thread(
+                    _tts, chunk, voice_name, voice_rate, chunk_file, voice_volume
+                )
+
+        return await asyncio.gather(
+            *[_synthesize(chunk, chunk_file) for chunk, chunk_file in zip(chunks, chunk_files)]
+        )
+
+    try:
+        sub_makers = asyncio.run(_do())
+        for chunk, sub_maker in zip(chunks, sub_makers):
+            if not sub_maker or not sub_maker.subs:
+                logger.error(f"failed to synthesize chunk: {chunk}")
+                return None
+
+        ffmpeg.concat_copy(chunk_files, voice_file)
+
+        # offsets are in 100 nanoseconds, each chunk starts where the audio of the previous one ends
+        merged = SubMaker()
+        start = 0
+        for sub_maker, chunk_file in zip(sub_makers, chunk_files):
+            merged.subs.extend(sub_maker.subs)
+            merged.offset.extend(
+                (offset[0] + start, offset[1] + start) for offset in sub_maker.offset
+            )
+            start += round(probe.probe(chunk_file).duration * 10000000)
+        logger.info(f"completed, output file: {voice_file}")
+        return merged
+    except Exception as e:
+        logger.error(f"failed to synthesize chunks: {str(e)}")
+        return None
+    finally:
+        for chunk_file in chunk_files:
+            if os.path.exists(chunk_file):
+                os.remove(chunk_file)
+
+
+def _tts(
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    voice_volume: float = 1.0,
 ) -> Union[SubMaker, None]:
     if is_azure_v2_voice(voice_name):
         return azure_tts_v2(text, voice_name, voice_file)
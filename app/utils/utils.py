@@ -73,7 +73,7 @@ def storage_dir(sub_dir: str = "", create: bool = False):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if create and not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
 
     return d
 
@@ -90,7 +90,7 @@ def task_dir(sub_dir: str = ""):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
     return d
 
 
@@ -99,7 +99,7 @@ def font_dir(sub_dir: str = ""):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
     return d
 
 
@@ -108,7 +108,7 @@ def song_dir(sub_dir: str = ""):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
     return d
 
 
@@ -117,7 +117,7 @@ def public_dir(sub_dir: str = ""):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
     return d
 
 
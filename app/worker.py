@@ -0,0 +1,194 @@
+"""
+worker daemon that runs the tasks of the redis task queue, start one or more on any machine:
+
+    python -m app.worker --workers 2
+
+tasks are taken by priority and tenant (see RedisFairQueue), every worker moves the task it takes into
+its own processing list and keeps a heartbeat key alive, the tasks of a worker whose heartbeat expired
+are put back on the queue by the other workers, a task is run at most worker_max_attempts times.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+import redis
+from loguru import logger
+
+from app.config import config
+from app.controllers.manager.fair_queue import RedisFairQueue
+from app.controllers.manager.redis_manager import (
+    deserialize_task,
+    get_queue_name,
+    migrate_legacy_queue,
+)
+from app.models import const
+from app.services import state as sm
+from app.utils import utils
+
+_prefix = config.app.get("redis_key_prefix", "mpt")
+_heartbeat_interval = config.app.get("worker_heartbeat_interval", 10)
+_max_attempts = config.app.get("worker_max_attempts", 3)
+
+
+def get_redis_client() -> redis.Redis:
+    return redis.StrictRedis(
+        host=config.app.get("redis_host", "localhost"),
+        port=config.app.get("redis_port", 6379),
+        db=config.app.get("redis_db", 0),
+        password=config.app.get("redis_password", None),
+    )
+
+
+def _workers_key() -> str:
+    return f"{_prefix}:workers"
+
+
+def _heartbeat_key(worker_id: str) -> str:
+    return f"{_prefix}:worker:{worker_id}"
+
+
+def _processing_key(worker_id: str) -> str:
+    # 与队列在同一个 hash tag 下，出队脚本在同一步中写入
+    return f"{get_queue_name()}:processing:{worker_id}"
+
+
+def requeue_dead_workers(redis_client: redis.Redis) -> int:
+    """
+    put the tasks of the workers without a heartbeat back on the queue, returns the number of tasks.
+    a task that already took down worker_max_attempts workers is marked as failed instead
+    """
+    queue = RedisFairQueue(redis_client, get_queue_name())
+    requeued = 0
+    for worker_id in redis_client.smembers(_workers_key()):
+        worker_id = worker_id.decode("utf-8")
+        if redis_client.exists(_heartbeat_key(worker_id)):
+            continue
+        # a task is never lost or queued twice if this worker dies halfway
+        count, dropped = queue.requeue(_processing_key(worker_id), _max_attempts)
+        requeued += count
+        for task in dropped:
+            task_id = task.get("kwargs", {}).get("task_id")
+            logger.error(f"task {task_id} took down {task['attempts']} workers, giving up")
+            if task_id:
+                sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        redis_client.srem(_workers_key(), worker_id)
+        logger.warning(f"worker {worker_id} is gone, its tasks are back on the queue")
+    return requeued
+
+
+class Worker:
+    def __init__(self, redis_client: redis.Redis = None):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{utils.get_uuid(remove_hyphen=True)[:8]}"
+        self.redis = redis_client or get_redis_client()
+        self.queue = RedisFairQueue(self.redis, get_queue_name())
+        self.stopping = threading.Event()
+
+    def _beat(self):
+        self.redis.set(
+            _heartbeat_key(self.worker_id), int(time.time()), ex=_heartbeat_interval * 3
+        )
+
+    def _heartbeat(self):
+        while not self.stopping.wait(_heartbeat_interval):
+            try:
+                self._beat()
+                requeue_dead_workers(self.redis)
+            except redis.RedisError as e:
+                logger.warning(f"worker {self.worker_id} heartbeat failed: {str(e)}")
+
+    def run_task(self, task_json: bytes):
+        try:
+            task_info = deserialize_task(task_json)
+            logger.info(f"worker {self.worker_id} running task: {task_info['kwargs'].get('task_id')}")
+            task_info["func"](*task_info.get("args", ()), **task_info.get("kwargs", {}))
+        except Exception as e:
+            logger.error(f"worker {self.worker_id} task failed: {str(e)}")
+            task_id = json.loads(task_json).get("kwargs", {}).get("task_id")
+            if task_id:
+                sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        finally:
+            self.redis.lrem(_processing_key(self.worker_id), 1, task_json)
+
+    def run(self):
+        self._beat()
+        self.redis.sadd(_workers_key(), self.worker_id)
+        migrate_legacy_queue(self.redis, self.queue)
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        logger.info(f"worker {self.worker_id} waiting for tasks on {get_queue_name()}")
+        try:
+            while not self.stopping.is_set():
+                try:
+                    task_json = self.queue.get(_processing_key(self.worker_id))
+                    if not task_json:
+                        self.queue.wait(timeout=5)
+                        continue
+                except redis.RedisError as e:
+                    logger.warning(f"worker {self.worker_id} failed to read the queue: {str(e)}")
+                    time.sleep(_heartbeat_interval)
+                    continue
+                self.run_task(task_json)
+        finally:
+            self.stopping.set()
+            pipe = self.redis.pipeline()
+            pipe.delete(_heartbeat_key(self.worker_id))
+            pipe.srem(_workers_key(), self.worker_id)
+            pipe.execute()
+            logger.info(f"worker {self.worker_id} stopped")
+
+
+def _run_worker():
+    worker = Worker()
+    # finish the running task, then stop
+    signal.signal(signal.SIGTERM, lambda *_: worker.stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: worker.stopping.set())
+    worker.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run the tasks of the redis task queue")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.app.get("max_concurrent_tasks", 5),
+        help="number of worker processes, each runs one task at a time",
+    )
+    args = parser.parse_args()
+
+    if not config.app.get("enable_redis", False):
+        logger.error("the worker needs redis, set enable_redis = true in config.toml")
+        return
+
+    context = multiprocessing.get_context("spawn")
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    processes = []
+    # 工作进程崩溃后重新启动，它未完成的任务在心跳过期后重新入队
+    while not stopping.is_set():
+        for process in processes:
+            if not process.is_alive():
+                logger.warning(f"worker process {process.pid} exited with code {process.exitcode}")
+        processes = [p for p in processes if p.is_alive()]
+        for _ in range(args.workers - len(processes)):
+            process = context.Process(target=_run_worker, daemon=False)
+            process.start()
+            processes.append(process)
+        stopping.wait(1)
+
+    logger.info("stopping the workers, waiting for the running tasks")
+    for process in processes:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
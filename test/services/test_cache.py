@@ -0,0 +1,124 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import cache
+
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _make_file(self, name, size):
+        file = os.path.join(self.temp_dir, name)
+        with open(file, "wb") as f:
+            f.write(b"0" * size)
+        return file
+
+    def test_put_and_fetch(self):
+        file_cache = cache.FileCache(self.cache_dir, max_size=1024)
+        source = self._make_file("source.mp4", 100)
+        file_cache.put("key", source, ".mp4")
+
+        dest = os.path.join(self.temp_dir, "dest.mp4")
+        self.assertTrue(file_cache.fetch("key", dest, ".mp4"))
+        self.assertEqual(os.path.getsize(dest), 100)
+        self.assertFalse(file_cache.fetch("missing", dest, ".mp4"))
+
+    def test_evict_least_recently_used(self):
+        file_cache = cache.FileCache(self.cache_dir, max_size=250)
+        file_cache.put("a", self._make_file("a", 100))
+        file_cache.put("b", self._make_file("b", 100))
+        past = time.time() - 60
+        os.utime(file_cache.path("a"), (past, past))
+        os.utime(file_cache.path("b"), (past + 1, past + 1))
+
+        # "a" is used again, so "b" becomes the least recently used one
+        self.assertTrue(file_cache.get("a"))
+        file_cache.put("c", self._make_file("c", 100))
+
+        self.assertTrue(os.path.exists(file_cache.path("a")))
+        self.assertFalse(os.path.exists(file_cache.path("b")))
+        self.assertTrue(os.path.exists(file_cache.path("c")))
+
+    def test_file_hash(self):
+        a = self._make_file("a", 10)
+        b = self._make_file("b", 10)
+        c = self._make_file("c", 11)
+        self.assertEqual(cache.file_hash(a), cache.file_hash(b))
+        self.assertNotEqual(cache.file_hash(a), cache.file_hash(c))
+        self.assertEqual(cache.file_hash(os.path.join(self.temp_dir, "missing")), "")
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_get_and_set(self):
+        ttl_cache = cache.TTLCache("test", ttl=60)
+        self.assertIsNone(ttl_cache.get("key"))
+        ttl_cache.set("key", [{"url": "a"}])
+        self.assertEqual(ttl_cache.get("key"), [{"url": "a"}])
+        self.assertEqual(ttl_cache.stats()["hits"], 1)
+        self.assertEqual(ttl_cache.stats()["misses"], 1)
+        self.assertEqual(ttl_cache.stats()["hit_rate"], 0.5)
+
+    def test_expired(self):
+        ttl_cache = cache.TTLCache("test", ttl=0)
+        ttl_cache.set("key", 1)
+        self.assertIsNone(ttl_cache.get("key"))
+
+    def test_redis_keys_use_the_prefix(self):
+        redis_client = mock.Mock()
+        redis_client.get.return_value = None
+        ttl_cache = cache.TTLCache("search", ttl=60, redis_client=redis_client)
+        with mock.patch.dict(cache.config.app, {"redis_key_prefix": "site-a"}):
+            ttl_cache.set("key", 1)
+        self.assertEqual(redis_client.setex.call_args.args[0], "site-a:cache:search:key")
+
+
+class TestPersistentCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.temp_dir, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_get_and_set(self):
+        persistent_cache = cache.PersistentCache(self.db_file, ttl=60, max_entries=10)
+        self.assertIsNone(persistent_cache.get("key"))
+        persistent_cache.set("key", ["a", "b"], meta={"tokens": 10})
+        # survives a restart
+        persistent_cache = cache.PersistentCache(self.db_file, ttl=60, max_entries=10)
+        self.assertEqual(persistent_cache.get("key"), (["a", "b"], {"tokens": 10}))
+
+    def test_expired_and_evicted(self):
+        persistent_cache = cache.PersistentCache(self.db_file, ttl=0, max_entries=10)
+        persistent_cache.set("key", 1)
+        self.assertIsNone(persistent_cache.get("key"))
+
+        persistent_cache = cache.PersistentCache(self.db_file, ttl=60, max_entries=2)
+        persistent_cache.set("a", 1)
+        time.sleep(0.01)
+        persistent_cache.set("b", 2)
+        time.sleep(0.01)
+        persistent_cache.get("a")
+        time.sleep(0.01)
+        persistent_cache.set("c", 3)
+        self.assertIsNone(persistent_cache.get("b"))
+        self.assertEqual(persistent_cache.get("a")[0], 1)
+        self.assertEqual(persistent_cache.size(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.controllers.file_response import TaskFileResponse
+
+
+class TestTaskFileResponse(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".mp4")
+        self.data = os.urandom(3 * 1024 * 1024 + 100)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.data)
+        app = Starlette(routes=[Route("/video", lambda request: TaskFileResponse(self.path))])
+        self.client = TestClient(app)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_ranges(self):
+        r = self.client.get("/video")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.data)
+
+        r = self.client.get("/video", headers={"Range": "bytes=100-1048675"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, self.data[100:1048676])
+        self.assertEqual(r.headers["content-range"], f"bytes 100-1048675/{len(self.data)}")
+
+        r = self.client.get("/video", headers={"Range": "bytes=0-9,-10"})
+        self.assertEqual(r.status_code, 206)
+        self.assertTrue(r.headers["content-type"].startswith("multipart/byteranges; boundary="))
+        self.assertIn(self.data[-10:], r.content)
+
+        r = self.client.get("/video", headers={"Range": f"bytes={len(self.data)}-"})
+        self.assertEqual(r.status_code, 416)
+        self.assertEqual(r.headers["content-range"], f"bytes */{len(self.data)}")
+
+    def test_conditional_requests(self):
+        headers = self.client.get("/video").headers
+        r = self.client.get("/video", headers={"If-None-Match": headers["etag"]})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, b"")
+        r = self.client.get("/video", headers={"If-Modified-Since": headers["last-modified"]})
+        self.assertEqual(r.status_code, 304)
+        r = self.client.get("/video", headers={"If-None-Match": '"other"'})
+        self.assertEqual(r.status_code, 200)
+
+        # a changed file is sent whole instead of the range
+        r = self.client.get("/video", headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+        self.assertEqual(r.status_code, 200)
+        r = self.client.get("/video", headers={"Range": "bytes=0-9", "If-Range": headers["etag"]})
+        self.assertEqual(r.status_code, 206)
+
+    def test_zero_copy(self):
+        messages = []
+
+        async def send(message):
+            if "file" in message:
+                message["file"].seek(message["offset"])
+                message["body"] = message["file"].read(message["count"])
+            messages.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "headers": [(b"range", b"bytes=10-19")],
+            "extensions": {"http.response.zerocopysend": {}},
+        }
+        asyncio.run(TaskFileResponse(self.path)(scope, None, send))
+        self.assertEqual(messages[0]["status"], 206)
+        self.assertEqual(messages[1]["type"], "http.response.zerocopysend")
+        self.assertEqual(messages[1]["body"], self.data[10:20])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import httpx
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import cache, llm
+
+
+def _chat_completion(content: str) -> dict:
+    return {
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-test",
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }
+        ],
+    }
+
+
+class TestLLMClients(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            return httpx.Response(200, json=_chat_completion('["sky", "sea"]'))
+
+        transport = httpx.MockTransport(handler)
+        self.config = {
+            "llm_provider": "openai",
+            "openai_api_key": "sk-test",
+            "openai_model_name": "gpt-test",
+            "enable_llm_cache": False,
+        }
+        patches = [
+            mock.patch.dict(llm.config.app, self.config),
+            mock.patch.dict(llm._clients, clear=True),
+            mock.patch.object(llm, "_retired_clients", []),
+            mock.patch.dict(llm._provider_settings, clear=True),
+            mock.patch.object(llm, "_config_version", None),
+            mock.patch.object(llm.config, "version", llm.config.version),
+            mock.patch.object(llm, "_llm_cache", None),
+            mock.patch.object(llm, "router", llm.ProviderRouter()),
+            mock.patch.dict(
+                llm._llm_cache_stats,
+                {"hits": 0, "misses": 0, "saved_tokens": 0, "saved_seconds": 0.0},
+            ),
+            mock.patch.object(llm, "_new_http_client", lambda: httpx.Client(transport=transport)),
+            mock.patch.object(
+                llm, "_new_async_http_client", lambda: httpx.AsyncClient(transport=transport)
+            ),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _change_config(self, **values):
+        # what config.save_config does after the settings were changed
+        llm.config.app.update(values)
+        llm.config.version += 1
+
+    def test_client_is_reused_until_the_config_changes(self):
+        settings = llm._get_provider_settings("openai")
+        client = llm.get_client("openai", settings)
+        llm.config.app["openai_api_key"] = "sk-other"
+        # the settings are read once per config version
+        self.assertIs(llm._get_provider_settings("openai"), settings)
+        self.assertIs(llm.get_client("openai", llm._get_provider_settings("openai")), client)
+
+        self._change_config(openai_api_key="sk-other")
+        self.assertEqual(llm._get_provider_settings("openai")["api_key"], "sk-other")
+        self.assertIsNot(llm.get_client("openai", llm._get_provider_settings("openai")), client)
+
+    def test_replaced_clients_are_closed_at_the_next_config_change(self):
+        client = llm.get_client("openai", llm._get_provider_settings("openai"))
+        self._change_config(openai_api_key="sk-other")
+        # a request may still be running on it
+        llm.get_client("openai", llm._get_provider_settings("openai"))
+        self.assertFalse(client.is_closed())
+
+        self._change_config(openai_api_key="sk-test")
+        llm.get_client("openai", llm._get_provider_settings("openai"))
+        self.assertTrue(client.is_closed())
+
+    def test_sync_and_async_terms(self):
+        self.assertEqual(llm.generate_terms("ocean", "script"), ["sky", "sea"])
+
+        async def generate():
+            return await asyncio.gather(
+                *[llm.agenerate_terms("ocean", "script") for _ in range(5)]
+            )
+
+        self.assertEqual(asyncio.run(generate()), [["sky", "sea"]] * 5)
+        self.assertEqual(len(self.requests), 6)
+        body = json.loads(self.requests[-1].content)
+        self.assertEqual(body["model"], "gpt-test")
+        self.assertEqual(self.requests[-1].headers["authorization"], "Bearer sk-test")
+
+    def test_http_provider(self):
+        self._change_config(
+            llm_provider="pollinations", pollinations_base_url="https://text.pollinations.ai/openai"
+        )
+        self.assertEqual(llm._generate_response("ocean"), '["sky", "sea"]')
+        self.assertEqual(str(self.requests[0].url), "https://text.pollinations.ai/openai")
+
+    def test_missing_settings(self):
+        self._change_config(openai_api_key="")
+        self.assertTrue(llm._generate_response("hi").startswith("Error: openai: api_key is not set"))
+
+    def test_cached_responses_skip_the_llm(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        llm.config.app["enable_llm_cache"] = True
+        llm.config.app["llm_cost_per_1k_tokens"] = 0.002
+        llm_cache = cache.PersistentCache(os.path.join(temp_dir, "llm.db"), ttl=60, max_entries=10)
+
+        with mock.patch.object(llm, "_llm_cache", llm_cache):
+            self.assertEqual(llm.generate_terms("ocean", "script"), ["sky", "sea"])
+            # whitespace in the prompt does not matter
+            self.assertEqual(llm.generate_terms("ocean ", "script"), ["sky", "sea"])
+            self.assertEqual(asyncio.run(llm.agenerate_terms("ocean", "script")), ["sky", "sea"])
+            self.assertEqual(len(self.requests), 1)
+
+            llm.generate_terms("ocean", "script", use_cache=False)
+            self.assertEqual(len(self.requests), 2)
+            # another model does not share the cache
+            self._change_config(openai_model_name="gpt-other")
+            llm.generate_terms("ocean", "script")
+            self.assertEqual(len(self.requests), 3)
+
+            stats = llm.get_llm_cache_stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hit_rate"], 0.5)
+        self.assertEqual(stats["size"], 2)
+        self.assertGreater(stats["saved_tokens"], 0)
+        self.assertGreater(stats["saved_cost"], 0)
+
+
+class TestProviderRouting(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.dict(
+                llm.config.app,
+                {"llm_providers": ["slow", "fast"], "llm_hedge_delay": 0.2, "enable_llm_hedging": True},
+            ),
+            mock.patch.object(llm, "router", llm.ProviderRouter()),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_rank(self):
+        router = llm.ProviderRouter()
+        now = time.time()
+        # never called goes first
+        self.assertEqual(router.rank(["a", "b"]), ["a", "b"])
+        router.record("a", now - 2, ok=True)
+        self.assertEqual(router.rank(["a", "b"]), ["b", "a"])
+        router.record("b", now - 1, ok=True)
+        self.assertEqual(router.rank(["a", "b"]), ["b", "a"])
+        router.record("b", now - 1, ok=False)
+        router.record("b", now - 1, ok=False)
+        self.assertEqual(router.rank(["a", "b"]), ["a", "b"])
+        self.assertEqual(router.stats()["b"]["failures"], 2)
+
+        # a request that has not answered for long makes its provider slow
+        router.begin("c")
+        self.assertEqual(router.rank(["c", "d"]), ["d", "c"])
+        for latency in range(1, 11):
+            router.record("e", now - latency, ok=True)
+        self.assertAlmostEqual(router.hedge_delay("e", 0.9), 10, places=1)
+        self.assertIsNone(router.hedge_delay("d", 0.9))
+
+    def _responses(self, provider, prompt):
+        if provider == "broken":
+            raise Exception("unavailable")
+        return "fast answer"
+
+    async def _aresponses(self, provider, prompt):
+        if provider == "slow":
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                self.cancelled.set()
+                raise
+            return "slow answer"
+        return self._responses(provider, prompt)
+
+    def test_slow_provider_is_hedged(self):
+        self.cancelled = threading.Event()
+        with mock.patch.object(llm, "_aprovider_response", self._aresponses):
+            start_time = time.time()
+            self.assertEqual(llm._generate_response("hi"), "fast answer")
+            self.assertLess(time.time() - start_time, 0.9)
+        # the slower request does not run on to its end
+        self.assertTrue(self.cancelled.wait(0.5))
+        # the fast provider is asked first from now on
+        self.assertEqual(llm.router.rank(llm.get_llm_providers()), ["fast", "slow"])
+
+    def test_async_slow_provider_is_hedged(self):
+        self.cancelled = threading.Event()
+        with mock.patch.object(llm, "_aprovider_response", self._aresponses):
+            start_time = time.time()
+            self.assertEqual(asyncio.run(llm._agenerate_response("hi")), "fast answer")
+            self.assertLess(time.time() - start_time, 0.9)
+        self.assertTrue(self.cancelled.is_set())
+
+    def test_failed_provider_is_taken_over(self):
+        llm.config.app["llm_providers"] = ["broken", "fast"]
+        with mock.patch.object(llm, "_aprovider_response", self._aresponses), mock.patch.object(
+            llm, "_provider_response", self._responses
+        ):
+            self.assertEqual(llm._generate_response("hi"), "fast answer")
+            llm.config.app["llm_providers"] = ["broken"]
+            self.assertEqual(llm._generate_response("hi"), "Error: unavailable")
+        self.assertEqual(llm.router.stats()["broken"]["failures"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
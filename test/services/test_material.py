@@ -0,0 +1,141 @@
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models.schema import MaterialInfo, VideoConcatMode
+from app.services import material
+
+
+def _items(term, count):
+    items = []
+    for i in range(count):
+        item = MaterialInfo()
+        item.url = f"https://example.com/{term}/{i}.mp4"
+        item.duration = 10
+        items.append(item)
+    return items
+
+
+class TestMaterialService(unittest.TestCase):
+    def test_download_videos_stops_at_audio_duration(self):
+        def search(search_term, minimum_duration, video_aspect):
+            return _items(search_term, 5)
+
+        def save(video_url, save_dir, provider, cancel_event):
+            return f"/tmp/{video_url.split('/', 3)[-1]}"
+
+        with mock.patch.object(
+            material, "search_videos_pexels", side_effect=search
+        ), mock.patch.object(material, "save_video", side_effect=save) as save_video:
+            video_paths = material.download_videos(
+                task_id="test",
+                search_terms=["a", "b"],
+                video_contact_mode=VideoConcatMode.sequential,
+                audio_duration=12,
+                max_clip_duration=5,
+            )
+
+        # 3 clips of 5 seconds cover 12 seconds of audio
+        self.assertEqual(len(video_paths), 3)
+        self.assertEqual(video_paths[0], "/tmp/a/0.mp4")
+        self.assertLess(save_video.call_count, 10)
+
+    def test_download_videos_skips_failed_downloads(self):
+        def search(search_term, minimum_duration, video_aspect):
+            return _items(search_term, 4)
+
+        def save(video_url, save_dir, provider, cancel_event):
+            if video_url.endswith("/0.mp4"):
+                raise IOError("connection reset")
+            return f"/tmp/{video_url.split('/', 3)[-1]}"
+
+        with mock.patch.object(
+            material, "search_videos_pexels", side_effect=search
+        ), mock.patch.object(material, "save_video", side_effect=save):
+            video_paths = material.download_videos(
+                task_id="test",
+                search_terms=["a"],
+                video_contact_mode=VideoConcatMode.sequential,
+                audio_duration=12,
+                max_clip_duration=5,
+            )
+
+        self.assertEqual(video_paths, ["/tmp/a/1.mp4", "/tmp/a/2.mp4", "/tmp/a/3.mp4"])
+
+    def test_download_videos_tops_up_downloaded_videos(self):
+        def search(search_term, minimum_duration, video_aspect):
+            return _items(search_term, 5)
+
+        def save(video_url, save_dir, provider, cancel_event):
+            return material.get_video_path(video_url, save_dir)
+
+        downloaded = [material.get_video_path(f"https://example.com/a/{i}.mp4") for i in range(2)]
+        media = mock.Mock(duration=10)
+        with mock.patch.object(
+            material, "search_videos_pexels", side_effect=search
+        ), mock.patch.object(
+            material, "save_video", side_effect=save
+        ) as save_video, mock.patch.object(material.probe, "probe", return_value=media):
+            video_paths = material.download_videos(
+                task_id="test",
+                search_terms=["a"],
+                video_contact_mode=VideoConcatMode.sequential,
+                audio_duration=12,
+                max_clip_duration=5,
+                downloaded_videos=downloaded,
+            )
+            # already long enough, nothing is searched or downloaded
+            self.assertEqual(
+                material.download_videos(
+                    task_id="test",
+                    search_terms=["a"],
+                    audio_duration=8,
+                    max_clip_duration=5,
+                    downloaded_videos=downloaded,
+                ),
+                downloaded,
+            )
+
+        self.assertEqual(video_paths[:2], downloaded)
+        self.assertEqual(len(video_paths), 3)
+        self.assertEqual(save_video.call_count, 1)
+        self.assertEqual(save_video.call_args.kwargs["video_url"], "https://example.com/a/2.mp4")
+
+    def test_search_cache(self):
+        response = mock.Mock()
+        response.json.return_value = {
+            "videos": [
+                {
+                    "duration": 10,
+                    "video_files": [
+                        {"width": 1080, "height": 1920, "link": "https://example.com/1.mp4"}
+                    ],
+                }
+            ]
+        }
+        session = mock.Mock()
+        session.get.return_value = response
+
+        with mock.patch.object(
+            material, "_search_cache", material.cache.TTLCache("search", ttl=60)
+        ), mock.patch.object(
+            material, "get_session", return_value=session
+        ), mock.patch.object(
+            material, "get_api_key", return_value="key"
+        ):
+            first = material.search_videos_pexels("Money ", minimum_duration=5)
+            second = material.search_videos_pexels("money", minimum_duration=5)
+            material.search_videos_pexels("money", minimum_duration=8)
+
+        self.assertEqual(session.get.call_count, 2)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(second[0].url, first[0].url)
+        self.assertEqual(second[0].duration, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
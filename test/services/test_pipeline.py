@@ -0,0 +1,169 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def test_independent_stages_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def branch(a):
+            # both branches have to be running at the same time to pass the barrier
+            barrier.wait()
+            return a + 1
+
+        stages = [
+            pipeline.Stage("a", lambda: 1),
+            pipeline.Stage("b", branch, ["a"]),
+            pipeline.Stage("c", branch, ["a"]),
+            pipeline.Stage("d", lambda b, c: b + c, ["b", "c"]),
+        ]
+        results = pipeline.run_stages(stages)
+        self.assertEqual(results["d"], 4)
+
+    def test_only_required_stages_run(self):
+        calls = []
+        stages = [
+            pipeline.Stage("a", lambda: calls.append("a") or 1),
+            pipeline.Stage("b", lambda a: calls.append("b") or 2, ["a"]),
+            pipeline.Stage("c", lambda a: calls.append("c") or 3, ["a"]),
+        ]
+        results = pipeline.run_stages(stages, targets=["b"])
+        self.assertEqual(sorted(calls), ["a", "b"])
+        self.assertNotIn("c", results)
+
+    def test_failed_stage_stops_scheduling(self):
+        calls = []
+
+        def slow(a):
+            time.sleep(0.2)
+            calls.append("slow")
+            return 1
+
+        stages = [
+            pipeline.Stage("a", lambda: 1),
+            pipeline.Stage("failed", lambda a: None, ["a"]),
+            pipeline.Stage("slow", slow, ["a"]),
+            pipeline.Stage("after", lambda slow: calls.append("after") or 1, ["slow"]),
+        ]
+        results = pipeline.run_stages(stages)
+        self.assertNotIn("failed", results)
+        # the running stage is waited for, but nothing is started after the failure
+        self.assertEqual(calls, ["slow"])
+
+    def test_exception_is_raised(self):
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            pipeline.run_stages([pipeline.Stage("a", fail)])
+
+    def test_manifest_reuses_unchanged_stages(self):
+        work_dir = tempfile.mkdtemp()
+        manifest_file = os.path.join(work_dir, "manifest.json")
+        output_file = os.path.join(work_dir, "a.txt")
+        calls = []
+
+        def a():
+            calls.append("a")
+            with open(output_file, "w") as f:
+                f.write("a")
+            return output_file
+
+        def b(a):
+            calls.append("b")
+            return "b"
+
+        def stages(inputs):
+            return [
+                pipeline.Stage("a", a, inputs=inputs, files=lambda result: [result]),
+                pipeline.Stage("b", b, ["a"], inputs={}),
+                pipeline.Stage("c", lambda b: calls.append("c") or "c", ["b"]),
+            ]
+
+        try:
+            pipeline.run_stages(stages({"x": 1}), manifest=pipeline.Manifest(manifest_file))
+            self.assertEqual(calls, ["a", "b", "c"])
+
+            # stages without inputs always run
+            calls.clear()
+            results = pipeline.run_stages(stages({"x": 1}), manifest=pipeline.Manifest(manifest_file))
+            self.assertEqual(calls, ["c"])
+            self.assertEqual(results["a"], output_file)
+
+            # a changed input runs the stage and its dependents again
+            calls.clear()
+            pipeline.run_stages(stages({"x": 2}), manifest=pipeline.Manifest(manifest_file))
+            self.assertEqual(calls, ["a", "b", "c"])
+
+            # so does a missing output file
+            calls.clear()
+            os.remove(output_file)
+            pipeline.run_stages(stages({"x": 2}), manifest=pipeline.Manifest(manifest_file))
+            self.assertEqual(calls, ["a", "b", "c"])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def test_stages_share_slots_per_resource(self):
+        lock = threading.Lock()
+        running = {"io": 0, "render": 0}
+        peaks = {"io": 0, "render": 0}
+
+        def work(resource):
+            def _work(**kwargs):
+                with lock:
+                    running[resource] += 1
+                    peaks[resource] = max(peaks[resource], running[resource])
+                time.sleep(0.2)
+                with lock:
+                    running[resource] -= 1
+                return resource
+
+            return _work
+
+        def run_task():
+            pipeline.run_stages(
+                [
+                    pipeline.Stage("download", work("io")),
+                    pipeline.Stage(
+                        "video", work("render"), ["download"], resource=pipeline.RESOURCE_RENDER
+                    ),
+                ]
+            )
+
+        limits = {"io_stage_concurrency": 3, "render_stage_concurrency": 1}
+        with mock.patch.dict(pipeline.config.app, limits), mock.patch.object(pipeline, "_slots", {}):
+            tasks = [threading.Thread(target=run_task) for _ in range(3)]
+            for task in tasks:
+                task.start()
+            for task in tasks:
+                task.join()
+
+        # the downloads of all the tasks overlap, the renders run one at a time
+        self.assertEqual(peaks["io"], 3)
+        self.assertEqual(peaks["render"], 1)
+
+    def test_renders_share_the_cores(self):
+        with mock.patch.object(pipeline.os, "cpu_count", return_value=16):
+            with mock.patch.dict(pipeline.config.app, {"render_stage_concurrency": 0}):
+                self.assertEqual(pipeline.get_resource_limit(pipeline.RESOURCE_RENDER), 4)
+                self.assertEqual(pipeline.get_render_cores(), 4)
+            with mock.patch.dict(pipeline.config.app, {"render_stage_concurrency": 3}):
+                self.assertEqual(pipeline.get_render_cores(), 5)
+            with mock.patch.dict(pipeline.config.app, {"render_stage_concurrency": 32}):
+                self.assertEqual(pipeline.get_render_cores(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import probe
+
+resources_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources")
+
+
+class TestProbe(unittest.TestCase):
+    def setUp(self):
+        self.test_video_path = os.path.join(resources_dir, "2.png.mp4")
+
+    def test_probe(self):
+        info = probe.probe(self.test_video_path)
+        self.assertTrue(info.has_video)
+        self.assertGreater(info.duration, 0)
+        self.assertGreater(info.fps, 0)
+        self.assertGreater(info.width, 0)
+        self.assertGreater(info.height, 0)
+
+    def test_probe_is_served_from_index(self):
+        info = probe.probe(self.test_video_path)
+        probe._memo.clear()
+        with mock.patch.object(probe, "_ffprobe") as ffprobe, mock.patch.object(
+            probe, "_ffmpeg_probe"
+        ) as ffmpeg_probe:
+            cached = probe.probe(self.test_video_path)
+            ffprobe.assert_not_called()
+            ffmpeg_probe.assert_not_called()
+        self.assertEqual(cached.to_dict(), info.to_dict())
+
+    def test_parse_rate(self):
+        self.assertAlmostEqual(probe._parse_rate("30000/1001"), 29.97, places=2)
+        self.assertEqual(probe._parse_rate("25"), 25)
+        self.assertEqual(probe._parse_rate("0/0"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import json
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.controllers.manager import fair_queue
+from app.controllers.manager.fair_queue import FairQueue, RedisFairQueue
+from app.controllers.manager.memory_manager import InMemoryTaskManager
+
+
+def _task(name: str, priority: str = "normal", tenant: str = "default") -> dict:
+    return {"func": name, "args": (), "kwargs": {}, "priority": priority, "tenant": tenant}
+
+
+def _drain(queue: FairQueue) -> list:
+    names = []
+    while not queue.empty():
+        names.append(queue.get()["func"])
+    return names
+
+
+class TestFairQueue(unittest.TestCase):
+    def test_higher_priority_goes_first(self):
+        queue = FairQueue()
+        queue.put(_task("low", "low"))
+        queue.put(_task("normal"))
+        queue.put(_task("high", "high"))
+        self.assertEqual(_drain(queue), ["high", "normal", "low"])
+        self.assertIsNone(queue.get())
+
+    def test_tenants_take_turns_by_weight(self):
+        queue = FairQueue()
+        for i in range(4):
+            queue.put(_task(f"batch-{i}", tenant="batch"))
+        queue.put(_task("studio-0", tenant="studio"))
+        queue.put(_task("studio-1", tenant="studio"))
+        self.assertEqual(
+            _drain(queue), ["batch-0", "studio-0", "batch-1", "studio-1", "batch-2", "batch-3"]
+        )
+
+        with mock.patch.object(fair_queue, "get_tenant_weight", lambda t: 2 if t == "batch" else 1):
+            for i in range(4):
+                queue.put(_task(f"batch-{i}", tenant="batch"))
+            queue.put(_task("studio-0", tenant="studio"))
+            self.assertEqual(_drain(queue), ["batch-0", "batch-1", "studio-0", "batch-2", "batch-3"])
+
+    def test_invalid_priority(self):
+        with self.assertRaises(ValueError):
+            FairQueue().put(_task("urgent", "urgent"))
+
+    def test_stats(self):
+        queue = FairQueue()
+        queue.put(_task("a", tenant="a"))
+        queue.put(_task("b", tenant="b"))
+        queue.put(_task("c", "low"))
+        queue.get()
+
+        stats = queue.stats()
+        self.assertEqual(stats["normal"]["depth"], 1)
+        self.assertEqual(stats["normal"]["tenants"], 1)
+        self.assertEqual(stats["normal"]["dequeued"], 1)
+        self.assertGreaterEqual(stats["normal"]["oldest_wait"], 0)
+        self.assertEqual(stats["low"]["depth"], 1)
+        self.assertEqual(stats["high"], {"depth": 0, "tenants": 0, "oldest_wait": 0, "dequeued": 0, "avg_wait": 0})
+
+
+class TestRedisFairQueue(unittest.TestCase):
+    def setUp(self):
+        self.redis = mock.Mock()
+        self.scripts = {}
+        self.redis.register_script.side_effect = lambda script: self.scripts.setdefault(script, mock.Mock())
+        self.queue = RedisFairQueue(self.redis, "{mpt}:task_queue")
+
+    def test_put_passes_every_key(self):
+        self.queue.put("task", "high", "a")
+        self.scripts[fair_queue._ENQUEUE_SCRIPT].assert_called_once_with(
+            keys=[
+                "{mpt}:task_queue:high:tenant:a",
+                "{mpt}:task_queue:high:tenants",
+                "{mpt}:task_queue:weights",
+                "{mpt}:task_queue:signal",
+            ],
+            args=["task", "a", 1],
+        )
+
+    def test_get_records_the_wait_time(self):
+        task_json = json.dumps(fair_queue.stamp_task(_task("a", "high"))).encode("utf-8")
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [b"a", None, None]
+        dequeue = self.scripts[fair_queue._DEQUEUE_SCRIPT]
+        dequeue.return_value = task_json
+        self.assertEqual(self.queue.get("{mpt}:task_queue:processing:w1"), task_json)
+        dequeue.assert_called_once_with(
+            keys=[
+                "{mpt}:task_queue:high:tenants",
+                "{mpt}:task_queue:high:turns",
+                "{mpt}:task_queue:weights",
+                "{mpt}:task_queue:high:tenant:a",
+                "{mpt}:task_queue:processing:w1",
+            ],
+            args=["a", 1],
+        )
+        pipe.hincrby.assert_called_once_with("{mpt}:task_queue:stats:high", "dequeued", 1)
+
+        pipe.execute.return_value = [None, None, None]
+        self.assertIsNone(self.queue.get())
+
+    def test_get_retries_when_the_head_changed(self):
+        task_json = json.dumps(fair_queue.stamp_task(_task("b"))).encode("utf-8")
+        self.redis.pipeline.return_value.execute.side_effect = [[None, b"a", None], [None, b"b", None], [1, 1]]
+        dequeue = self.scripts[fair_queue._DEQUEUE_SCRIPT]
+        dequeue.side_effect = [None, task_json]
+        self.assertEqual(self.queue.get(), task_json)
+        self.assertEqual(dequeue.call_args.kwargs["keys"][3], "{mpt}:task_queue:normal:tenant:b")
+        self.assertEqual(dequeue.call_args.kwargs["args"], ["b", 0])
+
+
+class TestTaskManagerQueue(unittest.TestCase):
+    def test_queued_tasks_run_by_priority(self):
+        manager = InMemoryTaskManager(max_concurrent_tasks=0)
+        func = mock.Mock(__name__="func")
+        manager.add_task(func, task_id="bulk", tenant="batch")
+        manager.add_task(func, task_id="interactive", priority="high", tenant="studio")
+        self.assertEqual(manager.get_queue_stats()["normal"]["depth"], 1)
+
+        self.assertEqual(manager.dequeue()["kwargs"], {"task_id": "interactive"})
+        self.assertEqual(manager.dequeue()["kwargs"], {"task_id": "bulk"})
+        with self.assertRaises(ValueError):
+            manager.add_task(func, task_id="urgent", priority="urgent")
+
+
+if __name__ == "__main__":
+    unittest.main()
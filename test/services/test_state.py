@@ -0,0 +1,133 @@
+import asyncio
+import json
+import sys
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models import const
+from app.services import state as sm
+
+
+class TestRedisState(unittest.TestCase):
+    def setUp(self):
+        with mock.patch("redis.StrictRedis") as strict_redis:
+            self.state = sm.RedisState(prefix="test")
+        self.redis = strict_redis.return_value
+
+    def test_update_task_is_one_pipelined_write(self):
+        self.state.update_task(
+            "task-1", state=const.TASK_STATE_COMPLETE, progress=120, videos=["a.mp4"]
+        )
+
+        self.redis.pipeline.assert_called_once()
+        pipe = self.redis.pipeline.return_value
+        pipe.hset.assert_called_once()
+        self.assertEqual(pipe.hset.call_args.args[0], "test:task:task-1")
+        mapping = pipe.hset.call_args.kwargs["mapping"]
+        self.assertEqual(json.loads(mapping["progress"]), 100)
+        self.assertEqual(json.loads(mapping["videos"]), ["a.mp4"])
+        self.assertEqual(pipe.zadd.call_args.args[0], "test:tasks")
+        self.assertTrue(pipe.zadd.call_args.kwargs["nx"])
+        pipe.execute.assert_called_once()
+
+    def test_get_all_tasks_reads_a_page_from_the_index(self):
+        self.redis.zcard.return_value = 25
+        self.redis.zrange.return_value = [b"task-11", b"task-12"]
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [
+            {b"task_id": b'"task-11"', b"progress": b"100", b"videos": b'["a.mp4"]'},
+            # deleted while the page was read
+            {},
+        ]
+
+        tasks, total = self.state.get_all_tasks(page=2, page_size=10)
+
+        self.assertEqual(total, 25)
+        self.redis.zrange.assert_called_once_with("test:tasks", 10, 19)
+        self.assertEqual(pipe.hgetall.call_args_list[1].args[0], "test:task:task-12")
+        self.assertEqual(tasks, [{"task_id": "task-11", "progress": 100, "videos": ["a.mp4"]}])
+        self.redis.scan.assert_not_called()
+
+    def test_get_task_migrates_old_tasks(self):
+        # written by an older version under the bare task id as str(value)
+        old_tasks = {
+            "task-1": {
+                b"state": b"1",
+                b"videos": b"['a.mp4']",
+                b"task_id": b"task-1",
+            }
+        }
+        self.redis.hgetall.side_effect = lambda key: old_tasks.get(key, {})
+        task = self.state.get_task("task-1")
+        self.assertEqual(task, {"state": 1, "videos": ["a.mp4"], "task_id": "task-1"})
+
+        pipe = self.redis.pipeline.return_value
+        self.assertEqual(pipe.hset.call_args.args[0], "test:task:task-1")
+        self.assertEqual(json.loads(pipe.hset.call_args.kwargs["mapping"]["videos"]), ["a.mp4"])
+        self.assertEqual(pipe.zadd.call_args.args[0], "test:tasks")
+        pipe.delete.assert_called_once_with("task-1")
+
+        self.assertIsNone(self.state.get_task("task-2"))
+
+    def test_get_all_tasks_migrates_old_tasks_once(self):
+        self.redis.scan_iter.return_value = [b"task-1", b"test:task:task-2", b"other"]
+        self.redis.hget.side_effect = lambda key, field: key if key == b"task-1" else None
+        self.redis.hgetall.return_value = {b"task_id": b"task-1"}
+        self.redis.zrange.return_value = []
+
+        self.state.get_all_tasks(page=1, page_size=10)
+        self.state.get_all_tasks(page=1, page_size=10)
+
+        self.redis.scan_iter.assert_called_once()
+        self.redis.hgetall.assert_called_once_with("task-1")
+        self.redis.pipeline.return_value.delete.assert_called_once_with("task-1")
+
+    def test_delete_task_removes_it_from_the_index(self):
+        self.state.delete_task("task-1")
+        pipe = self.redis.pipeline.return_value
+        pipe.delete.assert_called_once_with("test:task:task-1")
+        pipe.zrem.assert_called_once_with("test:tasks", "task-1")
+
+    def test_update_task_publishes_progress(self):
+        self.state.update_task("task-1", progress=50)
+        pipe = self.redis.pipeline.return_value
+        self.assertEqual(pipe.publish.call_args.args[0], "test:progress:task-1")
+        self.assertEqual(json.loads(pipe.publish.call_args.args[1])["progress"], 50)
+
+
+class TestMemoryState(unittest.TestCase):
+    def test_subscribe_follows_updates_until_complete(self):
+        state = sm.MemoryState()
+        state.update_task("task-1", progress=10)
+
+        async def follow():
+            events = []
+            async for task in state.subscribe("task-1", timeout=0.05):
+                if task is None:
+                    # updates from another thread, e.g. the one running the task
+                    if not updater.ident:
+                        updater.start()
+                    continue
+                events.append(task)
+            return events
+
+        def update():
+            state.update_task("task-1", progress=60)
+            state.update_task(
+                "task-1", state=const.TASK_STATE_COMPLETE, progress=100, videos=["a.mp4"]
+            )
+
+        updater = threading.Thread(target=update)
+        events = asyncio.run(follow())
+        self.assertEqual([event["progress"] for event in events], [10, 60, 100])
+        self.assertEqual(events[-1]["videos"], ["a.mp4"])
+        self.assertEqual(state._subscribers, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,16 @@
 import unittest
 import os
+import shutil
 import sys
 from pathlib import Path
+from unittest import mock
 
 # add project root to python path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
 from app.services import task as tm
-from app.models.schema import MaterialInfo, VideoParams
+from app.utils import utils
+from app.models.schema import MaterialInfo, TaskVideoRequest, VideoParams
 
 resources_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources")
 
@@ -60,6 +63,49 @@ class TestTaskService(unittest.TestCase):
         )
         result = tm.start(task_id=task_id, params=params)
         print(result)
+
+    def test_resume_reuses_finished_stages(self):
+        task_id = "00000000-0000-0000-0000-000000000001"
+        task_dir = utils.task_dir(task_id)
+        audio_file = os.path.join(task_dir, "audio.mp3")
+        subtitle_file = os.path.join(task_dir, "subtitle.srt")
+        video_file = os.path.join(resources_dir, "1.png.mp4")
+        for file in [audio_file, subtitle_file]:
+            with open(file, "w") as f:
+                f.write("test")
+
+        sub_maker = tm.voice.SubMaker()
+        sub_maker.create_sub((0, 10000000), "test")
+        params = TaskVideoRequest(
+            video_subject="test", video_script="test", video_terms="test", priority="high"
+        )
+        with mock.patch.object(tm, "generate_terms", return_value=["test"]), mock.patch.object(
+            tm, "generate_audio", return_value=(audio_file, 1, sub_maker)
+        ) as generate_audio, mock.patch.object(
+            tm, "generate_subtitle", return_value=subtitle_file
+        ), mock.patch.object(
+            tm, "get_video_materials", return_value=[video_file]
+        ) as get_video_materials, mock.patch.object(
+            tm, "generate_final_videos", side_effect=[([], []), ([video_file], [None])]
+        ) as generate_final_videos:
+            # fails at render
+            self.assertIsNone(tm.start(task_id, params))
+
+            params, stop_at, priority = tm.load_task_params(task_id)
+            self.assertEqual(stop_at, "video")
+            self.assertEqual(priority, "high")
+            result = tm.start(task_id, params, stop_at)
+
+        shutil.rmtree(task_dir, ignore_errors=True)
+        self.assertEqual(result["videos"], [video_file])
+        self.assertEqual(generate_audio.call_count, 1)
+        self.assertEqual(get_video_materials.call_count, 2)
+        self.assertEqual(generate_final_videos.call_count, 2)
+
+    def test_estimate_audio_duration(self):
+        self.assertEqual(tm.estimate_audio_duration("金钱的作用" * 9), 10)
+        self.assertEqual(tm.estimate_audio_duration("money " * 25), 10)
+        self.assertEqual(tm.estimate_audio_duration("money " * 25, voice_rate=2.0), 5)
     
 
 if __name__ == "__main__":
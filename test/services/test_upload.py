@@ -0,0 +1,86 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import upload
+
+
+def _image(width: int, height: int) -> io.BytesIO:
+    data = io.BytesIO()
+    Image.new("RGB", (width, height), "red").save(data, format="PNG")
+    data.seek(0)
+    return data
+
+
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def test_save_upload_deduplicates(self):
+        data = os.urandom(3 * 1024 * 1024)
+        path = upload.save_upload(io.BytesIO(data), self.dir, "a.mp3")
+        self.assertEqual(path, os.path.join(self.dir, "a.mp3"))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+        self.assertEqual(upload.save_upload(io.BytesIO(data), self.dir, "b.mp3"), path)
+        self.assertEqual(os.listdir(self.dir), ["a.mp3"])
+
+    def test_save_upload_overwritten_file_is_not_reused(self):
+        first, second = os.urandom(1024), os.urandom(1024)
+        upload.save_upload(io.BytesIO(first), self.dir, "a.mp3")
+        # the same name with other content replaces the file
+        upload.save_upload(io.BytesIO(second), self.dir, "a.mp3")
+
+        path = upload.save_upload(io.BytesIO(first), self.dir, "b.mp3")
+        self.assertEqual(path, os.path.join(self.dir, "b.mp3"))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), first)
+
+        # changed behind the index
+        with open(path, "wb") as f:
+            f.write(second[:512] + first[512:])
+        self.assertEqual(
+            upload.save_upload(io.BytesIO(first), self.dir, "c.mp3"), os.path.join(self.dir, "c.mp3")
+        )
+
+    def test_save_upload_size_cap(self):
+        with self.assertRaises(upload.UploadTooLargeError):
+            upload.save_upload(io.BytesIO(os.urandom(2048)), self.dir, "a.mp3", max_size=1024)
+        # nothing left behind, not even the temp file
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_save_material(self):
+        with mock.patch.object(upload.utils, "storage_dir", return_value=self.dir):
+            material = upload.save_material(_image(640, 640), "cover.png")
+            self.assertEqual(material.provider, "local")
+            self.assertTrue(os.path.isfile(material.url))
+
+            with self.assertRaises(ValueError):
+                upload.save_material(_image(320, 320), "small.png")
+            with self.assertRaises(ValueError):
+                upload.save_material(io.BytesIO(b"not a video"), "broken.mp4")
+        materials = [f for f in os.listdir(self.dir) if not f.endswith(".db")]
+        self.assertEqual(materials, [os.path.basename(material.url)])
+
+    def test_save_material_keeps_a_duplicate_that_fails(self):
+        with mock.patch.object(upload.utils, "storage_dir", return_value=self.dir):
+            material = upload.save_material(_image(640, 640), "cover.png")
+            with mock.patch.object(upload.Image, "open", side_effect=OSError("broken")):
+                with self.assertRaises(ValueError):
+                    upload.save_material(_image(640, 640), "again.png")
+        # the file belongs to the first material
+        self.assertTrue(os.path.isfile(material.url))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,7 @@ import unittest
 import os
 import sys
 from pathlib import Path
+from unittest import mock
 from moviepy import (
     VideoFileClip,
 )
@@ -81,5 +82,139 @@ class TestVideoService(unittest.TestCase):
         except Exception as e:
             self.fail(f"test wrap_text failed: {str(e)}")
 
+    def test_select_subclips(self):
+        items = [
+            vd.SubClippedVideoClip(file_path=f"{i}.mp4", start_time=0, end_time=5)
+            for i in range(3)
+        ]
+        # materials are not long enough, the selected clips are looped
+        selected, duration = vd.select_subclips(items, audio_duration=22, max_clip_duration=5)
+        self.assertEqual(len(selected), 5)
+        self.assertEqual(duration, 25)
+        self.assertEqual(selected[3].file_path, "0.mp4")
+
+        selected, duration = vd.select_subclips(items, audio_duration=7, max_clip_duration=5)
+        self.assertEqual(len(selected), 2)
+
+    def test_ffmpeg_segment_filter(self):
+        graph = vd._ffmpeg_segment_filter(2, 5, None, None, 1080, 1920)
+        self.assertTrue(graph.startswith("[2:v]scale=1080:1920"))
+        self.assertTrue(graph.endswith("[v2]"))
+
+        graph = vd._ffmpeg_segment_filter(0, 5, "FadeOut", None, 1080, 1920)
+        self.assertIn("fade=t=out:st=4.000:d=1", graph)
+
+        graph = vd._ffmpeg_segment_filter(1, 5, "SlideIn", "left", 1080, 1920)
+        self.assertIn("overlay=x='min(0,w*(t-1))'", graph)
+    def test_generate_videos_batch_shares_segments(self):
+        video_file = os.path.join(resources_dir, "2.png.mp4")
+        output_files = [os.path.join(utils.storage_dir("temp", create=True), f"batch-{i}.mp4") for i in range(3)]
+        params = vd.VideoParams(video_subject="test", subtitle_enabled=False, bgm_type="")
+        items = [
+            vd.SubClippedVideoClip(file_path=video_file, start_time=i, end_time=i + 1, width=1080, height=1920)
+            for i in range(3)
+        ]
+        audio = mock.Mock(duration=2.5)
+        with mock.patch.object(vd.probe, "probe", return_value=audio), mock.patch.object(
+            vd, "plan_subclips", return_value=items
+        ), mock.patch.object(
+            vd, "encode_segments", side_effect=lambda segments, _: [1] * len(segments)
+        ) as encode_segments, mock.patch.object(
+            vd.ffmpeg, "concat_copy"
+        ) as concat_copy, mock.patch.object(vd, "_ffmpeg_compose") as compose:
+            on_variant = mock.Mock()
+            results = vd.generate_videos_batch(
+                [video_file], video_file, "", output_files, params, max_clip_duration=1, on_variant=on_variant
+            )
+
+        self.assertEqual(results, output_files)
+        self.assertEqual([call.args[0] for call in on_variant.call_args_list], [1, 2, 3])
+        # every distinct sub clip is encoded once for all the variants
+        encode_segments.assert_called_once()
+        self.assertLessEqual(len(encode_segments.call_args.args[0]), len(items))
+        self.assertEqual(concat_copy.call_count, 3)
+        self.assertEqual(compose.call_count, 3)
+        for call in concat_copy.call_args_list:
+            self.assertEqual(len(call.args[0]), 3)
+
+    def test_add_subtitles_renders_each_line_once(self):
+        subtitle_file = os.path.join(utils.storage_dir("temp", create=True), "subtitle-sprites.srt")
+        with open(subtitle_file, "w", encoding="utf-8") as f:
+            f.write(
+                "1\n00:00:00,000 --> 00:00:01,000\nhello\n\n"
+                "2\n00:00:01,000 --> 00:00:02,000\nworld\n\n"
+                "3\n00:00:03,000 --> 00:00:04,000\nhello\n\n"
+            )
+        params = vd.VideoParams(video_subject="test", font_name="Charm-Bold.ttf", font_size=40)
+        vd._render_text.cache_clear()
+        video_clip = vd.ColorClip(size=(320, 240), color=(0, 0, 255), duration=5)
+        subtitled = vd.add_subtitles(video_clip, subtitle_file, params, 320, 240)
+
+        # "hello" is rasterized once for both of its lines
+        self.assertEqual(vd._render_text.cache_info().misses, 2)
+        self.assertEqual(subtitled.duration, 5)
+        self.assertFalse((subtitled.get_frame(0.5) == video_clip.get_frame(0.5)).all())
+        self.assertFalse((subtitled.get_frame(3.5) == video_clip.get_frame(3.5)).all())
+        self.assertTrue((subtitled.get_frame(2.5) == video_clip.get_frame(2.5)).all())
+        self.assertTrue((subtitled.get_frame(4.5) == video_clip.get_frame(4.5)).all())
+
+    def test_create_ass_subtitles(self):
+        temp_dir = utils.storage_dir("temp", create=True)
+        subtitle_file = os.path.join(temp_dir, "subtitle-ass.srt")
+        with open(subtitle_file, "w", encoding="utf-8") as f:
+            f.write("1\n00:00:01,250 --> 00:01:02,000\nhello {world}\n\n")
+        params = vd.VideoParams(
+            video_subject="test",
+            font_name="Charm-Bold.ttf",
+            text_fore_color="#FF8000",
+            text_background_color="#000000",
+            subtitle_renderer="ass",
+        )
+        ass_file = vd.create_ass_subtitles(
+            subtitle_file, params, 1080, 1920, os.path.join(temp_dir, "subtitle.ass")
+        )
+        with open(ass_file, "r", encoding="utf-8") as f:
+            content = f.read()
+
+        self.assertIn("PlayResX: 1080", content)
+        self.assertIn("Style: Default,Charm,", content)
+        # colors are &HAABBGGRR, the background box uses the outline color
+        self.assertIn(",&H000080FF,&H00FFFFFF,&H00000000,", content)
+        self.assertIn("Dialogue: 0,0:00:01.25,0:01:02.00,Default,,0,0,0,,{\\pos(540,", content)
+        self.assertIn("hello \\{world\\}", content)
+        self.assertTrue(vd.get_subtitles_filter(ass_file).startswith("subtitles=filename='"))
+
+    def test_encode_profiles(self):
+        with mock.patch.dict(
+            vd.config.app,
+            {
+                "encode_profile": "fast",
+                "encode_profiles": {"archive": {"bitrate": "8000k"}, "web": {"preset": "fast", "crf": 22}},
+            },
+        ):
+            self.assertEqual(vd.get_encode_profile().ffmpeg_args(), ["-preset", "veryfast", "-crf", "24"])
+            self.assertEqual(vd.get_encode_profile("Draft").name, "draft")
+            self.assertEqual(vd.get_encode_profile("unknown").name, "fast")
+            # a bitrate from the config replaces the crf, the two are never combined
+            self.assertEqual(
+                vd.get_encode_profile("archive").ffmpeg_args(), ["-preset", "slow", "-b:v", "8000k"]
+            )
+            self.assertEqual(vd.get_encode_profile("web").rate_control_args(), ["-crf", "22"])
+
+            vd.record_encode(vd.get_encode_profile("web"), video_duration=10, elapsed=2)
+            stats = vd.get_encode_stats()
+        self.assertEqual(stats["web"]["fps"], 10 * vd.fps / 2)
+        self.assertEqual(stats["web"]["encodes"], 1)
+        self.assertIn("balanced", stats)
+
+    def test_blit_subtitles_clips_to_frame(self):
+        frame = vd.np.zeros((10, 10, 3), dtype=vd.np.uint8)
+        image = vd.np.full((4, 20, 4), 255, dtype=vd.np.uint8)
+        sprite = vd.SubtitleSprite(0, 1, -5, 8, image)
+        result = vd.blit_subtitles(frame, [sprite])
+        self.assertTrue((result[8:, :] == 255).all())
+        self.assertTrue((result[:8, :] == 0).all())
+        self.assertTrue((frame == 0).all())
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
@@ -1,13 +1,18 @@
 import asyncio
+import shutil
+import tempfile
 import unittest
 import os
 import sys
 from pathlib import Path
+from unittest import mock
 
 # add project root to python path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
 from app.utils import utils
+from app.services import cache, probe
+from app.services.utils import ffmpeg
 from app.services import voice as vs
 
 temp_dir = utils.storage_dir("temp")
@@ -101,6 +106,66 @@ class TestVoiceService(unittest.TestCase):
 
         self.loop.run_until_complete(_do())
 
+    def test_tts_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        voice_file = os.path.join(cache_dir, "audio.mp3")
+
+        def synthesize(text, voice_name, voice_rate, voice_file, voice_volume):
+            with open(voice_file, "wb") as f:
+                f.write(b"mp3")
+            sub_maker = vs.SubMaker()
+            sub_maker.create_sub((0, 5000000), "hello")
+            return sub_maker
+
+        try:
+            with mock.patch.object(
+                vs, "_tts_cache", cache.FileCache(os.path.join(cache_dir, "cache"), 1024 * 1024)
+            ), mock.patch.object(vs, "_tts", side_effect=synthesize) as _tts:
+                vs.tts("hello  world", "zh-CN-XiaoyiNeural-Female", 1.0, voice_file)
+                os.remove(voice_file)
+                sub_maker = vs.tts("hello world", "zh-CN-XiaoyiNeural-Female", 1.0, voice_file)
+                self.assertEqual(_tts.call_count, 1)
+                self.assertEqual(sub_maker.subs, ["hello"])
+                self.assertEqual(vs.get_audio_duration(sub_maker), 0.5)
+                with open(voice_file, "rb") as f:
+                    self.assertEqual(f.read(), b"mp3")
+
+                # a different rate is synthesized again
+                vs.tts("hello world", "zh-CN-XiaoyiNeural-Female", 1.2, voice_file)
+                self.assertEqual(_tts.call_count, 2)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_split_tts_chunks(self):
+        chunks = vs.split_tts_chunks(text_zh, max_length=40)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= 40 for chunk in chunks))
+        self.assertEqual("".join(chunks), "".join(text_zh.split()))
+        self.assertEqual(vs.split_tts_chunks("fee is 2.5% now.", max_length=5), ["fee is 2.5% now."])
+
+    def test_tts_in_chunks(self):
+        work_dir = tempfile.mkdtemp()
+        voice_file = os.path.join(work_dir, "audio.mp3")
+
+        def synthesize(text, voice_name, voice_rate, voice_file, voice_volume):
+            # one second of audio per chunk, with a single word boundary at 0.2s
+            ffmpeg.run(["-f", "lavfi", "-i", "anullsrc=r=24000:cl=mono", "-t", "1", "-c:a", "libmp3lame", voice_file])
+            sub_maker = vs.SubMaker()
+            sub_maker.create_sub((2000000, 1000000), text)
+            return sub_maker
+
+        try:
+            with mock.patch.object(vs, "_tts", side_effect=synthesize) as _tts:
+                sub_maker = vs._tts_in_chunks(text_en, "en-US-JennyNeural-Female", 1.0, voice_file)
+            self.assertGreater(_tts.call_count, 1)
+            self.assertEqual(len(sub_maker.subs), _tts.call_count)
+            # the boundaries of the second chunk are shifted by the duration of the first one
+            self.assertAlmostEqual(sub_maker.offset[1][0] / 10000000, 1.2, delta=0.1)
+            self.assertAlmostEqual(probe.probe(voice_file).duration, _tts.call_count, delta=0.2)
+            self.assertEqual(os.listdir(work_dir), ["audio.mp3"])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
 if __name__ == "__main__":
     # python -m unittest test.services.test_voice.TestVoiceService.test_azure_tts_v1
     # python -m unittest test.services.test_voice.TestVoiceService.test_azure_tts_v2
@@ -0,0 +1,111 @@
+import json
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app import worker
+from app.controllers.manager import fair_queue, redis_manager
+from app.models import const
+from app.models.schema import VideoParams
+
+
+class TestWorker(unittest.TestCase):
+    def test_requeue_dead_workers(self):
+        redis_client = mock.Mock()
+        redis_client.smembers.return_value = [b"alive", b"dead"]
+        redis_client.exists.side_effect = lambda key: key.endswith(":alive")
+        tasks = [
+            json.dumps({"kwargs": {"task_id": "task-1"}, "priority": "high", "tenant": "a"}),
+            json.dumps({"kwargs": {"task_id": "task-2"}, "attempts": 2}),
+        ]
+        # the processing list is newest first
+        redis_client.lrange.return_value = tasks[::-1]
+        requeue = mock.Mock(return_value=[1, 1])
+        redis_client.register_script.side_effect = lambda script: (
+            requeue if script == fair_queue._REQUEUE_SCRIPT else mock.Mock()
+        )
+
+        with mock.patch.object(worker, "_max_attempts", 3), mock.patch.object(
+            worker.sm, "state"
+        ) as state:
+            self.assertEqual(worker.requeue_dead_workers(redis_client), 1)
+
+        queue_name = redis_manager.get_queue_name()
+        self.assertTrue(queue_name.startswith("{"))
+        keys = requeue.call_args.kwargs["keys"]
+        self.assertEqual(
+            keys,
+            [
+                worker._processing_key("dead"),
+                f"{queue_name}:signal",
+                f"{queue_name}:high:tenant:a",
+                f"{queue_name}:high:tenants",
+                f"{queue_name}:normal:tenant:default",
+                f"{queue_name}:normal:tenants",
+            ],
+        )
+        args = requeue.call_args.kwargs["args"]
+        self.assertEqual(args[0], tasks[0])
+        # the attempts are counted in the task
+        self.assertEqual(json.loads(args[1])["attempts"], 1)
+        self.assertEqual(args[2], "a")
+        # the third attempt was the last one
+        self.assertEqual(args[4:], ["", "default"])
+        state.update_task.assert_called_once_with("task-2", state=const.TASK_STATE_FAILED)
+        redis_client.srem.assert_called_once_with(worker._workers_key(), "dead")
+
+    def test_requeue_skips_tasks_taken_by_another_worker(self):
+        redis_client = mock.Mock()
+        redis_client.lrange.return_value = [json.dumps({"kwargs": {"task_id": "task-1"}})]
+        redis_client.register_script.return_value = mock.Mock(return_value=[0])
+        queue = fair_queue.RedisFairQueue(redis_client, "test")
+        self.assertEqual(queue.requeue("processing", max_attempts=1), (0, []))
+
+    def test_migrate_legacy_queue(self):
+        redis_client = mock.Mock()
+        old_tasks = [json.dumps({"func": "start", "args": [], "kwargs": {"task_id": "task-1"}}), None]
+        redis_client.lpop.side_effect = old_tasks
+        queue = mock.Mock()
+        queue.name = redis_manager.get_queue_name()
+
+        self.assertEqual(redis_manager.migrate_legacy_queue(redis_client, queue), 1)
+        redis_client.lpop.assert_called_with("task_queue")
+        task_json, priority, tenant = queue.put.call_args.args
+        self.assertEqual((priority, tenant), ("normal", "default"))
+        self.assertEqual(json.loads(task_json)["kwargs"]["task_id"], "task-1")
+
+    def test_run_task_acknowledges_the_task(self):
+        task_json = redis_manager.serialize_task(
+            {
+                "func": redis_manager.tm.start,
+                "args": (),
+                "kwargs": {
+                    "task_id": "task-1",
+                    "params": VideoParams(video_subject="test"),
+                    "stop_at": "video",
+                },
+            }
+        )
+        self.assertEqual(json.loads(task_json)["kwargs"]["params"]["video_aspect"], "9:16")
+
+        redis_client = mock.Mock()
+        w = worker.Worker(redis_client)
+        start = mock.Mock(side_effect=RuntimeError("render failed"))
+        with mock.patch.dict(redis_manager.FUNC_MAP, {"start": start}), mock.patch.object(
+            worker.sm, "state"
+        ) as state:
+            w.run_task(task_json)
+
+        self.assertEqual(start.call_args.kwargs["task_id"], "task-1")
+        state.update_task.assert_called_once_with("task-1", state=const.TASK_STATE_FAILED)
+        self.assertIsInstance(start.call_args.kwargs["params"], VideoParams)
+        # removed from the processing list even though it failed, it is not run again
+        redis_client.lrem.assert_called_once_with(worker._processing_key(w.worker_id), 1, task_json)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.controllers.manager.memory_manager import InMemoryTaskManager
+from app.controllers.manager.worker_pool import WorkerPool
+from app.models import const
+from app.services import state as sm
+
+
+def report_progress(task_id: str):
+    sm.state.update_task(task_id, state=const.TASK_STATE_COMPLETE, progress=100, pid=os.getpid())
+
+
+def crash(task_id: str):
+    os._exit(1)
+
+
+def report_progress_later(task_id: str):
+    time.sleep(3)
+    report_progress(task_id)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(max_workers=1, max_tasks_per_child=1)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def _wait_for_state(self, task_id: str, state: int) -> dict:
+        for _ in range(100):
+            task = sm.state.get_task(task_id)
+            if task and task["state"] == state:
+                return task
+            time.sleep(0.1)
+        self.fail(f"task {task_id} did not reach state {state}")
+
+    def test_state_updates_flow_back_from_the_workers(self):
+        done = threading.Event()
+        self.pool.submit(report_progress, task_id="pool-1", on_done=done.set)
+        self.assertTrue(done.wait(60))
+        task = self._wait_for_state("pool-1", const.TASK_STATE_COMPLETE)
+        self.assertNotEqual(task["pid"], os.getpid())
+
+        # the worker is replaced after each task
+        self.pool.submit(report_progress, task_id="pool-2").result(60)
+        self.assertNotEqual(self._wait_for_state("pool-2", const.TASK_STATE_COMPLETE)["pid"], task["pid"])
+
+    def test_crashed_worker_fails_the_task_and_is_replaced(self):
+        sm.state.update_task("pool-3")
+        done = threading.Event()
+        self.pool.submit(crash, task_id="pool-3", on_done=done.set)
+        self.assertTrue(done.wait(60))
+        self.assertEqual(sm.state.get_task("pool-3")["state"], const.TASK_STATE_FAILED)
+
+        self.pool.submit(report_progress, task_id="pool-4").result(60)
+        self._wait_for_state("pool-4", const.TASK_STATE_COMPLETE)
+
+    def test_crashed_worker_does_not_fail_the_other_tasks(self):
+        pool = WorkerPool(max_workers=2)
+        try:
+            running = pool.submit(report_progress_later, task_id="pool-5")
+            crashed = pool.submit(crash, task_id="pool-6")
+            with self.assertRaises(Exception):
+                crashed.result(60)
+            running.result(60)
+            self._wait_for_state("pool-5", const.TASK_STATE_COMPLETE)
+        finally:
+            pool.shutdown()
+
+    def test_failed_submit_does_not_hold_a_slot(self):
+        manager = InMemoryTaskManager(max_concurrent_tasks=1, worker_pool=self.pool)
+        self.pool.shutdown()
+        with self.assertRaises(RuntimeError):
+            manager.add_task(report_progress, task_id="pool-7")
+        self.assertEqual(manager.current_tasks, 0)
+
+    def test_task_finishing_during_submit_does_not_deadlock(self):
+        manager = InMemoryTaskManager(max_concurrent_tasks=1, worker_pool=self.pool)
+
+        def finish_at_once(item):
+            # the supervisor completes the task before submit returns
+            finisher = threading.Thread(target=item[3].set_result, args=(None,))
+            finisher.start()
+            finisher.join(1)
+
+        with mock.patch.object(self.pool._tasks, "put", side_effect=finish_at_once):
+            adder = threading.Thread(
+                target=manager.add_task,
+                args=(report_progress,),
+                kwargs={"task_id": "pool-8"},
+                daemon=True,
+            )
+            adder.start()
+            adder.join(10)
+        self.assertFalse(adder.is_alive())
+        for _ in range(100):
+            if manager.current_tasks == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(manager.current_tasks, 0)
+
+if __name__ == "__main__":
+    unittest.main()
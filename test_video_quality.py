@@ -7,7 +7,7 @@
 import os
 import time
 from pathlib import Path
-from app.services.video import diagnose_video_quality, VideoQualityConfig
+from app.services.video import diagnose_video_quality, get_encode_stats, VideoQualityConfig
 from app.services.task import start
 from app.models.schema import VideoParams, MaterialInfo
 
@@ -23,25 +23,19 @@ def test_video_quality_optimization():
             "name": "快速模式",
             "temp_bitrate": "3000k",
             "temp_preset": "faster",
-            "final_bitrate": "6000k",
-            "final_preset": "medium",
-            "final_crf": "20"
+            "encode_profile": "fast"
         },
         {
             "name": "平衡模式（默认）",
             "temp_bitrate": "4000k",
             "temp_preset": "faster",
-            "final_bitrate": "8000k",
-            "final_preset": "slow",
-            "final_crf": "18"
+            "encode_profile": "balanced"
         },
         {
             "name": "高质量模式",
             "temp_bitrate": "6000k",
             "temp_preset": "medium",
-            "final_bitrate": "10000k",
-            "final_preset": "slower",
-            "final_crf": "16"
+            "encode_profile": "archive"
         }
     ]
     
@@ -54,16 +48,10 @@ def test_video_quality_optimization():
         original_config = {
             "temp_bitrate": VideoQualityConfig.TEMP_BITRATE,
             "temp_preset": VideoQualityConfig.TEMP_PRESET,
-            "final_bitrate": VideoQualityConfig.FINAL_BITRATE,
-            "final_preset": VideoQualityConfig.FINAL_PRESET,
-            "final_crf": VideoQualityConfig.FINAL_CRF
         }
         
         VideoQualityConfig.TEMP_BITRATE = config["temp_bitrate"]
         VideoQualityConfig.TEMP_PRESET = config["temp_preset"]
-        VideoQualityConfig.FINAL_BITRATE = config["final_bitrate"]
-        VideoQualityConfig.FINAL_PRESET = config["final_preset"]
-        VideoQualityConfig.FINAL_CRF = config["final_crf"]
         
         try:
             # 测试开始时间
@@ -86,7 +74,8 @@ def test_video_quality_optimization():
                 video_materials=test_materials,
                 video_clip_duration=3,
                 video_count=1,
-                n_threads=4
+                n_threads=4,
+                encode_profile=config["encode_profile"]
             )
             
             # 只运行到视频生成步骤
@@ -107,6 +96,7 @@ def test_video_quality_optimization():
                     "processing_time": processing_time,
                     "file_size_mb": file_size,
                     "video_info": video_info,
+                    "encode_fps": get_encode_stats()[config["encode_profile"]]["fps"],
                     "success": True
                 }
                 
@@ -114,6 +104,7 @@ def test_video_quality_optimization():
                 print(f"   处理时间: {processing_time:.2f}秒")
                 print(f"   文件大小: {file_size:.2f}MB")
                 print(f"   视频信息: {video_info}")
+                print(f"   编码速度: {test_result['encode_fps']} fps")
                 
             else:
                 test_result = {
@@ -136,9 +127,6 @@ def test_video_quality_optimization():
             # 恢复原始配置
             VideoQualityConfig.TEMP_BITRATE = original_config["temp_bitrate"]
             VideoQualityConfig.TEMP_PRESET = original_config["temp_preset"]
-            VideoQualityConfig.FINAL_BITRATE = original_config["final_bitrate"]
-            VideoQualityConfig.FINAL_PRESET = original_config["final_preset"]
-            VideoQualityConfig.FINAL_CRF = original_config["final_crf"]
             
         results.append(test_result)
     
@@ -214,4 +202,4 @@ if __name__ == "__main__":
     print("1. 如果追求速度，选择快速模式")
     print("2. 如果需要平衡质量和速度，选择平衡模式（推荐）")
     print("3. 如果追求最佳质量，选择高质量模式")
-    print("4. 可以根据具体需求调整 VideoQualityConfig 中的参数") 
\ No newline at end of file
+    print("4. 可以通过 encode_profile 选择编码档位，或在 config.toml 的 encode_profiles 中调整")
\ No newline at end of file
@@ -17,13 +17,12 @@ if root_dir not in sys.path:
 
 from app.config import config
 from app.models.schema import (
-    MaterialInfo,
     VideoAspect,
     VideoConcatMode,
     VideoParams,
     VideoTransitionMode,
 )
-from app.services import llm, voice
+from app.services import llm, upload, voice
 from app.services import task as tm
 from app.utils import utils
 
@@ -1130,17 +1129,16 @@ if start_button:
         st.stop()
 
     if uploaded_files:
-        local_videos_dir = utils.storage_dir("local_videos", create=True)
         for file in uploaded_files:
-            file_path = os.path.join(local_videos_dir, f"{file.file_id}_{file.name}")
-            with open(file_path, "wb") as f:
-                f.write(file.getbuffer())
-                m = MaterialInfo()
-                m.provider = "local"
-                m.url = file_path
-                if not params.video_materials:
-                    params.video_materials = []
-                params.video_materials.append(m)
+            try:
+                m = upload.save_material(file, file.name)
+            except ValueError as e:
+                st.error(str(e))
+                scroll_to_bottom()
+                st.stop()
+            if not params.video_materials:
+                params.video_materials = []
+            params.video_materials.append(m)
 
     log_container = st.empty()
     log_records = []